@@ -0,0 +1,143 @@
+"""
+Unit designator and street type normalisation from a dictionary of known variants.
+
+data/address_terms.csv maps each known variant of a unit designator
+(basement, lower un, ...) or street type (avenue, cresc, ...) to its
+canonical form (BSMT, LOWR, AVE, CRES, ...). A value that is not a known
+variant is matched against them through a character trigram index: the
+variants sharing the most trigrams with the value are compared by edit
+distance, and the closest is taken if it is within a distance bounded by
+the value's length and no variant of another canonical form is as close.
+Matches only a little further off are returned as suggestions for review.
+
+Each distinct value is looked up once per process, so a file with a
+million addresses costs one fuzzy match per unique string.
+"""
+import csv
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set
+
+DEFAULT_ADDRESS_TERMS = Path(__file__).parent / "data" / "address_terms.csv"
+UNIT = "unit"
+STREET_TYPE = "street_type"
+# Variants compared by edit distance for each fuzzy lookup, taken in order of shared trigrams
+CANDIDATES = 12
+
+_PUNCTUATION = re.compile(r"[.,]")
+_SEPARATORS = re.compile(r"[\s\-_]+")
+_DIGITS = re.compile(r"\d+")
+
+
+def term_key(value: str) -> str:
+    """Return the lookup form of a value: lowercased, without dots or commas, and single-spaced."""
+    return _SEPARATORS.sub(" ", _PUNCTUATION.sub("", value.lower())).strip()
+
+
+def max_distance(key: str) -> int:
+    """Edit distance allowed for a confident match: none for short values, one or two for longer ones."""
+    if len(key) <= 3:
+        return 0
+    return 1 if len(key) <= 7 else 2
+
+
+def trigrams(key: str) -> Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Return the Levenshtein distance between a and b, or limit + 1 once it is known to exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class TermMatch(NamedTuple):
+    canonical: str
+    # The known variant matched, and its edit distance from the value
+    variant: str
+    distance: int
+    # Exact or close enough to apply without review
+    confident: bool
+
+
+class TermMatcher:
+    """Known variants of one field's terms, with a trigram index over them for fuzzy lookups."""
+
+    def __init__(self, variants: Dict[str, str]) -> None:
+        # Lookup key -> canonical form; every canonical form is a variant of itself
+        self.variants = dict(variants)
+        for canonical in set(variants.values()):
+            self.variants.setdefault(term_key(canonical), canonical)
+        self._keys: List[str] = list(self.variants)
+        self._index: Dict[str, List[int]] = defaultdict(list)
+        for position, key in enumerate(self._keys):
+            for trigram in trigrams(key):
+                self._index[trigram].append(position)
+        self._memo: Dict[str, Optional[TermMatch]] = {}
+
+    def lookup(self, value: str) -> Optional[TermMatch]:
+        """
+        Return the canonical form of a value, or a suggestion that needs review, or None.
+
+        A known variant matches exactly. Otherwise the closest variant is
+        confident within max_distance() of the value, when no variant of a
+        different canonical form is as close, and a suggestion within twice
+        that distance. Only variants with the same numbers as the value are
+        compared, so a number is never edited away, as in "lower2".
+        """
+        key = term_key(value)
+        if key in self._memo:
+            return self._memo[key]
+        match = self._match(key)
+        self._memo[key] = match
+        return match
+
+    def _match(self, key: str) -> Optional[TermMatch]:
+        canonical = self.variants.get(key)
+        if canonical is not None:
+            return TermMatch(canonical, key, 0, True)
+        allowed = max_distance(key)
+        limit = max(2 * allowed, 1)
+        shared: Counter = Counter()
+        for trigram in trigrams(key):
+            shared.update(self._index.get(trigram, ()))
+        digits = _DIGITS.findall(key)
+        best: List[TermMatch] = []
+        for position, _ in shared.most_common(CANDIDATES):
+            variant = self._keys[position]
+            if _DIGITS.findall(variant) != digits:
+                continue
+            distance = edit_distance(key, variant, limit)
+            if distance > limit:
+                continue
+            if not best or distance < best[0].distance:
+                best = [TermMatch(self.variants[variant], variant, distance, False)]
+            elif distance == best[0].distance:
+                best.append(TermMatch(self.variants[variant], variant, distance, False))
+        if not best:
+            return None
+        match = best[0]
+        unambiguous = len({candidate.canonical for candidate in best}) == 1
+        return match._replace(confident=match.distance <= allowed and unambiguous)
+
+
+@lru_cache(maxsize=None)
+def load_address_terms(path: Path = DEFAULT_ADDRESS_TERMS) -> Dict[str, TermMatcher]:
+    """Load a matcher per field from a CSV table with field, variant and canonical columns."""
+    fields: Dict[str, Dict[str, str]] = defaultdict(dict)
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            fields[row["field"]][term_key(row["variant"])] = row["canonical"].strip().upper()
+    return {field: TermMatcher(variants) for field, variants in fields.items()}
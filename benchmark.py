@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Benchmark the scripts on synthetic STIX files of increasing size.
+
+Each case runs in a fresh process on a file from generate_stix.py, so its
+peak RSS is measured on its own. The wall time covers the work itself,
+not interpreter start-up and imports. Results are appended to a JSONL file
+with the code version they were measured on, and --compare checks the
+current results against an earlier version's:
+
+    python benchmark.py --sizes 10k 100k --label before
+    python benchmark.py --sizes 10k 100k --compare before
+
+Peak RSS needs os.wait4, so it is only reported on Linux and macOS.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+from generate_stix import GeneratorConfig, generate_file
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_WORKDIR = Path("benchmarks") / "data"
+DEFAULT_RESULTS = Path("benchmarks") / "results.jsonl"
+# Slowdown, as a share of the earlier time or RSS, reported as a regression
+DEFAULT_THRESHOLD = 0.10
+# Smaller wall time differences are noise, whatever their share
+MIN_WALL_DELTA_S = 0.05
+
+
+def _twig_stix(path: Path, stream: bool) -> None:
+    from twig_stix import CleanOptions, clean_file
+    summary = clean_file(str(path), CleanOptions(stream=stream, batch=True, no_memo=True))
+    if summary["error"]:
+        raise RuntimeError(summary["error"])
+
+
+def _pull_info(path: Path) -> None:
+    import pull_info
+    pull_info.parse_xml(path)
+
+
+def _extract_schools(path: Path) -> None:
+    import extract_schools
+    index = extract_schools.build_index(path)
+    # A handful of schools spread through the file
+    schools = index.schools[::max(1, len(index.schools) // 10)]
+    extract_schools.extract(path, index, schools, path.with_name(path.stem + "_SCHOOLS.xml"))
+
+
+def _rename_file(path: Path) -> None:
+    import rename_file
+    plans = rename_file.plan_renames([path], "elementary")
+    if plans[0].problem:
+        raise RuntimeError(plans[0].problem)
+
+
+def _pretty_print_xml(path: Path) -> None:
+    import pretty_print_xml
+    pretty_print_xml.stream_pretty(str(path), str(path.with_name(path.stem + "_PRETTY.xml")))
+
+
+# Case name -> function run on the generated file
+CASES: Dict[str, Callable[[Path], None]] = {
+    "twig_stix": lambda path: _twig_stix(path, stream=False),
+    "twig_stix_stream": lambda path: _twig_stix(path, stream=True),
+    "pull_info.parse_xml": _pull_info,
+    "extract_schools": _extract_schools,
+    "rename_file": _rename_file,
+    "pretty_print_xml": _pretty_print_xml,
+}
+
+
+@dataclass
+class Result:
+    """One case's measurement on one file."""
+    label: str
+    timestamp: str
+    python: str
+    case: str
+    students: int
+    file_mb: float
+    wall_s: float
+    students_per_s: float
+    peak_rss_mb: Optional[float]
+
+
+def parse_size(value: str) -> int:
+    """Parse a student count such as 10000, 100k or 1M."""
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    suffix = value[-1].lower()
+    if suffix in multipliers:
+        return int(float(value[:-1]) * multipliers[suffix])
+    return int(value)
+
+
+def version_label() -> str:
+    """Return the checked-out commit, marked dirty if there are uncommitted changes."""
+    here = Path(__file__).parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def dataset(workdir: Path, students: int, config: GeneratorConfig) -> Path:
+    """Return the generated file for a size, generating it on first use."""
+    path = workdir / f"stix_{students}_{config.encoding}_seed{config.seed}.xml"
+    if not path.exists():
+        workdir.mkdir(parents=True, exist_ok=True)
+        print(f"Generating {path} ...", flush=True)
+        tmp = path.with_suffix(".tmp")
+        generate_file(str(tmp), GeneratorConfig(**{**asdict(config), "students": students}))
+        os.replace(tmp, path)
+    return path
+
+
+def run_case(case: str, path: Path) -> float:
+    """Run a case in this process and return its wall time in seconds."""
+    func = CASES[case]
+    start = time.perf_counter()
+    func(path)
+    return time.perf_counter() - start
+
+
+def measure(case: str, path: Path) -> Dict[str, Optional[float]]:
+    """Run a case in a child process and return its wall time and peak RSS in MB."""
+    command = [sys.executable, str(Path(__file__).resolve()), "--child", case, str(path.resolve())]
+    # Outputs and logs of the scripts land next to the data, not in the caller's directory
+    proc = subprocess.Popen(command, cwd=path.parent, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    peak_rss_mb = None
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in KB on Linux and bytes on macOS
+        peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    else:
+        proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{case} failed on {path} (exit code {proc.returncode})")
+    return {"wall_s": json.loads(output)["wall_s"], "peak_rss_mb": peak_rss_mb}
+
+
+def load_results(path: Path, label: str) -> Dict[tuple, Result]:
+    """Return the latest result for each (case, students) recorded under label."""
+    latest: Dict[tuple, Result] = {}
+    if path.exists():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    result = Result(**json.loads(line))
+                    if result.label == label:
+                        latest[(result.case, result.students)] = result
+    return latest
+
+
+def compare(results: Sequence[Result], baseline: Dict[tuple, Result], threshold: float) -> int:
+    """Print each result against the baseline and return the number of regressions."""
+    regressions = 0
+    print(f"\n{'Case':<22} {'Students':>9} {'Wall':>14} {'Peak RSS':>14}")
+    for result in results:
+        before = baseline.get((result.case, result.students))
+        if before is None:
+            print(f"{result.case:<22} {result.students:>9} {'(no baseline)':>14}")
+            continue
+        changes = [result.wall_s / before.wall_s - 1]
+        columns = [f"{changes[0]:+.0%}"]
+        if abs(result.wall_s - before.wall_s) < MIN_WALL_DELTA_S:
+            changes[0] = 0.0
+        if result.peak_rss_mb and before.peak_rss_mb:
+            changes.append(result.peak_rss_mb / before.peak_rss_mb - 1)
+            columns.append(f"{changes[1]:+.0%}")
+        else:
+            columns.append("n/a")
+        flag = ""
+        if any(change > threshold for change in changes):
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{result.case:<22} {result.students:>9} {columns[0]:>14} {columns[1]:>14}{flag}")
+    return regressions
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Benchmark the STIX scripts on generated files.")
+    p.add_argument("--sizes", nargs="+", type=parse_size, default=list(DEFAULT_SIZES),
+                   help="Student counts to benchmark, e.g. 10k 100k 1M (default: 10k 100k 1M)")
+    p.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="Cases to run (default: all)")
+    p.add_argument("--repeat", type=int, default=1, help="Runs per case; the fastest is kept (default: 1)")
+    p.add_argument("--encoding", choices=("windows-1252", "utf-8"), default="windows-1252")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--workdir", type=Path, default=DEFAULT_WORKDIR, help="Where generated files are kept")
+    p.add_argument("--results", type=Path, default=DEFAULT_RESULTS, help="JSONL file results are appended to")
+    p.add_argument("--label", help="Version label for the results (default: the git commit)")
+    p.add_argument("--compare", metavar="LABEL", help="Compare with the latest results recorded under LABEL")
+    p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                   help="Slowdown or RSS growth reported as a regression (default: %(default)s)")
+    p.add_argument("--child", nargs=2, metavar=("CASE", "PATH"), help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.child:
+        case, path = args.child
+        print(json.dumps({"wall_s": run_case(case, Path(path))}))
+        return 0
+
+    label = args.label or version_label()
+    config = GeneratorConfig(encoding=args.encoding, seed=args.seed)
+    results: List[Result] = []
+    print(f"{'Case':<22} {'Students':>9} {'Wall (s)':>9} {'Students/s':>11} {'Peak RSS (MB)':>14}")
+    for students in args.sizes:
+        path = dataset(args.workdir, students, config)
+        for case in args.cases:
+            runs = [measure(case, path) for _ in range(max(1, args.repeat))]
+            wall_s = min(run["wall_s"] for run in runs)
+            rss = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+            result = Result(
+                label=label, timestamp=datetime.now().isoformat(timespec="seconds"),
+                python=platform.python_version(), case=case, students=students,
+                file_mb=round(path.stat().st_size / 1e6, 1), wall_s=round(wall_s, 3),
+                students_per_s=round(students / wall_s), peak_rss_mb=round(max(rss), 1) if rss else None,
+            )
+            results.append(result)
+            rss_text = f"{result.peak_rss_mb:.1f}" if result.peak_rss_mb is not None else "n/a"
+            print(f"{case:<22} {students:>9} {result.wall_s:>9.2f} {result.students_per_s:>11} {rss_text:>14}",
+                  flush=True)
+
+    args.results.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.results, "a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(asdict(result)) + "\n")
+    print(f"\nResults for {label} appended to {args.results}")
+
+    if args.compare:
+        regressions = compare(results, load_results(args.results, args.compare), args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
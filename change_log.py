@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Structured log of every value twig_stix changes or flags, one JSON line per record.
+
+Records are buffered and written in batches from a background thread, so a
+cleaning run only pays for appending a tuple per change. The human-readable
+log carries per-rule totals instead. The file is meant to be queried
+afterwards, e.g. every phone number emptied in one school:
+
+    python change_log.py file_CHANGES.jsonl --school 1234 --field Phone HomePhone --emptied
+"""
+import argparse
+import json
+import queue
+import sys
+import threading
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+# Columns of a change record, in the order of the tuples passed to ChangeLog
+CHANGE_FIELDS = ["sourceline", "school_number", "student_key", "field", "old", "new", "rule", "note"]
+ChangeRecord = Tuple[int, str, str, str, Optional[str], Optional[str], str, str]
+
+# Records per batch handed to the writer thread
+BATCH_SIZE = 5000
+
+
+class ChangeLog:
+    """
+    Append-only JSONL change log written by a background thread.
+
+    append() and extend() only buffer records; full batches are queued for
+    the writer thread, and close() flushes the rest and waits for it.
+    """
+
+    def __init__(self, path: str, append: bool = False, batch_size: int = BATCH_SIZE) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer: List[ChangeRecord] = []
+        # Bounded so a slow disk applies back-pressure instead of piling up batches
+        self._queue: "queue.Queue[Optional[List[ChangeRecord]]]" = queue.Queue(maxsize=8)
+        self._error: Optional[BaseException] = None
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+        self._thread = threading.Thread(target=self._write, name="change-log-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, record: ChangeRecord) -> None:
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self._hand_off()
+
+    def extend(self, records: Iterable[ChangeRecord]) -> None:
+        for record in records:
+            self.append(record)
+
+    def close(self) -> None:
+        """Write any buffered records and wait for the writer thread to finish. Safe to call twice."""
+        if self._file.closed:
+            return
+        if self._buffer:
+            self._hand_off()
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+    def _hand_off(self) -> None:
+        self.count += len(self._buffer)
+        self._queue.put(self._buffer)
+        self._buffer = []
+
+    def _write(self) -> None:
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._file.write("".join(
+                    json.dumps(dict(zip(CHANGE_FIELDS, record)), ensure_ascii=False) + "\n" for record in batch
+                ))
+                self._file.flush()
+            except BaseException as exc:
+                # Keep draining the queue so producers never block; close() re-raises
+                self._error = exc
+
+    def __enter__(self) -> "ChangeLog":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def load_changes(path: str) -> pd.DataFrame:
+    """Read a change log into a DataFrame with the CHANGE_FIELDS columns."""
+    df = pd.read_json(path, lines=True, dtype=False)
+    if df.empty:
+        return pd.DataFrame(columns=CHANGE_FIELDS)
+    return df[CHANGE_FIELDS]
+
+
+def query_changes(df: pd.DataFrame, schools: Sequence[str] = (), fields: Sequence[str] = (),
+                  rules: Sequence[str] = (), emptied: bool = False) -> pd.DataFrame:
+    """
+    Select change records by SchoolNumber, field localname and rule.
+
+    A rule matches itself and any rule under it, so "phone" matches
+    "phone:short" and "phone:invalid_area_code". With emptied, only values
+    that were set to "" are kept.
+    """
+    keep = pd.Series(True, index=df.index)
+    if schools:
+        keep &= df["school_number"].astype(str).isin(schools)
+    if fields:
+        keep &= df["field"].isin(fields)
+    if rules:
+        rule = df["rule"].astype(str)
+        keep &= rule.isin(rules) | rule.str.startswith(tuple(f"{name}:" for name in rules))
+    if emptied:
+        keep &= df["new"].fillna("").eq("") & df["old"].fillna("").ne("")
+    return df[keep]
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Query a twig_stix change log.")
+    p.add_argument("path", help="Change log written by twig_stix ({file}_CHANGES.jsonl)")
+    p.add_argument("--school", nargs="+", default=[], help="SchoolNumbers to keep")
+    p.add_argument("--field", nargs="+", default=[], help="Element localnames to keep (e.g. Phone PostalCode)")
+    p.add_argument("--rule", nargs="+", default=[], help="Rules to keep (e.g. phone, unit:standard)")
+    p.add_argument("--emptied", action="store_true", help="Only values that were set to empty")
+    p.add_argument("--count", action="store_true", help="Print the number of records per rule instead of the records")
+    args = p.parse_args()
+
+    changes = query_changes(load_changes(args.path), args.school, args.field, args.rule, args.emptied)
+    if args.count:
+        print(changes["rule"].value_counts().to_string())
+    else:
+        changes.to_csv(sys.stdout, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+"""
+Persistent store of manual normalisation decisions, reused across runs.
+
+Each decision maps a field, its original value and an optional address
+context (e.g. the StreetName next to a StreetNumber) to the corrected value.
+Entries carry a hit count and a last-used timestamp so stale or rarely used
+decisions can be expired or evicted.
+"""
+import logging
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("twig_stix.correction_store")
+
+DEFAULT_MAX_AGE_DAYS = 365
+DEFAULT_MAX_ENTRIES = 100_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS corrections (
+    field TEXT NOT NULL,
+    original TEXT NOT NULL,
+    context TEXT NOT NULL DEFAULT '',
+    corrected TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (field, original, context)
+)
+"""
+
+
+def _normalise(value: Optional[str]) -> str:
+    """Return the lookup form of a value: stripped and lowercased."""
+    return (value or "").strip().lower()
+
+
+class CorrectionStore:
+    """
+    SQLite-backed memo of field corrections.
+
+    The whole table is loaded into memory on open so lookups cost a dict
+    access. Decisions are committed as soon as they are made; hit counts are
+    added to the stored ones on close(), so parallel runs sharing the store
+    do not overwrite each other's counts or decisions.
+    """
+
+    def __init__(self, path: str, max_age_days: Optional[float] = DEFAULT_MAX_AGE_DAYS,
+                 max_entries: Optional[int] = DEFAULT_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        # Parallel runs share the store; wait for each other's writes to finish
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(_SCHEMA)
+        self.prune()
+        self._entries: Dict[Tuple[str, str, str], list] = {
+            (field, original, context): [corrected, hits, last_used]
+            for field, original, context, corrected, hits, last_used in self.conn.execute(
+                "SELECT field, original, context, corrected, hits, last_used FROM corrections"
+            )
+        }
+        # Hits since open and when each key was last used, added to the table on close()
+        self._used: Dict[Tuple[str, str, str], list] = {}
+        self.hits = 0
+        logger.info("Loaded %d stored corrections from %s", len(self._entries), path)
+
+    def get(self, field: str, original: Optional[str], context: Optional[str] = None) -> Optional[str]:
+        """
+        Return the stored correction for a value, or None if there is none.
+
+        A decision recorded with the same context is preferred; otherwise a
+        context-free decision for the value is used.
+        """
+        original = _normalise(original)
+        for key in ((field, original, _normalise(context)), (field, original, "")):
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] += 1
+                entry[2] = time.time()
+                used = self._used.setdefault(key, [0, 0.0])
+                used[0] += 1
+                used[1] = entry[2]
+                self.hits += 1
+                return entry[0]
+        return None
+
+    def put(self, field: str, original: Optional[str], corrected: str, context: Optional[str] = None) -> None:
+        """Record a decision, replacing any earlier one for the same key, and commit it."""
+        key = (field, _normalise(original), _normalise(context))
+        entry = self._entries.get(key)
+        hits = entry[1] if entry is not None else 0
+        now = time.time()
+        self._entries[key] = [corrected, hits, now]
+        self.conn.execute(
+            "INSERT INTO corrections (field, original, context, corrected, created, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (field, original, context) DO UPDATE SET "
+            "corrected = excluded.corrected, last_used = excluded.last_used",
+            (*key, corrected, now, now),
+        )
+        self.conn.commit()
+
+    def prune(self) -> int:
+        """Expire entries unused for max_age_days and evict the least recently used beyond max_entries."""
+        removed = 0
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 86400
+            removed += self.conn.execute("DELETE FROM corrections WHERE last_used < ?", (cutoff,)).rowcount
+        if self.max_entries is not None:
+            removed += self.conn.execute(
+                "DELETE FROM corrections WHERE rowid NOT IN "
+                "(SELECT rowid FROM corrections ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            ).rowcount
+        self.conn.commit()
+        if removed:
+            logger.info("Pruned %d stored corrections", removed)
+        return removed
+
+    def close(self) -> None:
+        """Add this run's hit counts to the stored ones, then close the database. Closing again does nothing."""
+        if self.conn is None:
+            return
+        self.conn.executemany(
+            "UPDATE corrections SET hits = hits + ?, last_used = MAX(last_used, ?) "
+            "WHERE field = ? AND original = ? AND context = ?",
+            [(hits, last_used, *key) for key, (hits, last_used) in self._used.items()],
+        )
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+        self._used.clear()
+
+    def __enter__(self) -> "CorrectionStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,304 @@
+"""
+Duplicate students across schools and files: the same child enrolled twice.
+
+A child can appear under two schools of one upload, or in both the
+elementary and secondary uploads of a board. Rather than comparing every
+student with every other, candidate pairs come from two indexes over the
+pull_info student table:
+
+* an exact index on OEN, which pairs every two students sharing a valid OEN;
+* a blocking index on last name, birth date and postal FSA, with names
+  compared without accents, case, spaces or punctuation, which pairs the
+  students of a block whose first names (or alias first names) are similar.
+
+Both are self-joins on the key, restricted to keys held by more than one
+student, so the work grows with the number of students plus the number of
+candidate pairs. Keys held by more than max_block students, such as a
+placeholder OEN, are counted and skipped rather than paired.
+
+Each pair is scored between 0 and 1:
+
+* OEN pairs: 0.4, plus 0.2 each for the same birth date and last name and
+  up to 0.2 for first name similarity. Every OEN pair is reported; a low
+  score means two different children share an OEN.
+* Block pairs: 0.6, plus up to 0.3 for first name similarity and 0.1 for
+  the same full postal code, times 0.8 when both have valid OENs that
+  differ. Pairs scoring below min_score are dropped.
+
+Pairs are linked into groups, so three enrollments of one child share a
+DuplicateGroup.
+"""
+import logging
+import re
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from addresses import edit_distance
+
+logger = logging.getLogger("pull_info.duplicates")
+
+# Columns of the pull_info student table that duplicates are found and reported by
+KEY_COLUMNS = ["SchoolNumber", "SchoolName", "OEN", "FirstName", "AliasFirstName", "LastName", "BirthDate",
+               "PostalCode"]
+# Columns given for each student of a pair in the report, as A_<column> and B_<column>
+REPORT_COLUMNS = ["File", "SchoolNumber", "SchoolName", "OEN", "FirstName", "LastName", "BirthDate", "PostalCode"]
+OEN_MATCH = "oen"
+BLOCK_MATCH = "name+birth+fsa"
+BLOCK_KEYS = ["last_key", "BirthDate", "fsa"]
+DEFAULT_MIN_SCORE = 0.5
+# Students sharing a key beyond this many are not paired
+DEFAULT_MAX_BLOCK = 50
+# First names less alike than this do not make a block pair
+MIN_FIRST_NAME_SIMILARITY = 0.75
+
+_NOT_LETTERS = re.compile(r"[^A-Z]")
+_FSA = re.compile(r"[A-Z]\d[A-Z]")
+
+
+@lru_cache(maxsize=None)
+def name_key(value: Optional[str]) -> str:
+    """Return the letters of a name, uppercased, without accents, spaces or punctuation."""
+    if not value:
+        return ""
+    ascii_value = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
+    return _NOT_LETTERS.sub("", ascii_value.upper())
+
+
+def oen_keys(values: pd.Series) -> np.ndarray:
+    """Return the digits of each OEN, or "" unless there are nine of them and they are not all the same."""
+    # Every OEN is distinct, so this is vectorized rather than mapped per distinct value
+    digits = values.astype("string").fillna("").str.replace(r"\D", "", regex=True)
+    valid = (digits.str.len() == 9) & (digits != digits.str.slice(0, 1).str.repeat(9))
+    return digits.where(valid, "").to_numpy(dtype=object)
+
+
+def postal_key(value: Optional[str]) -> str:
+    return "".join((value or "").split()).upper()
+
+
+def fsa_key(value: Optional[str]) -> str:
+    """Return the forward sortation area of a postal code, or "" if it does not start with one."""
+    fsa = postal_key(value)[:3]
+    return fsa if _FSA.fullmatch(fsa) else ""
+
+
+@lru_cache(maxsize=None)
+def first_name_similarity(a: str, b: str) -> float:
+    """
+    Return how alike two name_key() first names are, from 0 to 1.
+
+    Equal names score 1, a name that starts the other (Alex, Alexander)
+    0.85, an initial that starts the other 0.75, and anything else one less
+    the edit distance over the longer length.
+    """
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    short, long = sorted((a, b), key=len)
+    if len(short) == 1:
+        return 0.75 if long.startswith(short) else 0.0
+    if len(short) >= 3 and long.startswith(short):
+        return 0.85
+    return 1 - edit_distance(a, b, len(long)) / len(long)
+
+
+def _map_distinct(values: pd.Series, func: Callable[[Optional[str]], str]) -> np.ndarray:
+    """Apply func once per distinct value of a column and return the results as an object array."""
+    codes, uniques = pd.factorize(values.astype(object))
+    mapped = np.array([func(value) for value in uniques] + [func(None)], dtype=object)
+    # Missing values have code -1, the last entry
+    return mapped[codes]
+
+
+def student_keys(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    """
+    Return a pull_info student table's report columns and match keys, for find_duplicates.
+
+    Row is each student's position in df, and File is source. The tables of
+    several files are combined with pd.concat(..., ignore_index=True).
+    """
+    columns: Dict[str, np.ndarray] = {"File": np.full(len(df), source, dtype=object), "Row": np.arange(len(df))}
+    for column in KEY_COLUMNS:
+        if column == "BirthDate":
+            columns[column] = pd.to_datetime(df[column], errors="coerce").to_numpy()
+        elif column in df:
+            columns[column] = df[column].to_numpy(dtype=object)
+        else:
+            columns[column] = np.full(len(df), None, dtype=object)
+    columns["oen_key"] = oen_keys(df["OEN"])
+    columns["last_key"] = _map_distinct(df["LastName"], name_key)
+    columns["first_key"] = _map_distinct(df["FirstName"], name_key)
+    columns["alias_key"] = _map_distinct(df["AliasFirstName"], name_key)
+    columns["postal_key"] = _map_distinct(df["PostalCode"], postal_key)
+    columns["fsa"] = _map_distinct(df["PostalCode"], fsa_key)
+    # Object columns, so the keys are compared as Python strings without conversion
+    return pd.DataFrame({name: pd.Series(values, dtype=object) if values.dtype == object else values
+                         for name, values in columns.items()})
+
+
+def _pairs_within(keys: pd.DataFrame, on: List[str], max_block: int) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Return the positions of every two students sharing all the keys in on, none of them blank.
+
+    Also returns the number of keys held by more than max_block students,
+    whose students are not paired.
+    """
+    frame = keys[on].copy()
+    frame["pos"] = np.arange(len(keys))
+    valid = np.ones(len(frame), dtype=bool)
+    for column in on:
+        valid &= (frame[column].notna() if column == "BirthDate" else frame[column] != "").to_numpy()
+    frame = frame[valid]
+    sizes = frame.groupby(on, sort=False)["pos"].transform("size")
+    skipped = len(frame.loc[sizes > max_block, on].drop_duplicates())
+    frame = frame[(sizes > 1) & (sizes <= max_block)]
+    joined = frame.merge(frame, on=on, suffixes=("_a", "_b"))
+    joined = joined[joined["pos_a"] < joined["pos_b"]]
+    return joined["pos_a"].to_numpy(), joined["pos_b"].to_numpy(), skipped
+
+
+def _first_name_similarities(keys: pd.DataFrame, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Return the best first_name_similarity between the first and alias first names of each pair."""
+    best = np.zeros(len(left))
+    if not len(left):
+        return best
+    codes, names = pd.factorize(np.concatenate([keys["first_key"].to_numpy(dtype=object),
+                                                keys["alias_key"].to_numpy(dtype=object)]))
+    first, alias = codes[:len(keys)].astype(np.int64), codes[len(keys):].astype(np.int64)
+    for a in (first[left], alias[left]):
+        for b in (first[right], alias[right]):
+            # Each distinct pair of names is compared once
+            pairs, inverse = np.unique(a * len(names) + b, return_inverse=True)
+            similarities = np.array([first_name_similarity(names[pair // len(names)], names[pair % len(names)])
+                                     for pair in pairs.tolist()])
+            best = np.maximum(best, similarities[inverse])
+    return best
+
+
+def _link(left: np.ndarray, right: np.ndarray) -> Dict[int, int]:
+    """Return a group number for each position in a pair, numbered in order of each group's first position."""
+    parent: Dict[int, int] = {}
+
+    def find(pos: int) -> int:
+        root = pos
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while pos != root:
+            parent[pos], pos = root, parent.get(pos, pos)
+        return root
+
+    for a, b in zip(left.tolist(), right.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    numbers: Dict[int, int] = {}
+    groups = {}
+    for pos in sorted(set(left.tolist()) | set(right.tolist())):
+        groups[pos] = numbers.setdefault(find(pos), len(numbers) + 1)
+    return groups
+
+
+@dataclass
+class Duplicates:
+    """Scored duplicate pairs among the students of a student_keys() table."""
+    keys: pd.DataFrame
+    # Positions in keys of the two students, and the pair's score, match and group
+    pairs: pd.DataFrame
+    # Keys held by more than max_block students, which were not paired
+    skipped_blocks: int = 0
+
+    def scopes(self) -> np.ndarray:
+        """Whether each pair is in two files, two schools of one file, or the same school."""
+        left, right = self.pairs["left"].to_numpy(), self.pairs["right"].to_numpy()
+        files, schools = self.keys["File"].to_numpy(), self.keys["SchoolNumber"].to_numpy()
+        return np.where(files[left] != files[right], "cross-file",
+                        np.where(schools[left] != schools[right], "cross-school", "same school"))
+
+    def scope_counts(self) -> pd.Series:
+        return pd.Series(self.scopes(), dtype=object).value_counts()
+
+    def report(self) -> pd.DataFrame:
+        """One row per pair: group, score, match, scope, then each student's REPORT_COLUMNS."""
+        pairs = self.pairs
+        a = self.keys.iloc[pairs["left"].to_numpy()].reset_index(drop=True)
+        b = self.keys.iloc[pairs["right"].to_numpy()].reset_index(drop=True)
+        report = pd.DataFrame({
+            "DuplicateGroup": pairs["group"].to_numpy(),
+            "Score": pairs["score"].round(3).to_numpy(),
+            "Match": pairs["match"].to_numpy(),
+            "Scope": self.scopes(),
+        })
+        for prefix, side in (("A_", a), ("B_", b)):
+            for column in REPORT_COLUMNS:
+                values = side[column]
+                if column == "BirthDate":
+                    values = values.dt.strftime("%Y-%m-%d")
+                report[prefix + column] = values.to_numpy()
+        return report.sort_values(["DuplicateGroup", "Score"], ascending=[True, False], kind="stable",
+                                  ignore_index=True)
+
+    def annotate(self, df: pd.DataFrame, source: str) -> pd.DataFrame:
+        """
+        Return df with each student's DuplicateGroup and best pair DuplicateScore.
+
+        df is the student table given to student_keys() as source; students
+        in no pair get missing values.
+        """
+        sides = pd.concat([
+            pd.DataFrame({"pos": self.pairs[side], "group": self.pairs["group"], "score": self.pairs["score"]})
+            for side in ("left", "right")
+        ])
+        best = sides.groupby("pos").agg(group=("group", "first"), score=("score", "max"))
+        in_source = self.keys.iloc[best.index.to_numpy()]
+        best = best[(in_source["File"] == source).to_numpy()]
+        rows = self.keys["Row"].to_numpy()[best.index.to_numpy()]
+        group = pd.array([pd.NA] * len(df), dtype="Int64")
+        score = np.full(len(df), np.nan)
+        group[rows] = best["group"].to_numpy()
+        score[rows] = best["score"].round(3).to_numpy()
+        df = df.copy()
+        df["DuplicateGroup"] = group
+        df["DuplicateScore"] = score
+        return df
+
+
+def find_duplicates(keys: pd.DataFrame, min_score: float = DEFAULT_MIN_SCORE,
+                    max_block: int = DEFAULT_MAX_BLOCK) -> Duplicates:
+    """Pair the students of a student_keys() table that share an OEN or a block, score and group them."""
+    oen = keys["oen_key"].to_numpy()
+    birth = keys["BirthDate"].to_numpy()
+    last = keys["last_key"].to_numpy()
+    postal = keys["postal_key"].to_numpy()
+
+    oen_a, oen_b, skipped_oen = _pairs_within(keys, ["oen_key"], max_block)
+    oen_score = (0.4 + 0.2 * (birth[oen_a] == birth[oen_b]) + 0.2 * ((last[oen_a] == last[oen_b]) & (last[oen_a] != ""))
+                 + 0.2 * _first_name_similarities(keys, oen_a, oen_b))
+
+    block_a, block_b, skipped_block = _pairs_within(keys, BLOCK_KEYS, max_block)
+    # Pairs sharing an OEN are scored as OEN pairs
+    shared_oen = (oen[block_a] == oen[block_b]) & (oen[block_a] != "")
+    block_a, block_b = block_a[~shared_oen], block_b[~shared_oen]
+    similarity = _first_name_similarities(keys, block_a, block_b)
+    different_oens = (oen[block_a] != "") & (oen[block_b] != "")
+    block_score = (0.6 + 0.3 * similarity + 0.1 * (postal[block_a] == postal[block_b])) * np.where(
+        different_oens, 0.8, 1.0)
+    kept = (similarity >= MIN_FIRST_NAME_SIMILARITY) & (block_score >= min_score)
+
+    pairs = pd.DataFrame({
+        "left": np.concatenate([oen_a, block_a[kept]]),
+        "right": np.concatenate([oen_b, block_b[kept]]),
+        "score": np.concatenate([oen_score, block_score[kept]]),
+        "match": [OEN_MATCH] * len(oen_a) + [BLOCK_MATCH] * int(kept.sum()),
+    })
+    groups = _link(pairs["left"].to_numpy(), pairs["right"].to_numpy())
+    pairs["group"] = pairs["left"].map(groups).astype("int64")
+    skipped = skipped_oen + skipped_block
+    if skipped:
+        logger.warning("Skipped %d OENs or name blocks held by more than %d students each.", skipped, max_block)
+    return Duplicates(keys, pairs, skipped)
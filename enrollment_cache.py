@@ -0,0 +1,143 @@
+"""
+Content-addressed cache of parsed enrollment tables for pull_info.
+
+A table is stored as an uncompressed Feather (Arrow IPC) file named after
+the blake2b digest of the input XML and the parser version, so the same
+upload is only ever parsed once however it is named or moved, and a parser
+change invalidates every entry. Uncompressed Feather files are
+memory-mapped on load. The cache directory is kept under a size limit by
+evicting the least recently used tables.
+
+Digests are remembered per path, size and modification time in digests.json
+so unchanged inputs are not re-hashed on every run.
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import pandas as pd
+
+logger = logging.getLogger("pull_info.enrollment_cache")
+
+DEFAULT_CACHE_DIRNAME = ".pull_info_cache"
+DEFAULT_MAX_CACHE_MB = 2048
+_DIGEST_FILE = "digests.json"
+_CHUNK = 1 << 20
+
+
+def file_digest(path: Path) -> str:
+    """Return the hex blake2b digest of a file's contents."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class EnrollmentCache:
+    """Directory of cached student tables keyed by input digest and parser version."""
+
+    def __init__(self, directory: Path, parser_version: str,
+                 max_bytes: Optional[int] = DEFAULT_MAX_CACHE_MB << 20) -> None:
+        self.directory = directory
+        self.parser_version = parser_version
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def available() -> bool:
+        """Return True if pyarrow, which reads and writes the cache files, is installed."""
+        try:
+            import pyarrow.feather  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def key(self, source: Path) -> str:
+        """Return the cache key of an input file, re-hashing it only if it changed since last seen."""
+        stat = source.stat()
+        known = self._load_digests()
+        name = str(source.resolve())
+        entry = known.get(name)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            digest = entry[2]
+        else:
+            digest = file_digest(source)
+            known[name] = [stat.st_size, stat.st_mtime_ns, digest]
+            self._save_digests(known)
+        return f"{digest}-v{self.parser_version}"
+
+    def path_for(self, key: str) -> Path:
+        return self.directory / f"{key}.feather"
+
+    def load(self, key: str) -> Optional[pd.DataFrame]:
+        """Return the cached table for a key, or None on a miss."""
+        from pyarrow import feather
+
+        path = self.path_for(key)
+        if not path.exists():
+            return None
+        try:
+            table = feather.read_table(path, memory_map=True)
+        except Exception as exc:
+            logger.warning("Discarding unreadable cache entry %s: %s", path.name, exc)
+            path.unlink(missing_ok=True)
+            return None
+        # Touch the entry so eviction sees it as recently used
+        os.utime(path)
+        df = table.to_pandas()
+        # Arrow reads category labels back as str; keep the object labels the parser built
+        for column in df.select_dtypes("category"):
+            categories = df[column].cat.categories
+            df[column] = pd.Categorical.from_codes(df[column].cat.codes, categories=pd.Index(categories, dtype=object))
+        return df
+
+    def store(self, key: str, df: pd.DataFrame) -> None:
+        """Write a table to the cache, then evict old entries over the size limit."""
+        from pyarrow import feather
+
+        path = self.path_for(key)
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        feather.write_feather(df, tmp, compression="uncompressed")
+        # Atomic so concurrent runs never read a half-written entry
+        os.replace(tmp, path)
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[Path] = None) -> int:
+        """Remove least recently used entries until the cache fits max_bytes. Returns the number removed."""
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(
+            ((p.stat().st_mtime, p.stat().st_size, p) for p in self.directory.glob("*.feather")),
+            key=lambda entry: entry[0],
+        )
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info("Evicted %d cached tables from %s", removed, self.directory)
+        return removed
+
+    def _load_digests(self) -> Dict[str, list]:
+        try:
+            with open(self.directory / _DIGEST_FILE, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_digests(self, known: Dict[str, list]) -> None:
+        path = self.directory / _DIGEST_FILE
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(known, f)
+        os.replace(tmp, path)
@@ -1,50 +1,210 @@
-import xml.etree.ElementTree as ET
-import sys
-import xmltodict
+#!/usr/bin/env python3
+"""
+Extract whole schools from a STIX file by byte range.
+
+One pass over the file's bytes records each ns1:School's byte range,
+SchoolNumber, Name and student count in a sidecar index
+({file}.schools.json). The index is reused until the file's size or
+modification time changes. Extraction seeks to the selected schools and
+copies their bytes under the file's original header (XML declaration, root
+element and ns1:Metadata) without parsing any XML.
+"""
+import argparse
+import json
 import logging
+import mmap
+import re
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List, Sequence, Tuple
+from xml.sax.saxutils import unescape
+
+from xml_input import REPAIR_ERRORS, SNIFF_BYTES, sniff
+
+logger = logging.getLogger("extract_schools")
+logger.setLevel(logging.INFO)
+
+INDEX_SUFFIX = ".schools.json"
+# Bump whenever the index layout or scan changes, to invalidate saved indexes
+INDEX_VERSION = 2
+
+_ROOT_TAG = re.compile(rb"<(?![?!])([^\s>/]+)[^>]*>")
+
+
+@dataclass
+class SchoolEntry:
+    """One ns1:School; start includes the whitespace that precedes it in the file."""
+    number: str
+    name: str
+    students: int
+    start: int
+    end: int
+
+
+@dataclass
+class SchoolIndex:
+    """Byte layout of a STIX file's schools, tied to the file's size and modification time."""
+    size: int
+    mtime_ns: int
+    # Encoding the file is actually in, whatever it declares
+    encoding: str
+    header_end: int
+    footer_start: int
+    schools: List[SchoolEntry]
+
+    def find(self, numbers: Sequence[str]) -> Tuple[List[SchoolEntry], List[str]]:
+        """Return the schools with the given numbers in document order, and the numbers not found."""
+        wanted = set(numbers)
+        found = [school for school in self.schools if school.number in wanted]
+        present = {school.number for school in found}
+        return found, [number for number in dict.fromkeys(numbers) if number not in present]
+
+
+def index_path(path: Path) -> Path:
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def build_index(path: Path) -> SchoolIndex:
+    """
+    Scan a STIX file's bytes for ns1:School elements.
+
+    SchoolNumber and Name are read from each school's content before its
+    ns1:Students element. Tags inside comments or CDATA are not recognised.
+    """
+    stat = path.stat()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        sniffed = sniff(mm[:SNIFF_BYTES])
+        encoding = sniffed.encoding
+        # Names in a mixed file are UTF-8 or windows-1252 value by value
+        errors = REPAIR_ERRORS if sniffed.mixed else "replace"
+        root_match = _ROOT_TAG.search(mm)
+        root_qname = root_match.group(1)
+        content_end = mm.rfind(b"</" + root_qname)
+        prefix = root_qname.rpartition(b":")[0]
+
+        def qname(localname: bytes) -> bytes:
+            return prefix + b":" + localname if prefix else localname
+
+        school_tag = re.compile(rb"<(/?)" + re.escape(qname(b"School")) + rb"\b[^>]*?(/?)>")
+        students_tag = re.compile(rb"<" + re.escape(qname(b"Students")) + rb"\b")
+        student_tag = re.compile(rb"<" + re.escape(qname(b"Student")) + rb"[\s/>]")
+        number_tag = re.compile(rb"<" + re.escape(qname(b"SchoolNumber")) + rb">([^<]*)<")
+        name_tag = re.compile(rb"<" + re.escape(qname(b"Name")) + rb">([^<]*)<")
+
+        def text(pattern: re.Pattern, start: int, end: int) -> str:
+            match = pattern.search(mm, start, end)
+            return unescape(match.group(1).decode(encoding, errors=errors).strip()) if match else ""
+
+        schools: List[SchoolEntry] = []
+        previous_end = root_match.end()
+        school_start = None
+        for match in school_tag.finditer(mm, root_match.end(), content_end):
+            if not match.group(1) and not match.group(2):
+                school_start = match.start()
+                continue
+            start = match.start() if match.group(2) else school_start
+            end = match.end()
+            students = students_tag.search(mm, start, end)
+            header_end = students.start() if students else end
+            gap = mm[previous_end:start]
+            # Keep the school's indentation with it rather than with the previous school
+            lead = start - (len(gap) - len(gap.rstrip()))
+            schools.append(SchoolEntry(
+                number=text(number_tag, start, header_end),
+                name=text(name_tag, start, header_end),
+                students=sum(1 for _ in student_tag.finditer(mm, header_end, end)),
+                start=lead,
+                end=end,
+            ))
+            previous_end = end
+
+    header_end = schools[0].start if schools else content_end
+    footer_start = schools[-1].end if schools else content_end
+    return SchoolIndex(stat.st_size, stat.st_mtime_ns, encoding, header_end, footer_start, schools)
+
 
-path = sys.argv[1]
-school_number = sys.argv[2]  # School number to extract
-logfile = path.replace('.xml','.log')
+def load_index(path: Path, rebuild: bool = False) -> SchoolIndex:
+    """Return the file's saved index if it is still current, otherwise build and save a new one."""
+    sidecar = index_path(path)
+    stat = path.stat()
+    if not rebuild and sidecar.exists():
+        try:
+            with open(sidecar, encoding="utf-8") as f:
+                data = json.load(f)
+            if (data.get("version") == INDEX_VERSION and data["size"] == stat.st_size
+                    and data["mtime_ns"] == stat.st_mtime_ns):
+                schools = [SchoolEntry(**school) for school in data.pop("schools")]
+                del data["version"]
+                return SchoolIndex(schools=schools, **data)
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            logger.warning(f"Ignoring unreadable school index {sidecar}: {exc}")
 
-tree = ET.parse(path)
-root = tree.getroot()
+    logger.info(f"Indexing schools in {path}")
+    index = build_index(path)
+    with open(sidecar, "w", encoding="utf-8") as f:
+        json.dump({"version": INDEX_VERSION, **asdict(index)}, f)
+    logger.info(f"Indexed {len(index.schools)} schools to {sidecar}")
+    return index
 
-with open(path, 'r', encoding='utf-8') as file:
-    dict_data = xmltodict.parse(file.read())
 
-logging.basicConfig(level=logging.INFO, filename=logfile, filemode='w',)
+def extract(path: Path, index: SchoolIndex, schools: Sequence[SchoolEntry], out: Path) -> None:
+    """Write the schools in list order, as find() gives them in document order, under the source file's header and closing root tag."""
+    with open(path, "rb") as src, open(out, "wb") as dst:
+        dst.write(src.read(index.header_end))
+        for school in schools:
+            src.seek(school.start)
+            dst.write(src.read(school.end - school.start))
+        src.seek(index.footer_start)
+        dst.write(src.read())
 
-# start logging file
-logging.info(f"Processing file: {path}")
 
-# Get keys at the second level
-records = dict_data['ns1:SchoolUpload']['ns1:School']
+def main() -> int:
+    p = argparse.ArgumentParser(description="Extract schools from a STIX XML file by SchoolNumber.")
+    p.add_argument("path", type=Path, help="STIX XML file")
+    p.add_argument("numbers", nargs="*", help="SchoolNumbers to extract")
+    p.add_argument("--output", "-o", type=Path,
+                   help="Output file (default: {file}_SCHOOLS.xml), or directory with --split")
+    p.add_argument("--split", action="store_true", help="Write each school to its own {file}_{number}.xml")
+    p.add_argument("--list", action="store_true", help="List the schools in the file and exit")
+    p.add_argument("--rebuild-index", action="store_true", help="Re-scan the file even if its index is current")
+    args = p.parse_intermixed_args()
 
-student_list = []
-counter = 0
-ns = {"ns1": "http://ontario.ca"}
+    path = args.path
+    fh = logging.FileHandler(path.with_name(path.stem + "_extract.log"), mode="w", encoding="utf-8")
+    logger.addHandler(fh)
+    logger.addHandler(logging.StreamHandler())
+    logger.info(f"Processing file: {path}")
 
-logging.info(f"Total number of schools in the file: {len(records)}")
-logging.info(f"Extracting school with number: {school_number}")
+    index = load_index(path, rebuild=args.rebuild_index)
+    logger.info(f"Total number of schools in the file: {len(index.schools)}")
+    if args.list:
+        for school in index.schools:
+            print(f"{school.number}\t{school.students}\t{school.name}")
+        return 0
+    if not args.numbers:
+        p.error("give at least one SchoolNumber, or --list")
 
-for school in root.findall(".//ns1:School", ns):
-    school_record = school.find("ns1:SchoolNumber", ns)
-    if school_record is not None and school_record.text == school_number: 
-        logging.info(f"Found and removing school with number: {school_number}")
-        
+    schools, missing = index.find(args.numbers)
+    for number in missing:
+        logger.warning(f"School with number {number} is not in the file")
+    if not schools:
+        return 1
 
-logging.info(f"Total number of schools after removal: {len(root.findall('.//ns1:School', ns))}")
-# Check to make sure the schools were removed
-# for school in root.findall(".//ns1:School", ns):
-#     school_number = school.find("ns1:SchoolNumber", ns)
-#     if school_number is not None and school_number.text in remove_school_numbers:
-#         logging.info(f"School with number {school_number.text} was not removed.")
-#     else:
-#         logging.info(f"School with number {school_number.text} is present.")
+    if args.split:
+        out_dir = args.output or path.parent
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for school in schools:
+            out = out_dir / f"{path.stem}_{school.number}.xml"
+            extract(path, index, [school], out)
+            logger.info(f"Extracted school {school.number} ({school.name}, {school.students} students) to {out}")
+    else:
+        out = args.output or path.with_name(path.stem + "_SCHOOLS.xml")
+        extract(path, index, schools, out)
+        for school in schools:
+            logger.info(f"Extracted school {school.number} ({school.name}, {school.students} students)")
+        logger.info(f"Extracted XML file written to: {out}")
+    return 0
 
 
-# Write the modified XML back to a file
-output_path = path.replace('.xml','_cleaned.xml')
-tree.write(output_path, encoding='utf-8', xml_declaration=True)
-logging.info(f"Cleaned XML file written to: {output_path}")
\ No newline at end of file
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic STIX ns1:SchoolUpload files for testing and benchmarking.
+
+Real enrollment files cannot leave the secure environment, so this writes
+look-alike uploads: the same elements in the same order, plausible names,
+grades, birth dates and addresses, and a configurable share of the dirty
+values the cleaning rules exist for (bad phone numbers, long units and
+street numbers, malformed postal codes, schools with no students and
+students enrolled twice).
+
+Output is deterministic for a given configuration and seed, and is written
+one school at a time so files with millions of students need little memory.
+"""
+import argparse
+import math
+import random
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, TextIO
+from xml.sax.saxutils import escape
+
+ENCODINGS = ("windows-1252", "utf-8")
+
+# Names include accented letters so the declared encoding matters
+FIRST_NAMES = ["Olivia", "Liam", "Zoë", "Noah", "Chloé", "Lucas", "Amélie", "Ethan", "Maya", "François",
+               "Aiden", "Léa", "Owen", "Sofia", "Mateo", "Nora", "Benoît", "Ava", "Jaxon", "Hélène"]
+LAST_NAMES = ["Smith", "Tremblay", "Martin", "Roy", "Wilson", "Gagnon", "MacDonald", "Côté", "Brown", "Lee",
+              "Bouchard", "Taylor", "Singh", "Gauthier", "Morin", "Campbell", "Lévesque", "Anderson", "Nguyen", "Patel"]
+STREET_NAMES = ["King", "Queen", "Main", "Church", "Victoria", "Wellington", "Elm", "Maple", "Park", "Water"]
+STREET_TYPES = ["ST", "AVE", "RD", "DR", "CRES", "CRT", "BLVD"]
+LANGUAGES = ["English", "French", "Arabic", "Punjabi", "Mandarin", "Spanish"]
+# (FSA, city) pairs that agree with each other, so only the injected values fail region checks
+PLACES = [("K6V", "Brockville"), ("K6H", "Cornwall"), ("K7A", "Smiths Falls"), ("K0G", "Kemptville"),
+          ("K7C", "Carleton Place"), ("K6A", "Hawkesbury"), ("K0E", "Prescott"), ("K7H", "Perth")]
+# Grade and its age at the start of the school year
+GRADES = [("JK", 4), ("SK", 5)] + [(f"GR{n}", n + 5) for n in range(1, 9)]
+
+BAD_PHONES = ["555-1234", "1-613-555-0199 x123", "163-555-0000", "000-000-0000", "613555012", "Call mother"]
+LONG_UNITS = ["basement", "lower un", "upperlev", "(1203)", "unit 12", "unit 7b", "rear house"]
+LONG_STREET_NUMBERS = ["1234567", "12-14 REAR", "RR 2 LOT 4"]
+# Earlier students kept for --duplicate-rate to enrol again
+DUPLICATE_POOL = 10000
+BAD_POSTAL_CODES = ["k6v5t2", "K6V5T2", "KGV 5T2", "K6V 5TZ", "12345", "D6V 5T2", "K6V"]
+
+
+@dataclass
+class GeneratorConfig:
+    """What to generate. Rates are the share of students (or schools) given each kind of dirty value."""
+    students: int = 1000
+    students_per_school: int = 250
+    seed: int = 0
+    encoding: str = "windows-1252"
+    bad_phone_rate: float = 0.05
+    long_unit_rate: float = 0.03
+    long_street_number_rate: float = 0.01
+    bad_postal_rate: float = 0.04
+    empty_school_rate: float = 0.02
+    # Students enrolled again later in the file, half of them under a new OEN
+    duplicate_rate: float = 0.0
+    # OEN of the first student, so files for one board can be given distinct OENs
+    first_oen: int = 100000000
+    # Write the whole document on one line, as some raw exports arrive
+    one_line: bool = False
+    board_number: str = "67130"
+    board_name: str = "Upper Canada District School Board"
+    create_date: str = "2025-10-07"
+    school_year: int = 2025
+
+
+@dataclass
+class GenerationSummary:
+    """Counts of what a generated file contains."""
+    students: int = 0
+    schools: int = 0
+    empty_schools: int = 0
+    dirty: Counter = field(default_factory=Counter)
+
+
+class _Writer:
+    """Writes elements indented one per line, or all on one line."""
+
+    def __init__(self, out: TextIO, one_line: bool) -> None:
+        self.out = out
+        self.one_line = one_line
+
+    def line(self, depth: int, text: str) -> None:
+        self.out.write(text if self.one_line else "  " * depth + text + "\n")
+
+
+def _element(tag: str, value: Optional[str]) -> str:
+    return f"<ns1:{tag}>{escape(value)}</ns1:{tag}>" if value else ""
+
+
+def _postal_code(rng: random.Random, fsa: str) -> str:
+    return f"{fsa} {rng.randint(0, 9)}{rng.choice('ABCEGHJKLMNPRSTVWXYZ')}{rng.randint(0, 9)}"
+
+
+def _phone(rng: random.Random) -> str:
+    return rng.choice(["({0}) {1}-{2}", "{0}-{1}-{2}", "{0}{1}{2}", "{0}.{1}.{2}"]).format(
+        rng.choice(["613", "343"]), rng.randint(200, 999), f"{rng.randint(0, 9999):04d}")
+
+
+def _student(rng: random.Random, config: GeneratorConfig, oen: int, summary: GenerationSummary) -> List[str]:
+    """Return a ns1:Student's child elements in upload order."""
+    dirty = summary.dirty
+    grade, age = rng.choice(GRADES)
+    # Born in the calendar year the student turns `age`, or the year before
+    birth_year = config.school_year - age - (1 if rng.random() < 0.25 else 0)
+    fsa, city = rng.choice(PLACES)
+
+    unit = None
+    if rng.random() < config.long_unit_rate:
+        unit = rng.choice(LONG_UNITS)
+        dirty["long_unit"] += 1
+    elif rng.random() < 0.1:
+        unit = str(rng.randint(1, 1200))
+    street_number = str(rng.randint(1, 9999))
+    if rng.random() < config.long_street_number_rate:
+        street_number = rng.choice(LONG_STREET_NUMBERS)
+        dirty["long_street_number"] += 1
+    postal_code = _postal_code(rng, fsa)
+    if rng.random() < config.bad_postal_rate:
+        postal_code = rng.choice(BAD_POSTAL_CODES)
+        dirty["bad_postal_code"] += 1
+    phone = _phone(rng)
+    if rng.random() < config.bad_phone_rate:
+        phone = rng.choice(BAD_PHONES)
+        dirty["bad_phone"] += 1
+
+    name = _element("First", rng.choice(FIRST_NAMES))
+    if rng.random() < 0.3:
+        name += _element("Middle", rng.choice(FIRST_NAMES))
+    name += _element("Last", rng.choice(LAST_NAMES))
+    address = "".join([
+        _element("Unit", unit),
+        _element("StreetNumber", street_number),
+        _element("StreetName", rng.choice(STREET_NAMES)),
+        _element("StreetType", rng.choice(STREET_TYPES)),
+        _element("City", city),
+        _element("Province", "ON"),
+        _element("PostalCode", postal_code),
+    ])
+    return [
+        _element("OEN", f"{oen:09d}"),
+        f"<ns1:Name>{name}</ns1:Name>",
+        _element("BirthDate", f"{birth_year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"),
+        _element("Gender", rng.choice("FM")),
+        _element("Grade", grade),
+        _element("Language", rng.choice(LANGUAGES)),
+        f"<ns1:Address>{address}</ns1:Address>",
+        _element("Phone", phone),
+    ]
+
+
+def generate(out: TextIO, config: GeneratorConfig) -> GenerationSummary:
+    """Write a STIX upload to out, which must be opened with config.encoding. Returns what was written."""
+    rng = random.Random(config.seed)
+    summary = GenerationSummary()
+    writer = _Writer(out, config.one_line)
+    out.write(f'<?xml version="1.0" encoding="{config.encoding}"?>\n')
+    writer.line(0, '<ns1:SchoolUpload xmlns:ns1="http://ontario.ca">')
+    writer.line(1, "<ns1:Metadata>" + "".join([
+        _element("CreateDate", config.create_date),
+        _element("CreateTime", "09:30:00"),
+        _element("CreatedBy", "Student Information System"),
+        _element("ContactNumber", "6135550100"),
+        _element("ContactEmail", "stix@example.ca"),
+        _element("FullUpload", "true"),
+        "<ns1:SchoolBoard>" + _element("BoardNumber", config.board_number)
+        + _element("Name", config.board_name) + "</ns1:SchoolBoard>",
+    ]) + "</ns1:Metadata>")
+
+    school_count = math.ceil(config.students / config.students_per_school) if config.students else 0
+    empty_count = round(school_count * config.empty_school_rate)
+    # Spread the empty schools through the file rather than bunching them at one end
+    empty_at = set(rng.sample(range(school_count + empty_count), empty_count))
+    remaining = config.students
+    # Students that later ones may duplicate; bounded so large files need little memory
+    enrolled: List[List[str]] = []
+    for number in range(school_count + empty_count):
+        school_number = f"{100000 + number * 37 % 900000:06d}"
+        writer.line(1, "<ns1:School>")
+        writer.line(2, _element("SchoolNumber", school_number) + _element("Name", f"School {number} Public School"))
+        summary.schools += 1
+        if number in empty_at:
+            writer.line(2, "<ns1:Students/>")
+            summary.empty_schools += 1
+        else:
+            writer.line(2, "<ns1:Students>")
+            for _ in range(min(config.students_per_school, remaining)):
+                oen = config.first_oen + summary.students
+                if config.duplicate_rate and enrolled and rng.random() < config.duplicate_rate:
+                    student = list(rng.choice(enrolled))
+                    if rng.random() < 0.5:
+                        student[0] = _element("OEN", f"{oen:09d}")
+                    summary.dirty["duplicate"] += 1
+                else:
+                    student = _student(rng, config, oen, summary)
+                    if config.duplicate_rate:
+                        if len(enrolled) < DUPLICATE_POOL:
+                            enrolled.append(student)
+                        else:
+                            enrolled[rng.randrange(DUPLICATE_POOL)] = student
+                writer.line(3, "<ns1:Student>" + "".join(student) + "</ns1:Student>")
+                summary.students += 1
+            remaining -= min(config.students_per_school, remaining)
+            writer.line(2, "</ns1:Students>")
+        writer.line(1, "</ns1:School>")
+    writer.line(0, "</ns1:SchoolUpload>")
+    if config.one_line:
+        out.write("\n")
+    return summary
+
+
+def generate_file(path: str, config: GeneratorConfig) -> GenerationSummary:
+    """Write a STIX upload to path in config.encoding."""
+    # Characters outside windows-1252 never occur in the generated values
+    with open(path, "w", encoding=config.encoding, newline="\n") as out:
+        return generate(out, config)
+
+
+def _rate(value: str) -> float:
+    rate = float(value)
+    if not 0 <= rate <= 1:
+        raise argparse.ArgumentTypeError("rate must be between 0 and 1")
+    return rate
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Generate a synthetic STIX enrollment upload.")
+    p.add_argument("path", help="Output XML file")
+    p.add_argument("--students", type=int, default=1000, help="Number of students (default: %(default)s)")
+    p.add_argument("--students-per-school", type=int, default=250, help="Students in each non-empty school")
+    p.add_argument("--seed", type=int, default=0, help="Random seed; the same seed gives the same file")
+    p.add_argument("--encoding", choices=ENCODINGS, default="windows-1252")
+    p.add_argument("--bad-phone-rate", type=_rate, default=GeneratorConfig.bad_phone_rate)
+    p.add_argument("--long-unit-rate", type=_rate, default=GeneratorConfig.long_unit_rate)
+    p.add_argument("--long-street-number-rate", type=_rate, default=GeneratorConfig.long_street_number_rate)
+    p.add_argument("--bad-postal-rate", type=_rate, default=GeneratorConfig.bad_postal_rate)
+    p.add_argument("--empty-school-rate", type=_rate, default=GeneratorConfig.empty_school_rate,
+                   help="Empty schools to add, as a share of the schools with students")
+    p.add_argument("--duplicate-rate", type=_rate, default=GeneratorConfig.duplicate_rate,
+                   help="Students enrolled again in a later school, half of them under a new OEN")
+    p.add_argument("--first-oen", type=int, default=GeneratorConfig.first_oen,
+                   help="OEN of the first student; give each file of one board its own range")
+    p.add_argument("--one-line", action="store_true", help="Write the document on a single line")
+    args = p.parse_args()
+
+    config = GeneratorConfig(
+        students=args.students, students_per_school=args.students_per_school, seed=args.seed,
+        encoding=args.encoding, bad_phone_rate=args.bad_phone_rate, long_unit_rate=args.long_unit_rate,
+        long_street_number_rate=args.long_street_number_rate, bad_postal_rate=args.bad_postal_rate,
+        empty_school_rate=args.empty_school_rate, one_line=args.one_line,
+        duplicate_rate=args.duplicate_rate, first_oen=args.first_oen,
+    )
+    summary = generate_file(args.path, config)
+    dirty: Dict[str, int] = dict(sorted(summary.dirty.items()))
+    print(f"Wrote {summary.students} students in {summary.schools} schools "
+          f"({summary.empty_schools} empty) to {args.path}; dirty values: {dirty}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
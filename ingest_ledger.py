@@ -0,0 +1,144 @@
+"""
+Ledger of the files taken in by watch_folder, keyed by a digest of their contents.
+
+A file is claimed before any work is done on it and marked done once its
+outputs are written, so contents already processed are recognised and
+skipped whatever name they are dropped under, and however often. A claim
+left behind by a daemon that stopped part way through a file is released
+by recover() when the daemon starts again, so the file is processed anew.
+A failed file can be claimed again by dropping it again.
+"""
+import hashlib
+import sqlite3
+import time
+from typing import NamedTuple, Optional
+
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+# Bytes read at a time when hashing a file
+_READ_BYTES = 1 << 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    -- SHA-256 of the file's contents, in hex
+    digest TEXT PRIMARY KEY,
+    -- The path the file was dropped as
+    source TEXT NOT NULL,
+    -- The standard-named path its outputs are written under, once known
+    target TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS files_target ON files (target);
+"""
+
+
+def file_digest(path: str) -> str:
+    """Return the SHA-256 of a file's contents in hex, as sha256sum prints it."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class LedgerEntry(NamedTuple):
+    digest: str
+    source: str
+    target: Optional[str]
+    status: str
+    error: Optional[str]
+
+
+class IngestLedger:
+    """
+    SQLite ledger of every file claimed, with its status.
+
+    Worker processes each open their own connection; every change is a
+    single statement committed at once, so claims made in parallel cannot
+    both succeed.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Every worker shares the ledger; wait for each other's writes to finish
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(_SCHEMA)
+
+    def entry(self, digest: str) -> Optional[LedgerEntry]:
+        row = self.conn.execute("SELECT digest, source, target, status, error FROM files WHERE digest = ?",
+                                (digest,)).fetchone()
+        return LedgerEntry(*row) if row is not None else None
+
+    def claim(self, digest: str, source: str) -> Optional[LedgerEntry]:
+        """
+        Claim a file's contents for processing.
+
+        Returns None once claimed, or the entry of the same contents already
+        done or being processed. Contents that failed before are claimed again.
+        """
+        cursor = self.conn.execute(
+            "INSERT INTO files (digest, source, status, started) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (digest) DO UPDATE SET source = excluded.source, target = NULL, status = excluded.status, "
+            "error = NULL, started = excluded.started, finished = NULL WHERE files.status = ?",
+            (digest, source, PROCESSING, time.time(), FAILED),
+        )
+        self.conn.commit()
+        return None if cursor.rowcount else self.entry(digest)
+
+    def set_target(self, digest: str, target: str) -> Optional[LedgerEntry]:
+        """
+        Record the path a claimed file's outputs will be written under.
+
+        Returns None, or the entry of another file whose outputs are already
+        there, or are being written there, in which case nothing is recorded.
+        """
+        cursor = self.conn.execute(
+            "UPDATE files SET target = ? WHERE digest = ? AND NOT EXISTS "
+            "(SELECT 1 FROM files WHERE target = ? AND digest != ? AND status != ?)",
+            (target, digest, target, digest, FAILED),
+        )
+        self.conn.commit()
+        if cursor.rowcount:
+            return None
+        row = self.conn.execute(
+            "SELECT digest, source, target, status, error FROM files WHERE target = ? AND digest != ? AND status != ?",
+            (target, digest, FAILED),
+        ).fetchone()
+        # The other file failed in the meantime, leaving the target free
+        return LedgerEntry(*row) if row is not None else self.set_target(digest, target)
+
+    def finish(self, digest: str) -> None:
+        self.conn.execute("UPDATE files SET status = ?, finished = ? WHERE digest = ?", (DONE, time.time(), digest))
+        self.conn.commit()
+
+    def fail(self, digest: str, error: str) -> None:
+        self.conn.execute("UPDATE files SET status = ?, error = ?, finished = ? WHERE digest = ?",
+                          (FAILED, error, time.time(), digest))
+        self.conn.commit()
+
+    def fail_source(self, source: str, error: str) -> int:
+        """Mark the file claimed from source failed if it is still being processed, and return how many were."""
+        cursor = self.conn.execute(
+            "UPDATE files SET status = ?, error = ?, finished = ? WHERE source = ? AND status = ?",
+            (FAILED, error, time.time(), source, PROCESSING),
+        )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def recover(self) -> int:
+        """
+        Release the claims of files left part way through, and return how many there were.
+
+        Only call this while no other process is using the ledger, before the
+        daemon starts taking files.
+        """
+        cursor = self.conn.execute("DELETE FROM files WHERE status = ?", (PROCESSING,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,151 @@
+"""
+Phone number normalisation, one value at a time or a whole batch at once.
+
+clean_phone handles a single value. clean_phones applies the same rules to
+a batch with vectorized pandas string operations, computing each distinct
+value only once, and returns exactly what clean_phone would for each input.
+The diagnose_ variants also return why each value was changed, without
+logging, for callers that record changes themselves.
+"""
+import csv
+import logging
+import re
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import FrozenSet, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("twig_stix.phones")
+
+DEFAULT_AREA_CODES = Path(__file__).parent / "data" / "invalid_area_codes.csv"
+
+# Below this many distinct values the per-value path is faster than pandas
+VECTORIZE_MIN = 256
+
+_NON_DIGITS = re.compile(r"\D")
+_PHONE_EXTENSION = re.compile(r'.*x\d{1,4}$')
+
+
+@lru_cache(maxsize=None)
+def load_invalid_area_codes(path: Path = DEFAULT_AREA_CODES) -> FrozenSet[str]:
+    """Load the set of invalid area codes from the area_code column of a CSV table."""
+    with open(path, newline="", encoding="utf-8") as f:
+        return frozenset(row["area_code"] for row in csv.DictReader(f))
+
+
+# Why a number was changed or emptied, and the warning clean_phone logs for it
+SHORT = "short"
+TRUNCATED = "truncated"
+EXTENSION = "extension"
+INVALID_AREA_CODE = "invalid_area_code"
+ALL_ZEROS = "all_zeros"
+REFORMATTED = "format"
+REASON_MESSAGES = {
+    SHORT: "Phone number '{}' has less than 10 digits. Setting to empty.",
+    TRUNCATED: "Phone number '{}' has more than 10 digits and no valid extension. Truncating to 10 digits.",
+    INVALID_AREA_CODE: "Phone number '{}' has invalid area code. Setting to empty.",
+    ALL_ZEROS: "Phone number '{}' is all zeros. Setting to empty.",
+}
+REASON_SUMMARIES = {
+    SHORT: "have less than 10 digits and were set to empty",
+    TRUNCATED: "have more than 10 digits and no valid extension and were truncated to 10 digits",
+    INVALID_AREA_CODE: "have an invalid area code and were set to empty",
+    ALL_ZEROS: "are all zeros and were set to empty",
+}
+
+
+def diagnose_phone(text: str) -> Tuple[str, str]:
+    """Return text cleaned as clean_phone would, and the reason for the result."""
+    digits = _NON_DIGITS.sub("", text)
+    if digits.startswith("1") and len(digits) > 10:
+        digits = digits[1:]
+
+    # then readd hyphenated format
+    if len(digits) < 10:
+        return "", SHORT
+
+    reason = REFORMATTED
+    if len(digits) > 10:
+        # Check for x and 3 digits after with regex
+        if not _PHONE_EXTENSION.match(text):
+            reason = TRUNCATED
+            digits = digits[:10]
+        else:
+            # Allow extensions
+            return digits[:3] + '-' + digits[3:6] + '-' + digits[6:10] + 'x' + digits[10:], EXTENSION
+    digits = digits[:3] + '-' + digits[3:6] + '-' + digits[6:10]
+
+    if digits[:3] in load_invalid_area_codes():
+        return "", INVALID_AREA_CODE
+
+    if digits == '519-000-0000':
+        return "", ALL_ZEROS
+
+    return digits, reason
+
+
+def clean_phone(text: str) -> str:
+    """Return text as a hyphenated 10-digit number (plus any extension), or "" if it cannot be cleaned."""
+    cleaned, reason = diagnose_phone(text)
+    if reason in REASON_MESSAGES:
+        logger.warning(REASON_MESSAGES[reason].format(text))
+    return cleaned
+
+
+def diagnose_phones(values: Sequence[str]) -> Tuple[List[str], List[str]]:
+    """
+    Clean a batch of phone numbers, returning the diagnose_phone result for each as two lists.
+
+    Values are factorized first so repeated numbers (e.g. siblings sharing a
+    household phone) are computed once.
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    if len(uniques) < VECTORIZE_MIN:
+        results = [diagnose_phone(text) for text in uniques]
+        cleaned = np.array([result[0] for result in results], dtype=object)
+        reasons = np.array([result[1] for result in results], dtype=object)
+        return cleaned[codes].tolist(), reasons[codes].tolist()
+
+    text = pd.Series(uniques, dtype=object)
+    digits = text.str.replace(r"\D", "", regex=True)
+    strip_one = digits.str.startswith("1") & (digits.str.len() > 10)
+    digits = digits.where(~strip_one, digits.str[1:])
+    length = digits.str.len()
+
+    short = length < 10
+    has_extension = text.str.match(r'.*x\d{1,4}$')
+    extension = (length > 10) & has_extension
+    truncated = (length > 10) & ~has_extension
+    formatted = digits.str[:3] + '-' + digits.str[3:6] + '-' + digits.str[6:10]
+
+    # Numbers kept with an extension skip the area code and all-zeros checks
+    checked = ~short & ~extension
+    bad_area = checked & digits.str[:3].isin(load_invalid_area_codes())
+    zeros = checked & ~bad_area & (formatted == '519-000-0000')
+
+    cleaned = formatted.where(~extension, formatted + 'x' + digits.str[10:])
+    cleaned = cleaned.where(~(short | bad_area | zeros), "")
+
+    reasons = np.full(len(text), REFORMATTED, dtype=object)
+    for mask, reason in ((truncated, TRUNCATED), (extension, EXTENSION), (short, SHORT),
+                         (bad_area, INVALID_AREA_CODE), (zeros, ALL_ZEROS)):
+        reasons[mask.to_numpy()] = reason
+
+    return cleaned.to_numpy(dtype=object)[codes].tolist(), reasons[codes].tolist()
+
+
+def clean_phones(values: Sequence[str]) -> List[str]:
+    """
+    Clean a batch of phone numbers, returning the clean_phone result for each.
+
+    Instead of a warning per number, one warning per reason gives how many
+    distinct numbers it applied to.
+    """
+    cleaned, reasons = diagnose_phones(values)
+    counts = Counter(reason for _, reason in set(zip(values, reasons)) if reason in REASON_SUMMARIES)
+    for reason, count in sorted(counts.items()):
+        logger.warning(f"{count} distinct phone numbers {REASON_SUMMARIES[reason]}.")
+    return cleaned
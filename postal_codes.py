@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Batch validation and normalisation of Canadian postal codes.
+
+Codes are uppercased, their spacing fixed and O/0, I/1 swaps in digit
+positions repaired. Each forward sortation area (FSA, the first three
+characters) is checked against a precomputed FSA -> province/city index.
+The index is a NumPy structured array built once from a CSV with
+`python postal_codes.py build-index` and memory-mapped on load; an FSA
+covering several municipalities has a row for each. Without an index, the
+province is derived from the first letter of the code.
+"""
+import argparse
+import csv
+import logging
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("twig_stix.postal_codes")
+
+DEFAULT_FSA_INDEX = Path(__file__).parent / "data" / "fsa_index.npy"
+
+# Letters D, F, I, O, Q and U never appear; W and Z never start a code
+POSTAL_CODE_PATTERN = r"^[ABCEGHJ-NPRSTVXY]\d[ABCEGHJ-NPR-TV-Z]\d[ABCEGHJ-NPR-TV-Z]\d$"
+# Letters commonly typed in place of a digit
+_DIGIT_REPAIRS = str.maketrans("OI", "01")
+
+# Province or territory of each postal code first letter
+FIRST_LETTER_PROVINCES = {
+    "A": {"NL"}, "B": {"NS"}, "C": {"PE"}, "E": {"NB"},
+    "G": {"QC"}, "H": {"QC"}, "J": {"QC"},
+    "K": {"ON"}, "L": {"ON"}, "M": {"ON"}, "N": {"ON"}, "P": {"ON"},
+    "R": {"MB"}, "S": {"SK"}, "T": {"AB"}, "V": {"BC"},
+    "X": {"NT", "NU"}, "Y": {"YT"},
+}
+
+PROVINCE_CODES = {
+    "NEWFOUNDLAND AND LABRADOR": "NL", "NEWFOUNDLAND": "NL", "NOVA SCOTIA": "NS",
+    "PRINCE EDWARD ISLAND": "PE", "NEW BRUNSWICK": "NB", "QUEBEC": "QC", "QUÉBEC": "QC",
+    "ONTARIO": "ON", "ONT": "ON", "MANITOBA": "MB", "SASKATCHEWAN": "SK",
+    "ALBERTA": "AB", "BRITISH COLUMBIA": "BC", "NORTHWEST TERRITORIES": "NT",
+    "NUNAVUT": "NU", "YUKON": "YT", "PQ": "QC", "NF": "NL",
+}
+
+_INDEX_DTYPE = np.dtype([("fsa", "U3"), ("province", "U2"), ("city", "U40")])
+
+
+def build_fsa_index(source: Path, out: Path = DEFAULT_FSA_INDEX) -> int:
+    """
+    Build the FSA index from a CSV with fsa, province and (optional) city columns.
+
+    An FSA may be listed once per city it covers; each city gets its own
+    row. Rows are sorted by FSA so lookups can binary search the
+    memory-mapped array. Returns the number of FSAs written.
+    """
+    provinces: Dict[str, str] = {}
+    cities: Dict[str, Set[str]] = {}
+    with open(source, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            fsa = row["fsa"].strip().upper()
+            provinces[fsa] = normalise_province(row["province"])
+            city = (row.get("city") or "").strip().upper()
+            cities.setdefault(fsa, set()).update([city] if city else [])
+    index = np.array([(fsa, provinces[fsa], city) for fsa in sorted(provinces)
+                      for city in sorted(cities[fsa]) or [""]], dtype=_INDEX_DTYPE)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    np.save(out, index)
+    load_fsa_index.cache_clear()
+    return len(provinces)
+
+
+@lru_cache(maxsize=None)
+def load_fsa_index(path: Path = DEFAULT_FSA_INDEX) -> Optional[np.ndarray]:
+    """Memory-map the FSA index, or return None if it has not been built."""
+    if not path.exists():
+        logger.info(f"No FSA index at {path}; checking provinces from the first letter only.")
+        return None
+    return np.load(path, mmap_mode="r")
+
+
+def normalise_province(value: Optional[str]) -> str:
+    """Return the two-letter code for a province name or abbreviation."""
+    value = (value or "").strip().upper().rstrip(".")
+    return PROVINCE_CODES.get(value, value)
+
+
+def clean_postal_codes(values: Sequence[str], separator: str = " ") -> List[str]:
+    """
+    Normalise a batch of postal codes, returning "" for each invalid one.
+
+    Distinct values are computed once with vectorized string operations and
+    broadcast back to the input order.
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    text = pd.Series(uniques, dtype=object).str.upper().str.replace(r"[\s\-]", "", regex=True)
+    # Repair letters typed in the digit positions (2nd, 4th and 6th)
+    text = (
+        text.str[0:1] + text.str[1:2].str.translate(_DIGIT_REPAIRS)
+        + text.str[2:3] + text.str[3:4].str.translate(_DIGIT_REPAIRS)
+        + text.str[4:5] + text.str[5:6].str.translate(_DIGIT_REPAIRS)
+        + text.str[6:]
+    )
+    valid = text.str.match(POSTAL_CODE_PATTERN)
+    cleaned = (text.str[:3] + separator + text.str[3:]).where(valid, "")
+    return cleaned.to_numpy(dtype=object)[codes].tolist()
+
+
+def lookup_fsas(fsas: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up the province and the set of cities of each distinct FSA in the index."""
+    index = load_fsa_index()
+    distinct = sorted(set(fsas))
+    if index is None or not distinct:
+        return {}
+    keys = np.array(distinct, dtype="U3")
+    starts = np.searchsorted(index["fsa"], keys, side="left")
+    ends = np.searchsorted(index["fsa"], keys, side="right")
+    return {
+        fsa: {"province": str(index["province"][start]),
+              "cities": frozenset(str(city) for city in index["city"][start:end] if city)}
+        for fsa, start, end in zip(distinct, starts, ends)
+        if end > start
+    }
+
+
+def check_regions(codes: Sequence[str], provinces: Sequence[Optional[str]],
+                  cities: Sequence[Optional[str]]) -> List[Optional[str]]:
+    """
+    Cross-check cleaned postal codes against each record's province and city.
+
+    Returns, for each record, a description of the mismatch or None. City
+    is only checked when the FSA index has cities for the code.
+    """
+    fsas = [code[:3] for code in codes]
+    known = lookup_fsas([fsa for fsa in fsas if fsa])
+    index_loaded = load_fsa_index() is not None
+    results: Dict[tuple, Optional[str]] = {}
+    out: List[Optional[str]] = []
+    for fsa, province, city in zip(fsas, provinces, cities):
+        key = (fsa, province, city)
+        if key not in results:
+            results[key] = _check_region(fsa, province, city, known.get(fsa), index_loaded)
+        out.append(results[key])
+    return out
+
+
+def _check_region(fsa: str, province: Optional[str], city: Optional[str],
+                  entry: Optional[Dict[str, Any]], index_loaded: bool) -> Optional[str]:
+    if not fsa:
+        return None
+    if index_loaded and entry is None:
+        return f"FSA '{fsa}' is not in the FSA index"
+    expected = {entry["province"]} if entry else FIRST_LETTER_PROVINCES.get(fsa[0], set())
+    province = normalise_province(province)
+    if province and province not in expected:
+        return f"FSA '{fsa}' is in {'/'.join(sorted(expected))}, not {province}"
+    if entry and entry["cities"] and city and city.strip().upper() not in entry["cities"]:
+        return f"FSA '{fsa}' is in {'/'.join(sorted(entry['cities'])).title()}, not {city.strip()}"
+    return None
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Postal code utilities.")
+    sub = p.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build-index", help="Build the memory-mapped FSA index from a CSV")
+    build.add_argument("source", type=Path, help="CSV with fsa, province and optional city columns")
+    build.add_argument("--output", "-o", type=Path, default=DEFAULT_FSA_INDEX, help="Index file to write")
+    args = p.parse_args()
+
+    count = build_fsa_index(args.source, args.output)
+    print(f"Wrote {count} FSAs to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,87 +2,351 @@
 """
 Pretty-print an XML file so elements are on separate lines,
 making lxml.etree.Element.sourceline useful.
-Creates a backup: <file>.bak
+Keeps the original as a backup: <file>.bak
+
+The file is streamed with iterparse(recover=True) and written element by
+element, so memory stays flat however large or malformed the file is. If
+the content is not a single well-formed document (e.g. several
+concatenated exports), it is re-read inside a __WRAPPER__ root element.
+The same pass writes a sourceline index, <output>.lines.csv, giving the
+path, line and byte offset in the output of every element with a chosen
+localname.
 """
-import shutil
-import sys
+import argparse
+import csv
 import logging
+import os
+import re
+import shutil
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
 from lxml import etree
 
+from xml_input import Sniffed, open_bytes, open_source, sniff_file
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+WRAPPER_TAG = "__WRAPPER__"
+INDEX_SUFFIX = ".lines.csv"
+DEFAULT_INDEX_TAGS = ("Unit",)
+INDENT = "  "
+_CHUNK = 1 << 20
+_XML_DECLARATION = re.compile(rb"(?:\xef\xbb\xbf)?\s*<\?xml[^>]*\?>")
+# libxml2 error raised for content after the root element's end
+_ERR_DOCUMENT_END = 5
+
+# (element path, output line, output byte offset)
+IndexEntry = Tuple[str, int, int]
+
+
 def backup(path):
+    """Move the file to <file>.bak so the pretty-printed output can take its place."""
     bak = path + ".bak"
-    shutil.copy2(path, bak)
+    shutil.move(path, bak)
     logging.info(f"Backup created: {bak}")
     return bak
 
-def try_pretty(path, outpath=None):
+
+class _WrappedSource:
+    """Read-only file-like view of an XML file with its content inside a wrapper root element."""
+
+    def __init__(self, path: str, sniffed: Sniffed) -> None:
+        self._chunks = self._generate(path, sniffed)
+
+    @staticmethod
+    def _generate(path: str, sniffed: Sniffed) -> Iterator[bytes]:
+        with open_bytes(path, sniffed) as f:
+            head = f.read(_CHUNK)
+            # The declaration has to stay first to be a declaration at all
+            declaration = _XML_DECLARATION.match(head)
+            split = declaration.end() if declaration else 0
+            yield head[:split]
+            yield f"<{WRAPPER_TAG}>".encode("ascii")
+            yield head[split:]
+            yield from iter(lambda: f.read(_CHUNK), b"")
+            yield f"</{WRAPPER_TAG}>".encode("ascii")
+
+    def read(self, size: int = -1) -> bytes:
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return b""
+
+
+def _escape_text(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+
+
+def _escape_attr(value: str) -> str:
+    return (_escape_text(value).replace('"', "&quot;")
+            .replace("\n", "&#10;").replace("\t", "&#9;"))
+
+
+class _PrettyWriter:
+    """
+    Writes parse events as pretty-printed UTF-8 XML, tracking the line and byte offset.
+
+    An element is only written once the next event shows whether it has
+    children: a following start makes it a container, its own end makes it a
+    leaf written on one line. Finished elements are removed from the tree as
+    soon as their tail text has been written.
+
+    Nothing is indented inside mixed content, where added whitespace would
+    change the text: an element with text before its first child keeps its
+    content as it was, and so does one from the first child followed by
+    text. Whitespace already written before such a tail is kept.
+    """
+
+    def __init__(self, out, index_tags: Sequence[str], index_writer) -> None:
+        self.out = out
+        self.offset = 0
+        self.line = 1
+        self.index_tags = frozenset(index_tags)
+        self.index_writer = index_writer
+        self.indexed = 0
+        self.depth = 0
+        self.top_level_items = 0
+        self.pending_open: Optional[etree._Element] = None
+        self.pending_tail: Optional[etree._Element] = None
+        # Localname[position] of each started element, and its children's name counts
+        self.path: List[str] = []
+        self.child_counts: List[Dict[str, int]] = [{}]
+        # Whether each open container, and the top level, holds mixed content
+        self.mixed: List[bool] = [False]
+
+    def write(self, text: str) -> None:
+        data = text.encode("utf-8")
+        self.out.write(data)
+        self.offset += len(data)
+        self.line += data.count(b"\n")
+
+    def start(self, elem: etree._Element) -> None:
+        self._flush_tail()
+        if self.pending_open is not None:
+            self._open_container(self.pending_open)
+        self.pending_open = elem
+        local = etree.QName(elem).localname
+        counts = self.child_counts[-1]
+        counts[local] = counts.get(local, 0) + 1
+        self.path.append(f"{local}[{counts[local]}]")
+        self.child_counts.append({})
+
+    def end(self, elem: etree._Element) -> None:
+        self._flush_tail()
+        if self.pending_open is elem:
+            self._indent()
+            self._record(elem)
+            if elem.text:
+                self.write(f"{self._start_tag(elem)}{_escape_text(elem.text)}</{self._qname(elem)}>")
+            else:
+                self.write(self._start_tag(elem)[:-1] + "/>")
+            self.pending_open = None
+        else:
+            self.depth -= 1
+            if not self.mixed.pop():
+                self._indent()
+            self.write(f"</{self._qname(elem)}>")
+        self.path.pop()
+        self.child_counts.pop()
+        self.pending_tail = elem
+
+    def other(self, node: etree._Element) -> None:
+        """Write a comment or processing instruction."""
+        self._flush_tail()
+        if self.pending_open is not None:
+            self._open_container(self.pending_open)
+            self.pending_open = None
+        self._indent()
+        self.write(etree.tostring(node, encoding="unicode", with_tail=False))
+        self.pending_tail = node
+
+    def close(self) -> None:
+        self._flush_tail()
+        self.write("\n")
+
+    def _indent(self) -> None:
+        if self.mixed[-1]:
+            return
+        if self.depth:
+            self.write("\n" + INDENT * self.depth)
+        else:
+            if self.top_level_items:
+                self.write("\n")
+            self.top_level_items += 1
+
+    def _record(self, elem: etree._Element) -> None:
+        if self.index_tags and etree.QName(elem).localname in self.index_tags:
+            self.index_writer.writerow(("/" + "/".join(self.path), self.line, self.offset))
+            self.indexed += 1
+
+    def _open_container(self, elem: etree._Element) -> None:
+        self._indent()
+        self._record(elem)
+        self.write(self._start_tag(elem))
+        mixed = self.mixed[-1] or bool(elem.text and elem.text.strip())
+        if mixed and elem.text:
+            self.write(_escape_text(elem.text))
+        self.mixed.append(mixed)
+        self.depth += 1
+
+    def _flush_tail(self) -> None:
+        node = self.pending_tail
+        if node is None:
+            return
+        if node.tail and (self.mixed[-1] or node.tail.strip()):
+            self.mixed[-1] = True
+            self.write(_escape_text(node.tail))
+        parent = node.getparent()
+        if parent is not None:
+            # Free the finished subtree; only open ancestors stay in memory
+            parent.remove(node)
+        self.pending_tail = None
+
+    @staticmethod
+    def _qname(elem: etree._Element) -> str:
+        local = etree.QName(elem).localname
+        return f"{elem.prefix}:{local}" if elem.prefix else local
+
+    def _start_tag(self, elem: etree._Element) -> str:
+        parts = [self._qname(elem)]
+        parent = elem.getparent()
+        inherited = parent.nsmap if parent is not None else {}
+        for prefix, uri in elem.nsmap.items():
+            if inherited.get(prefix) != uri:
+                parts.append(f'xmlns:{prefix}="{_escape_attr(uri)}"' if prefix else f'xmlns="{_escape_attr(uri)}"')
+        if elem.attrib:
+            prefixes = {uri: prefix for prefix, uri in elem.nsmap.items() if prefix}
+            prefixes["http://www.w3.org/XML/1998/namespace"] = "xml"
+            for name, value in elem.attrib.items():
+                if name.startswith("{"):
+                    uri, _, local = name[1:].partition("}")
+                    name = f"{prefixes[uri]}:{local}"
+                parts.append(f'{name}="{_escape_attr(value)}"')
+        return "<" + " ".join(parts) + ">"
+
+
+def stream_pretty(source: str, outpath: str, wrap: bool = False,
+                  index_tags: Sequence[str] = DEFAULT_INDEX_TAGS) -> Tuple[int, etree._ListErrorLog]:
+    """
+    Stream source to outpath pretty-printed, recovering from malformed markup.
+
+    With wrap, the content is read inside a __WRAPPER__ root element.
+    Elements whose localname is in index_tags are written to the sourceline
+    index, outpath + INDEX_SUFFIX, as they are reached. Returns the number
+    of indexed elements and the parser's log of recovered errors.
+    """
+    sniffed = sniff_file(source)
+    if sniffed.mislabelled:
+        logging.warning(f"{source} {sniffed.describe()}.")
+    parse_source = _WrappedSource(source, sniffed) if wrap else open_source(source, sniffed)
+    context = etree.iterparse(parse_source, events=("start", "end", "comment", "pi"), encoding=sniffed.parser_encoding,
+                              recover=True, remove_blank_text=True, huge_tree=True)
+    with open(outpath, "wb") as out, open(outpath + INDEX_SUFFIX, "w", newline="", encoding="utf-8") as index:
+        index_writer = csv.writer(index)
+        index_writer.writerow(["path", "line", "offset"])
+        writer = _PrettyWriter(out, index_tags, index_writer)
+        writer.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        for event, node in context:
+            if event == "start":
+                writer.start(node)
+            elif event == "end":
+                writer.end(node)
+            else:
+                writer.other(node)
+        writer.close()
+    logging.info(f"Sourceline index ({writer.indexed} elements) saved to: {outpath + INDEX_SUFFIX}")
+    return writer.indexed, context.error_log
+
+
+def read_index(index_path: str) -> Iterator[IndexEntry]:
+    """Iterate over a sourceline index written alongside a pretty-printed file."""
+    with open(index_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            yield row["path"], int(row["line"]), int(row["offset"])
+
+
+def try_pretty(path, outpath=None, index_tags=DEFAULT_INDEX_TAGS):
+    """
+    Stream path to outpath pretty-printed. Returns the number of indexed elements,
+    or None if the content is not a single document and needs try_wrap_and_pretty.
+    """
     if outpath is None:
         outpath = path
-    parser = etree.XMLParser(remove_blank_text=True, recover=True)
     try:
-        tree = etree.parse(path, parser)
-        tree.write(outpath, encoding="utf-8", pretty_print=True, xml_declaration=True)
-        logging.info(f"Pretty printed XML saved to: {outpath}")
-        return True
+        indexed, errors = stream_pretty(path, outpath, index_tags=index_tags)
     except etree.XMLSyntaxError as e:
         logging.error(f"XMLSyntaxError during pretty print: {e}")
-        return False
+        return None
+    if any(error.type == _ERR_DOCUMENT_END for error in errors):
+        logging.error("Content found after the root element; it would be lost without a wrapper.")
+        return None
+    _log_recovered(errors)
+    logging.info(f"Pretty printed XML saved to: {outpath}")
+    return indexed
+
 
-def try_wrap_and_pretty(path, outpath=None):
+def try_wrap_and_pretty(path, outpath=None, index_tags=DEFAULT_INDEX_TAGS):
     """
     Fallback: wrap content in a temporary root element, pretty print.
     Note: this will add the wrapper element to the output — inspect result and remove wrapper if needed.
     """
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
-    wrapped = "<__WRAPPER__>\n" + content + "\n</__WRAPPER__>"
-    parser = etree.XMLParser(remove_blank_text=True, recover=True)
+    out = path if outpath is None else outpath
     try:
-        root = etree.fromstring(wrapped.encode("utf-8"), parser)
-        tree = etree.ElementTree(root)
-        out = path if outpath is None else outpath
-        tree.write(out, encoding="utf-8", pretty_print=True, xml_declaration=True)
-        logging.info(f"Wrapped and pretty printed to: {out} (contains a __WRAPPER__ root tag)")
-        return True
+        indexed, errors = stream_pretty(path, out, wrap=True, index_tags=index_tags)
     except etree.XMLSyntaxError as e:
         logging.error(f"Fallback wrap failed: {e}")
-        return False
+        return None
+    _log_recovered(errors)
+    logging.info(f"Wrapped and pretty printed to: {out} (contains a {WRAPPER_TAG} root tag)")
+    return indexed
+
 
-def print_sample_lines(path, tag_localname="Unit", limit=20):
+def _log_recovered(errors: etree._ListErrorLog, limit: int = 10) -> None:
+    for error in list(errors)[:limit]:
+        logging.warning(f"Recovered from line {error.line}: {error.message}")
+    if len(errors) > limit:
+        logging.warning(f"... and {len(errors) - limit} more recovered errors")
+
+
+def print_sample_lines(index_path, tag_localname="Unit", limit=20):
     """
-    Reparse and print sourceline for elements with given localname.
+    Print the line of indexed elements with the given localname, read from the sourceline index.
     """
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(path, parser)
-    root = tree.getroot()
     count = 0
-    for elem in root.iter():
-        # get localname (works with namespaces)
-        local = etree.QName(elem).localname
-        if local == tag_localname:
-            print(f"Line {elem.sourceline}: <{local}> -> {elem.text!r}")
+    for element_path, line, offset in read_index(index_path):
+        if element_path.rpartition("/")[2].startswith(tag_localname + "["):
+            print(f"Line {line} (byte {offset}): {element_path}")
             count += 1
             if count >= limit:
                 break
     if count == 0:
         logging.info(f"No elements named '{tag_localname}' found (check tag name or namespace).")
 
-def main(path):
-    backup(path)
-    ok = try_pretty(path)
-    if not ok:
-        logging.warning("Attempting fallback wrap-and-pretty. Output will include wrapper element; inspect it.")
-        ok2 = try_wrap_and_pretty(path)
-        if not ok2:
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Pretty-print an XML file in place, keeping a .bak backup.")
+    p.add_argument("path", help="XML file to pretty-print")
+    p.add_argument("--wrap", action="store_true", help=f"Always read the content inside a {WRAPPER_TAG} root")
+    p.add_argument("--index-tags", nargs="*", default=list(DEFAULT_INDEX_TAGS),
+                   help="Localnames of elements to record in the sourceline index (default: Unit)")
+    args = p.parse_args()
+
+    path = args.path
+    source = backup(path)
+    indexed = None if args.wrap else try_pretty(source, path, args.index_tags)
+    if indexed is None:
+        if not args.wrap:
+            logging.warning("Attempting fallback wrap-and-pretty. Output will include wrapper element; inspect it.")
+        indexed = try_wrap_and_pretty(source, path, args.index_tags)
+        if indexed is None:
             logging.error("Both pretty-print attempts failed. File may be badly malformed.")
-            sys.exit(2)
-    # show some sample 'Unit' elements with line numbers
-    print_sample_lines(path, tag_localname="Unit", limit=50)
+            os.replace(source, path)
+            return 2
+    # show some sample indexed elements with line numbers
+    for tag in args.index_tags:
+        print_sample_lines(path + INDEX_SUFFIX, tag_localname=tag, limit=50)
+    return 0
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python pretty_fix_xml.py path/to/file.xml")
-        sys.exit(1)
-    main(sys.argv[1])
+    raise SystemExit(main())
@@ -1,118 +1,361 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
+import json
 import logging
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple, Union
 
 import pandas as pd
-import xmltodict
 
-# Logging to both console and file
+from duplicates import DEFAULT_MAX_BLOCK, DEFAULT_MIN_SCORE, Duplicates, find_duplicates, student_keys
+from enrollment_cache import DEFAULT_CACHE_DIRNAME, DEFAULT_MAX_CACHE_MB, EnrollmentCache
+from run_metrics import RunMetrics, save_profile, stage
+from table_export import COMPRESSION_SUFFIXES, COMPRESSIONS, FORMATS, export_tables
+from xml_input import iterparse, sniff_file
+
+# Log written by main(), alongside the console
 DEFAULT_LOGFILE = "pull_info.log"
+# Written next to the log by --metrics and --profile
+METRICS_FILE = "pull_info_metrics.json"
+PROFILE_FILE = "pull_info.prof"
 logger = logging.getLogger("pull_info")
 logger.setLevel(logging.INFO)
-fmt = logging.Formatter("%(levelname)s: %(message)s")
-
-fh = logging.FileHandler(DEFAULT_LOGFILE, mode="w", encoding="windows-1252")
-fh.setFormatter(fmt)
-logger.addHandler(fh)
-
-sh = logging.StreamHandler()
-sh.setFormatter(fmt)
-logger.addHandler(sh)
-
 
-def _ensure_list(x: Optional[Any]) -> List[Any]:
-    """Normalize xmltodict result to a list."""
-    if x is None:
-        return []
-    if isinstance(x, list):
-        return x
-    return [x]
 
-
-def parse_xml(path: Path) -> List[Dict[str, Any]]:
-    """Parse STIX-like school XML and return a flat list of student dicts."""
+NS1 = "{http://ontario.ca}"
+
+# Bump whenever parse_xml or build_dataframe output changes, to invalidate cached tables
+PARSER_VERSION = "2"
+
+# Output columns, with the (parent, child) ns1 localnames each is read from.
+# A parent of None means a direct child of ns1:Student.
+STUDENT_FIELDS = {
+    "FirstName": ("Name", "First"),
+    "MiddleName": ("Name", "Middle"),
+    "LastName": ("Name", "Last"),
+    "AliasFirstName": ("AliasName", "First"),
+    "AliasMiddleName": ("AliasName", "Middle"),
+    "AliasLastName": ("AliasName", "Last"),
+    "BirthDate": (None, "BirthDate"),
+    "Grade": (None, "Grade"),
+    "Class": (None, "Class"),
+    "OEN": (None, "OEN"),
+    "Gender": (None, "Gender"),
+    "Language": (None, "Language"),
+    "CountryOfOrigin": (None, "CountryOfOrigin"),
+    "Unit": ("Address", "Unit"),
+    "StreetNumber": ("Address", "StreetNumber"),
+    "StreetNumberSuffix": ("Address", "StreetNumberSuffix"),
+    "StreetName": ("Address", "StreetName"),
+    "StreetType": ("Address", "StreetType"),
+    "City": ("Address", "City"),
+    "Province": ("Address", "Province"),
+    "PostalCode": ("Address", "PostalCode"),
+}
+COLUMNS = ["SchoolName", "SchoolNumber"] + list(STUDENT_FIELDS)
+# Missing name and address parts are "" rather than None
+BLANK_AS_EMPTY = {"SchoolName", "SchoolNumber", "FirstName", "MiddleName", "LastName", "Unit",
+                  "StreetNumber", "StreetNumberSuffix", "StreetName", "StreetType", "City",
+                  "Province", "PostalCode"}
+# High-repeat columns stored as category codes while parsing
+CATEGORICAL_COLUMNS = {"SchoolName", "Grade", "Gender", "City", "Province", "Language"}
+
+_DIRECT_FIELDS = {NS1 + child: column for column, (parent, child) in STUDENT_FIELDS.items() if parent is None}
+_NESTED_FIELDS: Dict[str, Dict[str, str]] = {}
+for _column, (_parent, _child) in STUDENT_FIELDS.items():
+    if _parent is not None:
+        _NESTED_FIELDS.setdefault(NS1 + _parent, {})[NS1 + _child] = _column
+
+
+class _CategoryBuffer:
+    """Column buffer that stores each value as an integer code into a list of distinct values."""
+
+    def __init__(self) -> None:
+        self.codes = array("i")
+        self.categories: List[str] = []
+        self._lookup: Dict[str, int] = {}
+
+    def append(self, value: Optional[str]) -> None:
+        if value is None:
+            self.codes.append(-1)
+            return
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self.categories)
+            self.categories.append(value)
+        self.codes.append(code)
+
+    def to_categorical(self) -> pd.Categorical:
+        categorical = pd.Categorical.from_codes(self.codes, categories=pd.Index(self.categories, dtype=object))
+        # Sorted categories make groupby order rows as it did for plain string columns
+        return categorical.reorder_categories(sorted(self.categories))
+
+
+@lru_cache(maxsize=None)
+def birth_year(birth_date: Optional[str]) -> Optional[int]:
+    """Return the year of a BirthDate value as build_dataframe derives it, or None if it does not parse."""
+    if not birth_date:
+        return None
+    try:
+        # Fast path for the ISO dates STIX uses; pandas handles anything else
+        return datetime.fromisoformat(birth_date).year
+    except ValueError:
+        pass
+    parsed = pd.to_datetime(birth_date, errors="coerce")
+    return None if pd.isna(parsed) else parsed.year
+
+
+@dataclass(frozen=True)
+class StudentFilter:
+    """
+    Cohort predicates on student fields. An empty value places no constraint.
+
+    Grades and school numbers match exactly, cities ignore case and postal
+    code prefixes ignore case and spacing.
+    """
+    birth_years: FrozenSet[int] = frozenset()
+    grades: FrozenSet[str] = frozenset()
+    school_numbers: FrozenSet[str] = frozenset()
+    cities: FrozenSet[str] = frozenset()
+    postal_prefixes: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_values(cls, birth_years: Sequence[int] = (), grades: Sequence[str] = (),
+                    school_numbers: Sequence[str] = (), cities: Sequence[str] = (),
+                    postal_prefixes: Sequence[str] = ()) -> "StudentFilter":
+        return cls(
+            birth_years=frozenset(int(year) for year in birth_years),
+            grades=frozenset(grades),
+            school_numbers=frozenset(str(number) for number in school_numbers),
+            cities=frozenset(city.strip().upper() for city in cities),
+            postal_prefixes=tuple(sorted({_postal_key(prefix) for prefix in postal_prefixes})),
+        )
+
+    def matches(self, row: Dict[str, Optional[str]]) -> bool:
+        """Return True if a parsed student row satisfies every predicate."""
+        if self.school_numbers and row["SchoolNumber"] not in self.school_numbers:
+            return False
+        if self.grades and row["Grade"] not in self.grades:
+            return False
+        if self.cities and row["City"].upper() not in self.cities:
+            return False
+        if self.postal_prefixes and not _postal_key(row["PostalCode"]).startswith(self.postal_prefixes):
+            return False
+        if self.birth_years and birth_year(row["BirthDate"]) not in self.birth_years:
+            return False
+        return True
+
+    def mask(self, df: pd.DataFrame) -> pd.Series:
+        """Return a boolean mask of the DataFrame rows that satisfy every predicate."""
+        keep = pd.Series(True, index=df.index)
+        if self.birth_years:
+            keep &= df["BirthYear"].isin(self.birth_years)
+        if self.grades:
+            keep &= df["Grade"].isin(self.grades)
+        if self.school_numbers:
+            keep &= df["SchoolNumber"].isin(self.school_numbers)
+        if self.cities:
+            keep &= df["City"].astype(object).str.upper().isin(self.cities)
+        if self.postal_prefixes:
+            postal = df["PostalCode"].astype(object).str.replace(r"\s", "", regex=True).str.upper()
+            keep &= postal.str.startswith(self.postal_prefixes)
+        return keep
+
+    def describe(self) -> str:
+        parts = [
+            f"{name}={','.join(str(value) for value in sorted(values))}"
+            for name, values in (
+                ("BirthYear", self.birth_years), ("Grade", self.grades), ("SchoolNumber", self.school_numbers),
+                ("City", self.cities), ("PostalCode^", self.postal_prefixes),
+            )
+            if values
+        ]
+        return " ".join(parts) or "all students"
+
+
+def _postal_key(code: Optional[str]) -> str:
+    return "".join((code or "").split()).upper()
+
+
+# The cohort filter_students selects when none is configured
+DEFAULT_COHORT = StudentFilter.from_values(birth_years=[2012, 2013], grades=["GR7", "GR8"])
+
+
+def load_filter(config: Optional[Path] = None, **overrides: Optional[Sequence[Any]]) -> StudentFilter:
+    """
+    Build a StudentFilter from a JSON config and command-line values.
+
+    The config is an object with any of the keys birth_years, grades,
+    school_numbers, cities and postal_prefixes, each a list. Overrides that
+    are not None replace the config's value. With neither, DEFAULT_COHORT
+    is returned.
+    """
+    values: Dict[str, Sequence[Any]] = {}
+    if config is not None:
+        with open(config, encoding="utf-8") as f:
+            values = json.load(f)
+        unknown = set(values) - set(StudentFilter.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"Unknown filter keys in {config}: {', '.join(sorted(unknown))}")
+    values.update({key: value for key, value in overrides.items() if value is not None})
+    if not values:
+        return DEFAULT_COHORT
+    return StudentFilter.from_values(**values)
+
+
+class RunningCounts:
+    """Full-population student counts accumulated while a filtered parse discards rows."""
+
+    def __init__(self) -> None:
+        self.counts: Counter = Counter()
+        self.schools: Set[str] = set()
+        self.grades: Set[str] = set()
+        self.total = 0
+        self.missing_birth_year = False
+
+    def add(self, row: Dict[str, Optional[str]]) -> None:
+        year = birth_year(row["BirthDate"])
+        self.missing_birth_year |= year is None
+        if row["SchoolName"] is not None:
+            self.schools.add(row["SchoolName"])
+        if row["Grade"] is not None:
+            self.grades.add(row["Grade"])
+        self.counts[row["SchoolName"], year, row["Grade"]] += 1
+        self.total += 1
+
+    def frame(self) -> pd.DataFrame:
+        """Return the counts as SchoolName, BirthYear, Grade and Count columns typed as in build_dataframe."""
+        keys = list(self.counts)
+        frame = pd.DataFrame({
+            "SchoolName": pd.Categorical([key[0] for key in keys], categories=pd.Index(sorted(self.schools), dtype=object)),
+            "BirthYear": pd.Series([key[1] for key in keys], dtype="float64"),
+            "Grade": pd.Categorical([key[2] for key in keys], categories=pd.Index(sorted(self.grades), dtype=object)),
+            "Count": pd.Series(list(self.counts.values()), dtype="int64"),
+        })
+        if not self.missing_birth_year:
+            # Series.dt.year is only float when some dates are missing
+            frame["BirthYear"] = frame["BirthYear"].astype("int32")
+        return frame
+
+    def summaries(self) -> Dict[str, pd.DataFrame]:
+        """Produce the same tables summarize() would for the full population."""
+        frame = self.frame()
+        school_counts = frame.groupby(["SchoolName", "BirthYear"], observed=True)["Count"].sum().reset_index(name="StudentCount")
+        grade_counts = frame.groupby(["SchoolName", "Grade"], observed=True)["Count"].sum().reset_index(name="GradeCount")
+        return {"school_counts": school_counts, "grade_counts": grade_counts}
+
+    def birth_year_counts(self) -> pd.Series:
+        counts = self.frame().groupby("BirthYear")["Count"].sum()
+        return counts.sort_values(ascending=False, kind="stable").rename("count")
+
+
+def parse_xml(path: Path, student_filter: Optional[StudentFilter] = None,
+              counts: Optional[RunningCounts] = None) -> Dict[str, Sequence[Any]]:
+    """
+    Stream STIX-like school XML and return the students as columns.
+
+    ns1:Student elements are read one at a time with iterparse and each
+    field is appended straight to its column buffer before the element is
+    freed. High-repeat columns are returned as categoricals.
+
+    With a student_filter, only matching students are kept. counts, if
+    given, is updated with every student, kept or not.
+    """
     logger.info("Parsing XML: %s", path)
-    text = path.read_text(encoding="windows-1252")
-    data = xmltodict.parse(text)
-
-    root = data.get("ns1:SchoolUpload", data)
-    records = _ensure_list(root.get("ns1:School"))
-
-    students_out: List[Dict[str, Any]] = []
-
-    for rec in records:
-        school_name = rec.get("ns1:Name", "") or ""
-        school_number = rec.get("ns1:SchoolNumber", "") or ""
-        students_node = rec.get("ns1:Students", {}) or {}
-        student_nodes = _ensure_list(students_node.get("ns1:Student"))
-
-        for student in student_nodes:
-            name_node = student.get("ns1:Name", {}) or {}
-            first = name_node.get("ns1:First", "") or ""
-            middle = name_node.get("ns1:Middle", "") or ""
-            last = name_node.get("ns1:Last", "") or ""
-
-            alias_name_node = student.get("ns1:AliasName", {}) or {}
-            address_node = student.get("ns1:Address", {}) or {}
-            unit = address_node.get("ns1:Unit", "") or ""
-            street_number = address_node.get("ns1:StreetNumber", "") or ""
-            street_number_suffix = address_node.get("ns1:StreetNumberSuffix", "") or ""
-            street_name = address_node.get("ns1:StreetName", "") or ""
-            street_type = address_node.get("ns1:StreetType", "") or ""
-            city = address_node.get("ns1:City", "") or ""
-            province = address_node.get("ns1:Province", "") or ""
-            postal_code = address_node.get("ns1:PostalCode", "") or ""
-
-            student_dict = {
-                "SchoolName": school_name,
-                "SchoolNumber": school_number,
-                "FirstName": first,
-                "MiddleName": middle,
-                "LastName": last,
-                "AliasFirstName": alias_name_node.get("ns1:First"),
-                "AliasMiddleName": alias_name_node.get("ns1:Middle"),
-                "AliasLastName": alias_name_node.get("ns1:Last"),
-                "BirthDate": student.get("ns1:BirthDate"),
-                "Grade": student.get("ns1:Grade"),
-                "Class": student.get("ns1:Class"),
-                "OEN": student.get("ns1:OEN"),
-                "Gender": student.get("ns1:Gender"),
-                "Language": student.get("ns1:Language"),
-                "CountryOfOrigin": student.get("ns1:CountryOfOrigin"),
-                "Unit": unit,
-                "StreetNumber": street_number,
-                "StreetNumberSuffix": street_number_suffix,
-                "StreetName": street_name,
-                "StreetType": street_type,
-                "City": city,
-                "Province": province,
-                "PostalCode": postal_code,
-            }
-            students_out.append(student_dict)
-
-    logger.info("Parsed %d students", len(students_out))
-    return students_out
+    buffers: Dict[str, Any] = {
+        column: _CategoryBuffer() if column in CATEGORICAL_COLUMNS else [] for column in COLUMNS
+    }
+    school = None
+    school_name = school_number = ""
+    count = 0
+
+    sniffed = sniff_file(path)
+    if sniffed.mislabelled:
+        logger.warning("%s %s.", path, sniffed.describe())
+    context = iterparse(path, sniffed, events=("end",), tag=(NS1 + "Student", NS1 + "School"),
+                        remove_blank_text=True)
+    for _, elem in context:
+        if elem.tag == NS1 + "School":
+            # Release the finished school and any earlier siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            school = None
+            continue
+
+        parent_school = elem.getparent().getparent()
+        if parent_school is not school:
+            school = parent_school
+            school_name = school.findtext(NS1 + "Name") or ""
+            school_number = school.findtext(NS1 + "SchoolNumber") or ""
+
+        values: Dict[str, Optional[str]] = {}
+        for child in elem:
+            column = _DIRECT_FIELDS.get(child.tag)
+            if column is not None:
+                values[column] = child.text
+                continue
+            nested = _NESTED_FIELDS.get(child.tag)
+            if nested is not None:
+                for grandchild in child:
+                    column = nested.get(grandchild.tag)
+                    if column is not None:
+                        values[column] = grandchild.text
+
+        row: Dict[str, Optional[str]] = {"SchoolName": school_name, "SchoolNumber": school_number}
+        for column in STUDENT_FIELDS:
+            value = values.get(column)
+            if value:
+                # xmltodict, which this replaced, stripped surrounding whitespace
+                value = value.strip()
+            if not value:
+                value = "" if column in BLANK_AS_EMPTY else None
+            row[column] = value
+
+        if counts is not None:
+            counts.add(row)
+        if student_filter is None or student_filter.matches(row):
+            for column, value in row.items():
+                buffers[column].append(value)
+            count += 1
+
+        # Release the student; its school's earlier students are already gone
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    if student_filter is None:
+        logger.info("Parsed %d students", count)
+    else:
+        logger.info("Parsed %d students matching %s", count, student_filter.describe())
+    return {
+        column: buffer.to_categorical() if isinstance(buffer, _CategoryBuffer) else buffer
+        for column, buffer in buffers.items()
+    }
 
 
 def summarize(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
     """Produce summary tables used by original script."""
-    school_counts = df.groupby(["SchoolName", "BirthYear"]).size().reset_index(name="StudentCount")
-    grade_counts = df.groupby(["SchoolName", "Grade"]).size().reset_index(name="GradeCount")
+    # observed=True keeps categorical columns to the combinations actually present
+    school_counts = df.groupby(["SchoolName", "BirthYear"], observed=True).size().reset_index(name="StudentCount")
+    grade_counts = df.groupby(["SchoolName", "Grade"], observed=True).size().reset_index(name="GradeCount")
     return {"school_counts": school_counts, "grade_counts": grade_counts}
 
 
-def filter_students(df: pd.DataFrame) -> pd.DataFrame:
-    """Apply birth year and grade filters (2012/2013 & GR7/GR8)."""
-    df_filtered = df[df["BirthYear"].isin([2012, 2013])]
-    df_filtered = df_filtered[df_filtered["Grade"].isin(["GR7", "GR8"])]
-    return df_filtered
+def filter_students(df: pd.DataFrame, student_filter: StudentFilter = DEFAULT_COHORT) -> pd.DataFrame:
+    """Apply cohort filters (by default birth years 2012/2013 & GR7/GR8)."""
+    return df[student_filter.mask(df)]
 
-def build_dataframe(student_list: List[Dict[str, Any]]) -> pd.DataFrame:
-    """Return DataFrame with parsed dates and derived columns."""
-    df = pd.DataFrame(student_list)
+def build_dataframe(students: Union[List[Dict[str, Any]], Dict[str, Sequence[Any]]]) -> pd.DataFrame:
+    """Return DataFrame with parsed dates and derived columns from student rows or columns."""
+    df = pd.DataFrame(students)
     if "BirthDate" in df.columns:
         df["BirthDate"] = pd.to_datetime(df["BirthDate"], errors="coerce")
         df["BirthYear"] = df["BirthDate"].dt.year
@@ -121,74 +364,255 @@ def build_dataframe(student_list: List[Dict[str, Any]]) -> pd.DataFrame:
         df["BirthYear"] = pd.NA
     return df
 
+def parse_students(path: Path, student_filter: Optional[StudentFilter] = None,
+                   counts: Optional[RunningCounts] = None, metrics: Optional[RunMetrics] = None) -> pd.DataFrame:
+    """parse_xml and build_dataframe, timed as the parse and dataframe stages."""
+    with stage(metrics, "parse"):
+        columns = parse_xml(path, student_filter, counts)
+    with stage(metrics, "dataframe", len(columns["SchoolName"])):
+        return build_dataframe(columns)
+
+def load_students(path: Path, cache_dir: Optional[Path] = None, rebuild: bool = False,
+                  max_cache_bytes: Optional[int] = DEFAULT_MAX_CACHE_MB << 20,
+                  metrics: Optional[RunMetrics] = None) -> pd.DataFrame:
+    """
+    Return the student table for an XML file, from the enrollment cache when possible.
+
+    With no cache_dir the XML is always parsed. Otherwise a cached table for
+    the same file contents and parser version is loaded instead, and a fresh
+    parse (or any parse when rebuild is set) is written back to the cache.
+    """
+    if cache_dir is None:
+        return parse_students(path, metrics=metrics)
+    if not EnrollmentCache.available():
+        logger.warning("pyarrow is not installed; parsing without the cache.")
+        return parse_students(path, metrics=metrics)
+
+    cache = EnrollmentCache(cache_dir, PARSER_VERSION, max_cache_bytes)
+    with stage(metrics, "cache load"):
+        key = cache.key(path)
+        df = None if rebuild else cache.load(key)
+    if df is not None:
+        logger.info("Loaded %d students from cache: %s", len(df), cache.path_for(key))
+        if metrics is not None:
+            metrics.count("cache hits")
+        return df
+
+    df = parse_students(path, metrics=metrics)
+    with stage(metrics, "cache store"):
+        cache.store(key, df)
+    logger.info("Cached student table: %s", cache.path_for(key))
+    return df
+
+def find_upload_duplicates(df: pd.DataFrame, path: Path, others: Iterable[Tuple[Path, pd.DataFrame]],
+                           min_score: float = DEFAULT_MIN_SCORE, max_block: int = DEFAULT_MAX_BLOCK,
+                           metrics: Optional[RunMetrics] = None) -> Duplicates:
+    """
+    Find students enrolled twice in df, the student table of path, or in it and one of the (path, table) others.
+
+    Each other table is reduced to its match keys as it is taken, so a
+    generator of others holds one full table at a time.
+    """
+    frames = [student_keys(df, str(path))] + [student_keys(other_df, str(other)) for other, other_df in others]
+    keys = pd.concat(frames, ignore_index=True)
+    with stage(metrics, "duplicates", len(keys)):
+        duplicates = find_duplicates(keys, min_score, max_block)
+    counts = duplicates.scope_counts()
+    logger.info("Duplicate students: %d pairs in %d groups%s", len(duplicates.pairs),
+                duplicates.pairs["group"].nunique(),
+                "".join(f", {count} {scope}" for scope, count in counts.items()))
+    if metrics is not None:
+        metrics.count("duplicate pairs", len(duplicates.pairs))
+    return duplicates
+
+
 def export_outputs(
-    df_all: pd.DataFrame,
+    df_all: Optional[pd.DataFrame],
     df_filtered: pd.DataFrame,
     summaries: Dict[str, pd.DataFrame],
     out: Optional[Path],
     excel: bool = False,
+    duplicates: Optional[pd.DataFrame] = None,
+    export_format: str = "csv",
+    compression: Optional[str] = None,
 ) -> None:
-    """Export results to CSVs or a single Excel workbook."""
+    """
+    Export results to CSV or Parquet files, or a single Excel workbook.
+
+    export_format is one of table_export.FORMATS; excel=True is the same as "excel".
+    CSVs may be compressed with gzip or zstd. The all-students output is
+    skipped if df_all is None, and the duplicates report is only written if
+    given. Tables are streamed a chunk of rows at a time (see table_export).
+    """
     if out is None:
         logger.info("No output path provided; skipping export.")
         return
+    if excel:
+        export_format = "excel"
+    if compression and export_format != "csv":
+        raise ValueError(f"Compression applies to CSV output, not {export_format}")
 
     out = out.expanduser()
     out_parent = out.parent
     if not out_parent.exists():
         out_parent.mkdir(parents=True, exist_ok=True)
 
-    if excel:
+    tables = {"all_students": df_all, "filtered_students": df_filtered,
+              "school_counts": summaries["school_counts"], "grade_counts": summaries["grade_counts"],
+              "duplicates": duplicates}
+    tables = {name: table for name, table in tables.items() if table is not None}
+
+    if export_format == "excel":
         out_file = out if out.suffix.lower() == ".xlsx" else out.with_suffix(".xlsx")
         logger.info("Writing Excel output: %s", out_file)
-        with pd.ExcelWriter(out_file, engine="openpyxl") as writer:
-            df_all.to_excel(writer, sheet_name="All_Students", index=False)
-            df_filtered.to_excel(writer, sheet_name="Filtered_Students", index=False)
-            summaries["school_counts"].to_excel(writer, sheet_name="School_Counts", index=False)
-            summaries["grade_counts"].to_excel(writer, sheet_name="Grade_Counts", index=False)
+        sheets = {name.title(): table for name, table in tables.items()}
+        export_tables(sheets, {"workbook": out_file}, export_format)
     else:
         base = out.with_suffix("") if out.suffix else out
-        students_csv = base.with_name(base.name + "_all_students.csv")
-        filtered_csv = base.with_name(base.name + "_filtered_students.csv")
-        school_csv = base.with_name(base.name + "_school_counts.csv")
-        grade_csv = base.with_name(base.name + "_grade_counts.csv")
+        suffix = ".parquet" if export_format == "parquet" else ".csv" + COMPRESSION_SUFFIXES.get(compression, "")
+        paths = {name: base.with_name(f"{base.name}_{name}{suffix}") for name in tables}
 
-        logger.info("Writing CSV outputs to: %s*", base)
-        df_all.to_csv(students_csv, index=False, encoding="utf-8-sig")
-        df_filtered.to_csv(filtered_csv, index=False, encoding="utf-8-sig")
-        summaries["school_counts"].to_csv(school_csv, index=False, encoding="utf-8-sig")
-        summaries["grade_counts"].to_csv(grade_csv, index=False, encoding="utf-8-sig")
+        logger.info("Writing %s outputs to: %s*", export_format.upper(), base)
+        export_tables(tables, paths, export_format, compression)
 
 
 def main() -> int:
     p = argparse.ArgumentParser(description="Extract student info from school XML.")
     p.add_argument("input", type=Path, help="Path to the XML file")
     p.add_argument("--output", "-o", type=Path, help="Output path (file). If --excel passed produces .xlsx")
-    p.add_argument("--excel", action="store_true", help="Export results as a single Excel workbook (.xlsx)")
+    p.add_argument("--format", choices=FORMATS, default="csv", dest="export_format",
+                   help="Export tables as CSV files, a single Excel workbook (.xlsx) or Parquet files")
+    p.add_argument("--excel", action="store_true", help="Export results as a single Excel workbook (--format excel)")
+    p.add_argument("--compress", choices=COMPRESSIONS, help="Compress CSV outputs (.csv.gz or .csv.zst)")
+    p.add_argument("--cache-dir", type=Path,
+                   help=f"Directory of cached student tables (default: {DEFAULT_CACHE_DIRNAME} next to the input)")
+    p.add_argument("--cache-max-mb", type=int, default=DEFAULT_MAX_CACHE_MB,
+                   help="Evict least recently used cached tables beyond this size")
+    p.add_argument("--no-cache", action="store_true", help="Always parse the XML; neither read nor write the cache")
+    p.add_argument("--rebuild-cache", action="store_true", help="Re-parse the XML and replace its cached table")
+    p.add_argument("--filter-config", type=Path, help="JSON file of cohort filters (see load_filter)")
+    p.add_argument("--birth-year", type=int, nargs="+", dest="birth_years", help="Keep students born in these years")
+    p.add_argument("--grade", nargs="+", dest="grades", help="Keep students in these grades (e.g. GR7)")
+    p.add_argument("--school-number", nargs="+", dest="school_numbers", help="Keep students of these schools")
+    p.add_argument("--city", nargs="+", dest="cities", help="Keep students living in these cities")
+    p.add_argument("--postal-prefix", nargs="+", dest="postal_prefixes",
+                   help="Keep students whose postal code starts with one of these (e.g. N1G)")
+    p.add_argument("--timings", action="store_true",
+                   help="Time each stage (parse, cache, summaries, filters, export) and print a table")
+    p.add_argument("--metrics", action="store_true",
+                   help=f"Save stage timings, peak memory and counts to {METRICS_FILE} next to the log")
+    p.add_argument("--profile", action="store_true",
+                   help=f"Run under cProfile and save the stats to {PROFILE_FILE}, with a text summary in "
+                        f"{PROFILE_FILE}.txt, next to the log")
+    p.add_argument("--cohort-only", action="store_true",
+                   help="Apply the filters while parsing and keep only the cohort in memory. "
+                        "Summaries still count every student; the all-students output and the cache are skipped.")
+    p.add_argument("--duplicates", nargs="*", type=Path, metavar="OTHER_XML",
+                   help="Find students enrolled twice: within the input, and between it and any other uploads "
+                        "given (e.g. the board's secondary file). Adds DuplicateGroup and DuplicateScore columns "
+                        "and writes a duplicates report with the other outputs")
+    p.add_argument("--duplicates-min-score", type=float, default=DEFAULT_MIN_SCORE,
+                   help="Drop name, birth date and FSA matches scoring below this (default: %(default)s)")
+    p.add_argument("--duplicates-max-block", type=int, default=DEFAULT_MAX_BLOCK,
+                   help="Do not pair students sharing an OEN or name block with more than this many others")
     args = p.parse_args()
 
-    if not args.input.exists():
-        logger.error("Input file not found: %s", args.input)
-        return 2
-
+    # Logging to both console and file
+    fmt = logging.Formatter("%(levelname)s: %(message)s")
+    fh = logging.FileHandler(DEFAULT_LOGFILE, mode="w", encoding="utf-8")
+    fh.setFormatter(fmt)
+    logger.addHandler(fh)
+    sh = logging.StreamHandler()
+    sh.setFormatter(fmt)
+    logger.addHandler(sh)
+
+    if args.excel:
+        args.export_format = "excel"
+    if args.compress and args.export_format != "csv":
+        p.error("--compress applies to CSV output only")
+
+    for path in [args.input] + (args.duplicates or []):
+        if not path.exists():
+            logger.error("Input file not found: %s", path)
+            return 2
+
+    metrics = RunMetrics() if args.timings or args.metrics else None
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
     try:
-        students = parse_xml(args.input)
-        df = build_dataframe(students)
-        summaries = summarize(df)
-        df_filtered = filter_students(df)
-
-        logger.info("Total schools processed: %d", df["SchoolName"].nunique() if "SchoolName" in df else 0)
-        logger.info("Total students extracted: %d", len(df))
-        logger.info("Birth year distribution:\n%s", df["BirthYear"].value_counts(dropna=True).to_string())
+        student_filter = load_filter(
+            args.filter_config, birth_years=args.birth_years, grades=args.grades,
+            school_numbers=args.school_numbers, cities=args.cities, postal_prefixes=args.postal_prefixes,
+        )
+        duplicates = None
+        if args.cohort_only:
+            df = None
+            counts = RunningCounts()
+            df_filtered = parse_students(args.input, student_filter, counts, metrics)
+            if counts.missing_birth_year:
+                # Type BirthYear as the full table would be, so outputs match a run without --cohort-only
+                df_filtered["BirthYear"] = df_filtered["BirthYear"].astype("float64")
+            if args.duplicates is not None:
+                # Only the cohort is held, so only the cohorts of each upload are compared
+                others = ((other, parse_students(other, student_filter, metrics=metrics)) for other in args.duplicates)
+                duplicates = find_upload_duplicates(df_filtered, args.input, others, args.duplicates_min_score,
+                                                    args.duplicates_max_block, metrics)
+                df_filtered = duplicates.annotate(df_filtered, str(args.input))
+            summaries = counts.summaries()
+            total_schools, total_students = len(counts.schools), counts.total
+            birth_years = counts.birth_year_counts()
+        else:
+            def load(path: Path) -> pd.DataFrame:
+                cache_dir = None if args.no_cache else (args.cache_dir or path.parent / DEFAULT_CACHE_DIRNAME)
+                return load_students(path, cache_dir, rebuild=args.rebuild_cache,
+                                     max_cache_bytes=args.cache_max_mb << 20, metrics=metrics)
+
+            df = load(args.input)
+            if args.duplicates is not None:
+                others = ((other, load(other)) for other in args.duplicates)
+                duplicates = find_upload_duplicates(df, args.input, others, args.duplicates_min_score,
+                                                    args.duplicates_max_block, metrics)
+                df = duplicates.annotate(df, str(args.input))
+            with stage(metrics, "summarize", len(df)):
+                summaries = summarize(df)
+            with stage(metrics, "filter", len(df)):
+                df_filtered = filter_students(df, student_filter)
+            total_schools = df["SchoolName"].nunique() if "SchoolName" in df else 0
+            total_students = len(df)
+            birth_years = df["BirthYear"].value_counts(dropna=True)
+
+        logger.info("Total schools processed: %d", total_schools)
+        logger.info("Total students extracted: %d", total_students)
+        logger.info("Birth year distribution:\n%s", birth_years.to_string())
         logger.info("Grade distribution:\n%s", summaries["grade_counts"].to_string(index=False))
-        logger.info("Total students born in 2012 and 2013: %d", len(df_filtered))
-        logger.info("Grade distribution for filtered students:\n%s", df_filtered["Grade"].value_counts(dropna=True).to_string())
-        logger.info("Schools with filtered students:\n%s", df_filtered["SchoolName"].unique())
-
-        export_outputs(df, df_filtered, summaries, args.output, excel=args.excel)
+        logger.info("Total students matching %s: %d", student_filter.describe(), len(df_filtered))
+        grade_distribution = df_filtered["Grade"].value_counts(dropna=True)
+        logger.info("Grade distribution for filtered students:\n%s", grade_distribution[grade_distribution > 0].to_string())
+        logger.info("Schools with filtered students:\n%s", df_filtered["SchoolName"].astype(object).unique())
+
+        with stage(metrics, "export", len(df_filtered) + (len(df) if df is not None else 0)):
+            export_outputs(df, df_filtered, summaries, args.output, excel=args.excel,
+                           duplicates=duplicates.report() if duplicates is not None else None,
+                           export_format=args.export_format, compression=args.compress)
+
+        if metrics is not None:
+            metrics.count("students", total_students)
+            metrics.count("schools", total_schools)
+            metrics.count("filtered students", len(df_filtered))
+            table = metrics.table()
+            logger.info("Timings:\n%s", table)
+            if args.metrics:
+                metrics.save(METRICS_FILE)
+                logger.info("Metrics saved to: %s", METRICS_FILE)
     except Exception as exc:
         logger.exception("Processing failed: %s", exc)
         return 1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, PROFILE_FILE)
+            logger.info("Profile saved to: %s (top functions in %s.txt)", PROFILE_FILE, PROFILE_FILE)
 
     return 0
 
@@ -1,46 +1,176 @@
-import xml.etree.ElementTree as ET
+#!/usr/bin/env python3
+"""
+Rename STIX files to the standard naming convention using their metadata.
+
+    {DATE}_{BOARDACRONYM}_{BOARDNUMBER}_{SCHOOLTYPE}_{DATASET}_{STAGE}.{EXT}
+
+Only the top of each file is read: parsing stops as soon as ns1:Metadata
+closes. The board acronym comes from data/board_acronyms.csv, or failing
+that from the initials of the board's name. Files and directories can be
+renamed in bulk; the whole plan is checked for collisions before anything
+is renamed, and --dry-run prints the plan without renaming.
+"""
+import argparse
+import csv
 import re
-import sys
-import xmltodict
-import os
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from lxml import etree
+
+from xml_input import iterparse, sniff_file
+
+NS1 = "{http://ontario.ca}"
+DEFAULT_ACRONYMS = Path(__file__).parent / "data" / "board_acronyms.csv"
+SCHOOL_TYPES = ("elementary", "secondary")
+BOARD_NUMBER_WIDTH = 5
+# Enough of a file to sniff the encoding of its ns1:Metadata
+HEADER_BYTES = 64 * 1024
+
+_NAME_STOPWORDS = {"of", "the", "and", "de", "du", "des"}
+
+
+@dataclass
+class RenamePlan:
+    """One file's rename, or the reason it cannot be renamed."""
+    source: Path
+    target: Optional[Path] = None
+    problem: Optional[str] = None
+
+
+def probe_metadata(path: Path) -> Dict[str, str]:
+    """
+    Return CreateDate, BoardNumber and BoardName from a file's ns1:Metadata.
+
+    The file is parsed incrementally and parsing stops at the end of
+    ns1:Metadata, so the cost does not depend on the file's size. Missing
+    fields are returned as "".
+    """
+    context = iterparse(path, sniff_file(path, HEADER_BYTES), events=("end",), tag=NS1 + "Metadata")
+    for _, metadata in context:
+        return {
+            "CreateDate": (metadata.findtext(NS1 + "CreateDate") or "").strip(),
+            "BoardNumber": (metadata.findtext(f"{NS1}SchoolBoard/{NS1}BoardNumber") or "").strip(),
+            "BoardName": (metadata.findtext(f"{NS1}SchoolBoard/{NS1}Name") or "").strip(),
+        }
+    raise ValueError("no ns1:Metadata element")
+
+
+@lru_cache(maxsize=None)
+def load_board_acronyms(path: Path = DEFAULT_ACRONYMS) -> Dict[str, str]:
+    """Load the board number -> acronym table."""
+    with open(path, newline="", encoding="utf-8") as f:
+        return {normalise_board_number(row["board_number"]): row["acronym"].strip().upper()
+                for row in csv.DictReader(f)}
+
+
+def normalise_board_number(value: str) -> str:
+    """Return the digits of a board number, zero-padded to BOARD_NUMBER_WIDTH."""
+    digits = re.sub(r"\D", "", value)
+    return digits.zfill(BOARD_NUMBER_WIDTH) if digits else ""
+
+
+def board_acronym(board_number: str, board_name: str, table: Dict[str, str]) -> str:
+    """
+    Return a board's acronym from the lookup table, or from its name's initials.
+
+    Words already in capitals are kept whole, so "Upper Canada DSB" gives
+    UCDSB as "Upper Canada District School Board" does.
+    """
+    if board_number in table:
+        return table[board_number]
+    words = re.findall(r"[A-Za-z]+", board_name)
+    return "".join(
+        word if word.isupper() and len(word) > 1 else word[0].upper()
+        for word in words
+        if word.lower() not in _NAME_STOPWORDS
+    )
+
+
+def standard_name(metadata: Dict[str, str], school_type: str, dataset: str = "enrollment",
+                  stage: str = "raw", ext: str = "xml", table: Optional[Dict[str, str]] = None) -> str:
+    """Build the standard file name from probed metadata. Raises ValueError if a component is missing."""
+    match = re.match(r"(\d{4})-(\d{2})-(\d{2})", metadata["CreateDate"])
+    # The convention falls back to the processing date when CreateDate is missing
+    create_date = "".join(match.groups()) if match else date.today().strftime("%Y%m%d")
+    board_number = normalise_board_number(metadata["BoardNumber"])
+    if not board_number:
+        raise ValueError("no BoardNumber in metadata")
+    acronym = board_acronym(board_number, metadata["BoardName"], load_board_acronyms() if table is None else table)
+    if not acronym:
+        raise ValueError(f"no acronym for board {board_number}; add it to {DEFAULT_ACRONYMS.name}")
+    return f"{create_date}_{acronym}_{board_number}_{school_type}_{dataset}_{stage}.{ext}"
 
-# Using the metadata, rename the file to our standard naming convention
 
-path = sys.argv[1]
-school_type = sys.argv[2]  # 'Elementary' or 'Secondary'
+def expand_inputs(paths: Sequence[Path]) -> List[Path]:
+    """Expand directories to the .xml files directly inside them."""
+    files: List[Path] = []
+    for path in paths:
+        files.extend(sorted(path.glob("*.xml")) if path.is_dir() else [path])
+    return files
 
-# Check for valid school type
-if school_type not in ['elementary', 'secondary']:
-    print("Error: school_type must be 'elementary' or 'secondary'")
-    sys.exit(1)
 
-tree = ET.parse(path)
-root = tree.getroot()
+def plan_renames(files: Sequence[Path], school_type: str, dataset: str = "enrollment",
+                 stage: str = "raw") -> List[RenamePlan]:
+    """
+    Work out each file's new name and flag collisions.
 
-with open(path, 'r', encoding='utf-8') as file:
-    dict_data = xmltodict.parse(file.read())
+    A target collides if two files map to it, or if it already exists and
+    is not the file being renamed. Colliding files are left out of the
+    rename rather than overwriting anything.
+    """
+    plans: List[RenamePlan] = []
+    for source in files:
+        try:
+            name = standard_name(probe_metadata(source), school_type, dataset, stage, source.suffix.lstrip(".") or "xml")
+            plans.append(RenamePlan(source, source.with_name(name)))
+        except (OSError, ValueError, etree.XMLSyntaxError) as exc:
+            plans.append(RenamePlan(source, problem=str(exc)))
 
-metadata = dict_data['ns1:SchoolUpload']['ns1:Metadata']
+    claimed: Dict[Path, List[RenamePlan]] = {}
+    for plan in plans:
+        if plan.target is not None:
+            claimed.setdefault(plan.target.resolve(), []).append(plan)
+    for target, claims in claimed.items():
+        if len(claims) > 1:
+            for plan in claims:
+                others = ", ".join(other.source.name for other in claims if other is not plan)
+                plan.problem = f"{plan.target.name} is also the new name of {others}"
+        elif target.exists() and target != claims[0].source.resolve():
+            claims[0].problem = f"{claims[0].target.name} already exists"
+    return plans
 
-print(metadata)
-create_date = metadata['ns1:CreateDate']
-board_number = metadata['ns1:SchoolBoard']['ns1:BoardNumber']
 
-# Format date as YYYYMMDD
-create_date_formatted = re.sub(r'(\d{4})-(\d{2})-(\d{2}).*', r'\1\2\3', create_date)
+def main() -> int:
+    p = argparse.ArgumentParser(description="Rename STIX files to the standard naming convention.")
+    p.add_argument("paths", nargs="+", type=Path, help="STIX XML files or directories of them")
+    p.add_argument("school_type", type=str.lower, choices=SCHOOL_TYPES, help="Level of the schools in the files")
+    p.add_argument("--dataset", default="enrollment", help="DATASET component of the new names")
+    p.add_argument("--stage", default="raw", help="STAGE component of the new names")
+    p.add_argument("--dry-run", action="store_true", help="Print the renames without renaming anything")
+    args = p.parse_args()
 
-new_filename = f"{create_date_formatted}_{board_number}_{school_type}_STIX.xml"
+    plans = plan_renames(expand_inputs(args.paths), args.school_type, args.dataset, args.stage)
+    failed = 0
+    for plan in plans:
+        if plan.problem:
+            failed += 1
+            print(f"SKIP {plan.source}: {plan.problem}")
+        elif plan.target == plan.source:
+            print(f"KEEP {plan.source}")
+        elif args.dry_run:
+            print(f"PLAN {plan.source} -> {plan.target.name}")
+        else:
+            plan.source.rename(plan.target)
+            print(f"RENAMED {plan.source} -> {plan.target.name}")
 
-print(f"Renaming file to: {new_filename}")
-os.rename(path, new_filename)
+    if failed:
+        print(f"{failed} of {len(plans)} files not renamed")
+    return 1 if failed else 0
 
-# Verify the rename
-if os.path.exists(new_filename):
-    print(f"File successfully renamed to: {new_filename}")
-else:
-    print("Error: File rename failed.")
 
-# Remove the old file if it still exists
-if os.path.exists(path):
-    os.remove(path)
-    print(f"Old file {path} removed.")
\ No newline at end of file
+if __name__ == "__main__":
+    raise SystemExit(main())
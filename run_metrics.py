@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing, memory and counters for a twig_stix or pull_info run.
+
+A RunMetrics collects wall time, CPU time and calls for each named stage,
+the process's peak RSS as each stage finishes, and free-form counters.
+Stages can be timed with a with-block, per call for functions run many
+times (such as cleaning rules), or as what remains of a block once the
+stages inside it are taken out. The result is a summary table for the
+log, or a JSON file.
+
+Peak RSS needs the resource module, so it is not reported on Windows.
+"""
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, ContextManager, Dict, Iterator, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Return the process's peak resident set size so far in MB, or None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+@dataclass
+class StageStats:
+    """Totals for one stage over every time it ran."""
+    calls: int = 0
+    items: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    # Process peak RSS when the stage last finished, and how much the stage raised it
+    peak_rss_mb: Optional[float] = None
+    rss_growth_mb: float = 0.0
+
+
+class RunMetrics:
+    """Stage timings and counters for one run, in the order stages were first reached."""
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Counter = Counter()
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0) -> Iterator[None]:
+        """Time the with-block as a run of the stage, along with its effect on peak RSS."""
+        stats = self.stages.setdefault(name, StageStats())
+        rss_before = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stats.wall_s += time.perf_counter() - wall
+            stats.cpu_s += time.process_time() - cpu
+            stats.calls += 1
+            stats.items += items
+            if rss_before is not None:
+                stats.peak_rss_mb = peak_rss_mb()
+                stats.rss_growth_mb += stats.peak_rss_mb - rss_before
+
+    def call(self, name: str, items: int, func: Callable[..., Any], *args: Any) -> Any:
+        """Call func(*args) as a run of the stage. Cheaper than stage(), as peak RSS is not read."""
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(*args)
+        finally:
+            stats.wall_s += time.perf_counter() - wall
+            stats.cpu_s += time.process_time() - cpu
+            stats.calls += 1
+            stats.items += items
+
+    @contextmanager
+    def remainder(self, name: str, *inner: str) -> Iterator[None]:
+        """
+        Time the with-block as the stage, less the time it spent in the inner stages.
+
+        For work too fine-grained to time directly, such as iterparse
+        producing the elements a loop then cleans and writes.
+        """
+        def spent() -> Tuple[float, float]:
+            timed = [self.stages[stage_name] for stage_name in inner if stage_name in self.stages]
+            return sum(stats.wall_s for stats in timed), sum(stats.cpu_s for stats in timed)
+
+        stats = self.stages.setdefault(name, StageStats())
+        inner_wall, inner_cpu = spent()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            inner_wall_after, inner_cpu_after = spent()
+            stats.wall_s += wall - (inner_wall_after - inner_wall)
+            stats.cpu_s += cpu - (inner_cpu_after - inner_cpu)
+            stats.calls += 1
+            stats.peak_rss_mb = peak_rss_mb()
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        """Add the stages and counters of another run's to_dict(), e.g. from a worker process."""
+        for name, other in data["stages"].items():
+            stats = self.stages.setdefault(name, StageStats())
+            stats.calls += other["calls"]
+            stats.items += other["items"]
+            stats.wall_s += other["wall_s"]
+            stats.cpu_s += other["cpu_s"]
+            stats.rss_growth_mb += other["rss_growth_mb"]
+            if other["peak_rss_mb"] is not None:
+                stats.peak_rss_mb = max(stats.peak_rss_mb or 0.0, other["peak_rss_mb"])
+        self.counters.update(data["counters"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "wall_s": time.perf_counter() - self._started,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": {name: asdict(stats) for name, stats in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def save(self, path: str) -> None:
+        """Write the metrics as JSON."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def table(self) -> str:
+        """Return the stages and counters as a text table."""
+        total = time.perf_counter() - self._started
+        width = max([len("Stage")] + [len(name) for name in self.stages])
+        lines = [f"{'Stage':<{width}}  {'Calls':>8}  {'Items':>9}  {'Wall (s)':>9}  {'CPU (s)':>8}  "
+                 f"{'Wall %':>6}  {'Peak RSS (MB)':>13}"]
+        for name, stats in self.stages.items():
+            rss = f"{stats.peak_rss_mb:.1f}" if stats.peak_rss_mb is not None else "-"
+            share = stats.wall_s / total if total else 0.0
+            lines.append(f"{name:<{width}}  {stats.calls:>8}  {stats.items:>9}  {stats.wall_s:>9.3f}  "
+                         f"{stats.cpu_s:>8.3f}  {share:>6.1%}  {rss:>13}")
+        lines.append(f"{'Total':<{width}}  {'':>8}  {'':>9}  {total:>9.3f}")
+        if self.counters:
+            lines.append("")
+            count_width = max(len(name) for name in self.counters)
+            lines.extend(f"{name:<{count_width}}  {count:>9}" for name, count in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+
+def stage(metrics: Optional[RunMetrics], name: str, items: int = 0) -> ContextManager[None]:
+    """Time a stage when metrics are being collected; otherwise do nothing."""
+    return metrics.stage(name, items) if metrics is not None else nullcontext()
+
+
+def save_profile(profiler: cProfile.Profile, path: str, limit: int = 40) -> None:
+    """Save profiler stats to path, for pstats or snakeviz, and the top functions by cumulative time to path.txt."""
+    profiler.dump_stats(path)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(limit)
+    with open(path + ".txt", "w", encoding="utf-8") as f:
+        f.write(report.getvalue())
@@ -0,0 +1,118 @@
+"""
+Validation of STIX files against an XSD, one top-level element at a time.
+
+The schema is compiled once per process and shared by every file cleaned
+in it. Each ns1:Metadata and ns1:School is validated on its own as soon as
+it is parsed, so validation works the same in the tree, streaming and
+sharded modes and never needs the whole document. Violations are counted
+per rule (the element and the kind of error), and only the first few of
+each rule are kept with their line and message, so a problem repeated on
+every student does not flood the report.
+"""
+import csv
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple
+
+from lxml import etree
+
+DEFAULT_SCHEMA = Path(__file__).parent / "data" / "stix_school_upload.xsd"
+# Violations of each rule kept with their line and message
+DEFAULT_MAX_PER_RULE = 20
+VIOLATION_FIELDS = ["line", "rule", "path", "message"]
+# Children of ns1:SchoolUpload declared globally in the schema
+TOP_LEVEL = ("Metadata", "School")
+
+
+@lru_cache(maxsize=None)
+def load_schema(path: str = str(DEFAULT_SCHEMA)) -> etree.XMLSchema:
+    """Compile an XSD, once per process."""
+    return etree.XMLSchema(etree.parse(path))
+
+
+class Violation(NamedTuple):
+    line: int
+    rule: str
+    path: str
+    message: str
+
+
+def _rule(error: etree._LogEntry) -> str:
+    """Name a validation error by its element and kind, e.g. OEN:cvc_pattern_valid."""
+    element = error.path.rpartition("/")[2].rpartition(":")[2].partition("[")[0]
+    return f"{element}:{error.type_name.removeprefix('SCHEMAV_').lower()}"
+
+
+class ValidationReport:
+    """Violations found in one file, counted per rule with the first max_per_rule of each kept."""
+
+    def __init__(self, schema: etree.XMLSchema, max_per_rule: int = DEFAULT_MAX_PER_RULE) -> None:
+        self.schema = schema
+        self.max_per_rule = max_per_rule
+        self.counts: Counter = Counter()
+        self.violations: List[Violation] = []
+        self.metadata_seen = False
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def add(self, violation: Violation) -> None:
+        self.counts[violation.rule] += 1
+        if self.counts[violation.rule] <= self.max_per_rule:
+            self.violations.append(violation)
+
+    def validate(self, elem: etree._Element, line_offset: int = 0) -> bool:
+        """
+        Validate a child of ns1:SchoolUpload and record its violations.
+
+        line_offset is added to line numbers, for an element parsed from a
+        shard cut from the original file. Returns whether it was valid.
+        """
+        local = etree.QName(elem).localname
+        if local not in TOP_LEVEL:
+            self.add(Violation(elem.sourceline + line_offset, f"{local}:unexpected", f"/{elem.prefix}:{local}",
+                               f"Element '{elem.tag}': This element is not expected in ns1:SchoolUpload."))
+            return False
+        if local == "Metadata":
+            self.metadata_seen = True
+        if self.schema.validate(elem):
+            return True
+        for error in self.schema.error_log:
+            self.add(Violation(error.line + line_offset, _rule(error), error.path, error.message))
+        return False
+
+    def finish(self) -> None:
+        """Record the checks that need the whole file, once every element has been validated."""
+        if not self.metadata_seen:
+            self.add(Violation(0, "Metadata:missing", "/ns1:Metadata", "The file has no ns1:Metadata element."))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"counts": dict(self.counts), "violations": [tuple(v) for v in self.violations],
+                "metadata_seen": self.metadata_seen}
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        """Add the violations of a later part of the file, from another report's to_dict()."""
+        kept = Counter(violation.rule for violation in self.violations)
+        for violation in map(Violation._make, data["violations"]):
+            if kept[violation.rule] < self.max_per_rule:
+                kept[violation.rule] += 1
+                self.violations.append(violation)
+        self.counts.update(data["counts"])
+        self.metadata_seen = self.metadata_seen or data["metadata_seen"]
+
+    def write(self, path: str) -> None:
+        """Write the kept violations as CSV, in document order."""
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(VIOLATION_FIELDS)
+            writer.writerows(sorted(self.violations, key=lambda violation: violation.line))
+
+    def summary(self) -> List[str]:
+        """One line per rule: its count and the line of its first violation."""
+        first = {}
+        for violation in self.violations:
+            first.setdefault(violation.rule, violation.line)
+        return [f"{rule}: {count} (first at line {first[rule]})"
+                for rule, count in sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))]
@@ -0,0 +1,209 @@
+"""
+Per-student state kept between cleaning runs of a board's uploads, for delta processing.
+
+For every student keyed by SchoolNumber and OEN, the state holds a digest
+of the raw ns1:Student subtree and, when it needed no manual review, its
+cleaned form. A new upload's students whose digest is unchanged can then
+reuse their cleaned form instead of being cleaned again. Each board's
+students are stored as numbered runs; a run replaces the previous one only
+once it finishes, so a failed run leaves the state as it was.
+"""
+import csv
+import hashlib
+import logging
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from lxml import etree
+
+logger = logging.getLogger("twig_stix.student_state")
+
+# Statuses in the delta report; unchanged students are only counted
+ADDED = "added"
+CHANGED = "changed"
+REMOVED = "removed"
+UNCHANGED = "unchanged"
+DELTA_FIELDS = ["school_number", "oen", "status"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS students (
+    board TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    school_number TEXT NOT NULL,
+    oen TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    -- freeze_student() of the cleaned ns1:Student, or NULL if it must be cleaned again
+    cleaned BLOB,
+    PRIMARY KEY (board, run, school_number, oen)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    board TEXT PRIMARY KEY,
+    run INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    source TEXT NOT NULL,
+    finished REAL NOT NULL
+);
+"""
+
+
+class StoredStudent(NamedTuple):
+    digest: bytes
+    cleaned: Optional[bytes]
+
+
+def student_digest(student: etree._Element) -> bytes:
+    """Return a digest of a raw ns1:Student subtree's serialisation."""
+    return hashlib.blake2b(etree.tostring(student, with_tail=False), digest_size=16).digest()
+
+
+def freeze_student(student: etree._Element) -> bytes:
+    """
+    Serialise a cleaned ns1:Student so thaw_students() gives back an identical element.
+
+    A rule that empties a value leaves text "" rather than None, which writes
+    as <ns1:Phone></ns1:Phone> but parses back as None. The positions of
+    those elements are kept on a first line ahead of the XML, and the whole
+    is compressed.
+    """
+    emptied = [str(position) for position, elem in enumerate(student.iter()) if elem.text == ""]
+    return zlib.compress(",".join(emptied).encode() + b"\n" + etree.tostring(student, with_tail=False), 1)
+
+
+def thaw_students(frozen: Sequence[bytes]) -> List[etree._Element]:
+    """Parse ns1:Student elements saved by freeze_student()."""
+    if not frozen:
+        return []
+    emptied, xml = zip(*(zlib.decompress(data).split(b"\n", 1) for data in frozen))
+    # One parse for a whole school's students is much cheaper than one each
+    students = list(etree.fromstring(b"<students>" + b"".join(xml) + b"</students>"))
+    for student, positions in zip(students, emptied):
+        if positions:
+            positions = {int(position) for position in positions.split(b",")}
+            for position, elem in enumerate(student.iter()):
+                if position in positions:
+                    elem.text = ""
+    return students
+
+
+class StudentState:
+    """
+    SQLite store of each board's students from its last finished run.
+
+    Call begin() with the board number before previous() and record(), then
+    finish() once the run succeeds or abort() if it fails. Cleaned forms
+    are only reused when the run that stored them used the same version of
+    the cleaning rules.
+    """
+
+    def __init__(self, path: str, version: str, source: str) -> None:
+        self.path = path
+        self.version = version
+        self.source = source
+        # Parallel runs on other boards' files share the state; wait for each other's writes
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(_SCHEMA)
+        self.board: Optional[str] = None
+        self.full_upload = True
+        self.previous_run: Optional[int] = None
+        self.run = 1
+        # Cleaned forms from the previous run are only reusable with the same rules
+        self.reusable = False
+
+    def begin(self, board: str, full_upload: bool = True) -> None:
+        """
+        Start a run for a board's upload.
+
+        A partial upload (ns1:FullUpload false) only holds the students that
+        changed, so when it finishes the students it does not mention are
+        carried forward rather than reported as removed.
+        """
+        self.board = board
+        self.full_upload = full_upload
+        row = self.conn.execute("SELECT run, version FROM runs WHERE board = ?", (board,)).fetchone()
+        if row is not None:
+            self.previous_run, previous_version = row
+            self.run = self.previous_run + 1
+            self.reusable = previous_version == self.version
+            if not self.reusable:
+                logger.info("Cleaning rules changed since the last run for board %s; every student is cleaned.", board)
+        # Rows of a run that failed before finishing
+        self.conn.execute("DELETE FROM students WHERE board = ? AND run = ?", (board, self.run))
+        self.conn.commit()
+
+    def previous(self, school_number: str) -> Dict[str, StoredStudent]:
+        """Return the previous run's students of a school by OEN."""
+        if self.previous_run is None:
+            return {}
+        return {
+            oen: StoredStudent(digest, cleaned if self.reusable else None)
+            for oen, digest, cleaned in self.conn.execute(
+                "SELECT oen, digest, cleaned FROM students WHERE board = ? AND run = ? AND school_number = ?",
+                (self.board, self.previous_run, school_number),
+            )
+        }
+
+    def record(self, school_number: str, students: Iterable[Tuple[str, bytes, Optional[bytes]]]) -> None:
+        """Add (OEN, digest, freeze_student() of the cleaned student or None) for a school's students to this run."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO students (board, run, school_number, oen, digest, cleaned) VALUES (?, ?, ?, ?, ?, ?)",
+            [(self.board, self.run, school_number, oen, digest, cleaned) for oen, digest, cleaned in students],
+        )
+        # Commit per school so parallel runs on other boards are not locked out for a whole file
+        self.conn.commit()
+
+    def finish(self) -> List[Tuple[str, str]]:
+        """Make this run the board's current state and return the (SchoolNumber, OEN) of removed students."""
+        removed: List[Tuple[str, str]] = []
+        if self.previous_run is not None:
+            missing = (
+                "FROM students AS old WHERE old.board = ? AND old.run = ? AND NOT EXISTS "
+                "(SELECT 1 FROM students AS new WHERE new.board = old.board AND new.run = ? "
+                "AND new.school_number = old.school_number AND new.oen = old.oen)"
+            )
+            params = (self.board, self.previous_run, self.run)
+            if self.full_upload:
+                removed = self.conn.execute(f"SELECT old.school_number, old.oen {missing}", params).fetchall()
+            else:
+                self.conn.execute(
+                    f"INSERT INTO students SELECT old.board, {self.run}, old.school_number, old.oen, old.digest, "
+                    f"old.cleaned {missing}", params)
+            self.conn.execute("DELETE FROM students WHERE board = ? AND run = ?", (self.board, self.previous_run))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO runs (board, run, version, source, finished) VALUES (?, ?, ?, ?, ?)",
+            (self.board, self.run, self.version, self.source, time.time()),
+        )
+        self.conn.commit()
+        return removed
+
+    def abort(self) -> None:
+        """Discard this run, keeping the previous state."""
+        self.conn.rollback()
+        if self.board is not None:
+            self.conn.execute("DELETE FROM students WHERE board = ? AND run = ?", (self.board, self.run))
+            self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class DeltaReport:
+    """CSV of the students added, changed and removed since the previous run, with counts of each status."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.counts: Counter = Counter()
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(DELTA_FIELDS)
+
+    def add(self, school_number: str, oen: str, status: str) -> None:
+        self.counts[status] += 1
+        if status != UNCHANGED:
+            self._writer.writerow((school_number, oen, status))
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
@@ -0,0 +1,158 @@
+"""
+Streaming export of pull_info's tables to CSV, Excel and Parquet.
+
+Every format is written a chunk of rows at a time, so memory is bounded by
+the chunk rather than the table and time grows linearly with rows:
+
+* CSV is written by DataFrame.to_csv a chunk at a time, into the same bytes
+  one to_csv(index=False, encoding="utf-8-sig") call writes, and optionally
+  compressed with gzip or zstd as it is written.
+* Excel goes through openpyxl's write-only workbook, which streams rows to
+  disk instead of keeping a cell object for every value.
+* Parquet is written a row group per chunk.
+
+CSV and Parquet files are written in parallel threads; zlib and Arrow
+release the GIL while they compress and write. Without pyarrow neither zstd
+nor Parquet is available.
+"""
+import codecs
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+FORMATS = ("csv", "excel", "parquet")
+COMPRESSIONS = ("gzip", "zstd")
+# Suffix added to a CSV file's name by each compression
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# gzip level for compressed CSV; higher levels are several times slower for little gain
+GZIP_LEVEL = 6
+# Rows formatted and written at a time
+CHUNK_ROWS = 100_000
+# Files written at once for CSV and Parquet
+EXPORT_THREADS = 4
+# Rows in an Excel sheet, including the header; longer tables continue on Name_2, Name_3, ...
+EXCEL_MAX_ROWS = 1_048_576
+# Number format of date cells, as DataFrame.to_excel writes them
+EXCEL_DATETIME_FORMAT = "YYYY-MM-DD HH:MM:SS"
+
+
+def arrow_available() -> bool:
+    """Return True if pyarrow, which writes Parquet and zstd-compressed CSV, is installed."""
+    try:
+        import pyarrow.compute  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _compressor(compression: Optional[str]) -> Callable[[bytes], Any]:
+    """Return a function compressing a chunk's bytes into a gzip member or zstd frame, or leaving them as they are."""
+    if compression is None:
+        return lambda data: data
+    if compression == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL)
+    if not arrow_available():
+        raise ValueError("zstd compression needs pyarrow")
+    import pyarrow as pa
+
+    return pa.Codec("zstd").compress
+
+
+def write_csv(df: pd.DataFrame, path: Path, compression: Optional[str] = None,
+              chunk_rows: int = CHUNK_ROWS) -> None:
+    """
+    Write df as DataFrame.to_csv(path, index=False, encoding="utf-8-sig") would, a chunk at a time.
+
+    Date and time columns are formatted for the whole table first, as
+    pandas picks their precision from a column's finest value and each
+    chunk would otherwise pick its own. With compression, each chunk is
+    compressed on its own, as a gzip member or zstd frame; readers of
+    either format read them as one stream.
+    """
+    compress = _compressor(compression)
+    dates = {column: df[column].astype(str).where(df[column].notna())
+             for column in df.columns if df[column].dtype.kind in "mM"}
+    with open(path, "wb") as f:
+        # An empty table still gets its header
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            if dates:
+                chunk = chunk.copy(deep=False)
+                for column, text in dates.items():
+                    chunk[column] = text.iloc[start:start + chunk_rows]
+            data = chunk.to_csv(index=False, header=start == 0).encode("utf-8")
+            f.write(compress(codecs.BOM_UTF8 + data if start == 0 else data))
+
+
+def write_parquet(df: pd.DataFrame, path: Path, chunk_rows: int = CHUNK_ROWS) -> None:
+    """Write df to a zstd-compressed Parquet file, a row group per chunk."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # One schema for every chunk, so a chunk whose values are all missing keeps its column's type
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(str(path), schema, compression="zstd") as writer:
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def _excel_values(values: pd.Series, sheet) -> List:
+    """Return a column as values for openpyxl, with None for missing values and dates formatted as to_excel does."""
+    from openpyxl.cell import WriteOnlyCell
+
+    objects = values.to_numpy(dtype=object, copy=True)
+    missing = pd.isna(objects)
+    objects[missing] = None
+    if values.dtype.kind == "M":
+        for position in np.flatnonzero(~missing):
+            cell = WriteOnlyCell(sheet, value=objects[position])
+            cell.number_format = EXCEL_DATETIME_FORMAT
+            objects[position] = cell
+    return objects.tolist()
+
+
+def write_excel(sheets: Dict[str, pd.DataFrame], path: Path, chunk_rows: int = CHUNK_ROWS) -> None:
+    """Write each DataFrame to its own sheet of a workbook, streaming rows through openpyxl's write-only mode."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    rows_per_sheet = EXCEL_MAX_ROWS - 1
+    for name, df in sheets.items():
+        for part, sheet_start in enumerate(range(0, max(len(df), 1), rows_per_sheet)):
+            sheet = workbook.create_sheet(name if part == 0 else f"{name}_{part + 1}")
+            sheet.append([str(column) for column in df.columns])
+            sheet_end = min(sheet_start + rows_per_sheet, len(df))
+            for start in range(sheet_start, sheet_end, chunk_rows):
+                chunk = df.iloc[start:min(start + chunk_rows, sheet_end)]
+                for row in zip(*(_excel_values(chunk[column], sheet) for column in chunk.columns)):
+                    sheet.append(row)
+    workbook.save(path)
+
+
+def export_tables(tables: Dict[str, pd.DataFrame], paths: Dict[str, Path], fmt: str = "csv",
+                  compression: Optional[str] = None, chunk_rows: int = CHUNK_ROWS,
+                  threads: int = EXPORT_THREADS) -> None:
+    """
+    Write each named table to its path in fmt, or, for Excel, every table to one workbook.
+
+    For Excel, paths holds the workbook under the key "workbook" and tables
+    are named by their sheet.
+    """
+    if fmt == "excel":
+        write_excel(tables, paths["workbook"], chunk_rows)
+        return
+    if fmt == "parquet" and not arrow_available():
+        raise ValueError("Parquet export needs pyarrow")
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(tables)))) as pool:
+        futures = [
+            pool.submit(write_parquet, df, paths[name], chunk_rows) if fmt == "parquet"
+            else pool.submit(write_csv, df, paths[name], compression, chunk_rows)
+            for name, df in tables.items()
+        ]
+        for future in futures:
+            future.result()
@@ -1,9 +1,85 @@
+import argparse
+import cProfile
+import csv
+import glob
+import hashlib
+import json
+import mmap
 import re
+import os
 import sys
-import xmltodict
 import logging
+from collections import Counter
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from lxml import etree
 
+from addresses import DEFAULT_ADDRESS_TERMS, STREET_TYPE, UNIT, TermMatch, load_address_terms
+from change_log import ChangeLog
+from correction_store import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_ENTRIES, CorrectionStore
+from phones import DEFAULT_AREA_CODES, clean_phone, diagnose_phones  # noqa: F401 (clean_phone re-exported)
+from postal_codes import check_regions, clean_postal_codes
+from run_metrics import RunMetrics, save_profile, stage
+from stix_schema import DEFAULT_MAX_PER_RULE, DEFAULT_SCHEMA, ValidationReport, load_schema
+from student_state import (ADDED, CHANGED, REMOVED, UNCHANGED, DeltaReport, StudentState, freeze_student,
+                           student_digest, thaw_students)
+from xml_input import Sniffed, iterparse, parse, repair, sniff_file
+
+logger = logging.getLogger("twig_stix")
+logger.setLevel(logging.INFO)
+# Each file gets its own log handler; keep messages out of the root logger
+logger.propagate = False
+
+NS = {"ns1": "http://ontario.ca"}
+
+# Columns of the manual review file written by --batch and read by --apply-corrections
+REVIEW_FIELDS = ["sourceline", "school_number", "student_key", "field", "value",
+                 "street_number", "street_name", "correction", "street_name_correction"]
+# A correction of this value clears the field instead of leaving it unchanged
+CLEAR_VALUE = "-"
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+# Target size of the runs of schools cleaned by each worker with --shard
+SHARD_BYTES = 8 * 1024 * 1024
+# Version of the cleaning rules' code; bump it whenever a rule changes what it
+# writes, so students cleaned by older rules are not reused by --delta
+RULES_CODE_VERSION = "2"
+# Data files the rules read; editing one changes the rules' output as well
+RULES_DATA_FILES = (DEFAULT_ADDRESS_TERMS, DEFAULT_AREA_CODES)
+
+
+def rules_version() -> str:
+    """Return the version saved with --delta: the rules' code version and a hash of their data files."""
+    digest = hashlib.sha256()
+    for path in RULES_DATA_FILES:
+        digest.update(path.read_bytes())
+    return f"{RULES_CODE_VERSION}-{digest.hexdigest()[:16]}"
+
+
+RULES_VERSION = rules_version()
+
+# Phone elements cleaned by clean_phone_rule
+PHONE_TAGS = ("Phone", "HomePhone", "WorkPhone", "CellPhone", "EmergencyPhone")
+STREET_NUMBER_TAG = f"{{{NS['ns1']}}}StreetNumber"
+STREET_NAME_TAG = f"{{{NS['ns1']}}}StreetName"
+CITY_TAG = f"{{{NS['ns1']}}}City"
+PROVINCE_TAG = f"{{{NS['ns1']}}}Province"
+STUDENT_TAG = f"{{{NS['ns1']}}}Student"
+# Elements named like a phone, in any namespace, as the original script cleaned them;
+# those not in PHONE_TAGS are found with this and cleaned as phones too
+OTHER_PHONES = etree.XPath(".//*[contains(local-name(), 'Phone')]")
+# Key in CleanContext.fixes of each field the rules change
+FIX_KEYS = {**{tag: "phone" for tag in PHONE_TAGS}, "PostalCode": "postal_code",
+            "StreetNumber": "street_number", "StreetName": "street_name", "Unit": "unit",
+            "StreetType": "street_type"}
+
+UNIT_BRACKETS = re.compile(r'.*\(.*\).*')
+UNIT_BRACKET_CHARS = re.compile(r'[\(\)]')
+UNIT_PREFIX = re.compile(r'unit \d+')
+UNIT_WORD = re.compile(r'unit')
+
 def rename_file(metadata, school_type):
     if school_type not in ['elementary', 'secondary']:
         print("Error: school_type must be 'elementary' or 'secondary'")
@@ -21,238 +97,1191 @@ def rename_file(metadata, school_type):
 
 
 
-def clean_phone(text: str) -> str:
-    digits = re.sub(r"\D", "", text)
-    if digits.startswith("1") and len(digits) > 10:
-        digits = digits[1:]
+def survey_schools(root: etree._Element, ns=NS) -> Tuple[int, Dict[str, List[etree._Element]]]:
+    """
+    Count students and find empty schools in a single walk over the schools.
 
-    # then readd hyphenated format
-    if len(digits) < 10:
-        logging.warning(f"Phone number '{text}' has less than 10 digits. Setting to empty.")
-        return ""
-    
-    elif len(digits) > 10:
-        # Check for x and 3 digits after with regex
-        if not re.match(r'.*x\d{1,4}$', text):
-            logging.warning(f"Phone number '{text}' has more than 10 digits and no valid extension. Truncating to 10 digits.")
-            digits = digits[:10]
+    Returns the total number of students and an index of SchoolNumber to the
+    School elements that hold no ns1:Student.
+    """
+    total_students = 0
+    empty_schools: Dict[str, List[etree._Element]] = {}
+    for school in root.iterfind("ns1:School", ns):
+        student_count = len(school.findall("ns1:Students/ns1:Student", ns))
+        if student_count:
+            total_students += student_count
+            continue
+        school_number = school.findtext("ns1:SchoolNumber", None, ns)
+        logger.info(f"Record {school_number or 'Unknown'} has no students.")
+        empty_schools.setdefault(school_number, []).append(school)
+    return total_students, empty_schools
+
+
+def remove_school_by_number(school_number: Optional[str], index: Dict[str, List[etree._Element]]) -> None:
+    """Remove the schools indexed under school_number from their parent."""
+    logger.info(f"Removing school with number: {school_number}")
+    for school in index.pop(school_number, []):
+        logger.info(f"Found and removing school with number: {school_number}")
+        school.getparent().remove(school)
+
+
+def record_context(elem: etree._Element, ns=NS) -> Tuple[str, str]:
+    """
+    Return the SchoolNumber and student key of the record holding elem.
+
+    The student key is the OEN, or the 1-based position of the student within
+    its school when the OEN is missing. Both survive cleaning unchanged, so
+    they identify the same record in the raw and cleaned files.
+    """
+    school_number = ""
+    student_key = ""
+    school_tag = f"{{{ns['ns1']}}}School"
+    for ancestor in elem.iterancestors(f"{{{ns['ns1']}}}Student", school_tag):
+        if ancestor.tag == school_tag:
+            school_number = ancestor.findtext("ns1:SchoolNumber", "", ns)
+            break
+        if not student_key:
+            student_key = ancestor.findtext("ns1:OEN", "", ns) or f"#{ancestor.getparent().index(ancestor) + 1}"
+    return school_number, student_key
+
+
+@dataclass
+class CleanContext:
+    """State shared by the cleaning rules during one run."""
+    # When a list, values needing a manual decision are queued here instead of prompting
+    review: Optional[List[Dict[str, str]]] = None
+    # Stored manual decisions, consulted before prompting and updated with new answers
+    store: Optional[CorrectionStore] = None
+    # Number of values changed, per field
+    fixes: Counter = field(default_factory=Counter)
+    # Added to parsed line numbers when cleaning a shard cut from the original file
+    line_offset: int = 0
+    # Receives a change_log record per change or flag: a ChangeLog, or a list in shard workers
+    changes: Optional[Any] = None
+    # Number of changes and flags, per rule
+    rule_counts: Counter = field(default_factory=Counter)
+    # record_context of each Student element seen by the subtree being cleaned
+    record_keys: Dict[etree._Element, Tuple[str, str]] = field(default_factory=dict)
+    # Per-stage and per-rule timings, collected with --timings
+    metrics: Optional[RunMetrics] = None
+    # With --delta, the students of the previous run, and the report of what changed since
+    state: Optional[StudentState] = None
+    delta: Optional[DeltaReport] = None
+    # Schema violations of each top-level element, found before it is cleaned
+    validation: Optional[ValidationReport] = None
+
+    def sourceline(self, elem: etree._Element) -> int:
+        """Return the line of elem in the original file."""
+        return elem.sourceline + self.line_offset
+
+    def change(self, elem: etree._Element, old: Optional[str], new: Optional[str], rule_name: str) -> None:
+        """Record that a rule changed elem's value from old to new, counting it as a fix of its field."""
+        local = etree.QName(elem).localname
+        # Fields not listed are phone-like tags outside PHONE_TAGS
+        self.fixes[FIX_KEYS.get(local, "phone")] += 1
+        self._record(elem, local, old, new, rule_name, "")
+
+    def flag(self, elem: etree._Element, rule_name: str, note: str = "") -> None:
+        """Record a finding about elem's value that leaves it unchanged."""
+        self._record(elem, etree.QName(elem).localname, elem.text, elem.text, rule_name, note)
+
+    def record_context(self, elem: etree._Element) -> Tuple[str, str]:
+        """Return record_context(elem), looked up once per student while its subtree is cleaned."""
+        student = next(elem.iterancestors(STUDENT_TAG), None)
+        if student is None:
+            return record_context(elem)
+        keys = self.record_keys.get(student)
+        if keys is None:
+            keys = self.record_keys[student] = record_context(elem)
+        return keys
+
+    def _record(self, elem: etree._Element, local: str, old: Optional[str], new: Optional[str],
+                rule_name: str, note: str) -> None:
+        self.rule_counts[rule_name] += 1
+        if self.changes is not None:
+            school_number, student_key = self.record_context(elem)
+            self.changes.append((self.sourceline(elem), school_number, student_key, local, old, new, rule_name, note))
+
+
+def queue_review(ctx: CleanContext, elem: etree._Element, field: str,
+                 street_number: Optional[str], street_name: Optional[str]) -> None:
+    """Add an element that needs a manual decision to the review queue."""
+    school_number, student_key = ctx.record_context(elem)
+    ctx.review.append({
+        "sourceline": str(ctx.sourceline(elem)),
+        "school_number": school_number,
+        "student_key": student_key,
+        "field": field,
+        "value": elem.text or "",
+        "street_number": street_number or "",
+        "street_name": street_name or "",
+        "correction": "",
+        "street_name_correction": "",
+    })
+
+
+Rule = Callable[[etree._Element, CleanContext], None]
+BatchRule = Callable[[List[etree._Element], CleanContext], None]
+
+# Cleaning rules keyed on the exact namespaced tag they apply to. A rule is
+# either run on each element as it is reached, or marked as a batch rule and
+# run once per subtree on all of its matching elements.
+RULES: Dict[str, List[Callable]] = {}
+BATCH_RULES = set()
+# Phone-like tags outside PHONE_TAGS already reported in this process
+_unlisted_phone_tags = set()
+
+
+def rule(*localnames: str, batch: bool = False) -> Callable[[Callable], Callable]:
+    """Register a cleaning rule, or a batch rule, for elements with the given ns1 localnames."""
+    def register(func: Callable) -> Callable:
+        for localname in localnames:
+            RULES.setdefault(f"{{{NS['ns1']}}}{localname}", []).append(func)
+        if batch:
+            BATCH_RULES.add(func)
+        return func
+    return register
+
+
+def clean_subtree(root: etree._Element, ctx: CleanContext) -> None:
+    """Run every registered rule over the matching elements under root, in document order."""
+    batches: Dict[BatchRule, List[etree._Element]] = {}
+    metrics = ctx.metrics
+    # Filtering on the registered tags happens inside lxml, so elements
+    # without a rule never reach Python
+    for elem in root.iter(*RULES):
+        for func in RULES[elem.tag]:
+            if func in BATCH_RULES:
+                batches.setdefault(func, []).append(elem)
+            elif metrics is None:
+                func(elem, ctx)
+            else:
+                metrics.call(f"rule:{func.__name__}", 1, func, elem, ctx)
+    for elem in OTHER_PHONES(root):
+        if elem.tag not in RULES:
+            if elem.tag not in _unlisted_phone_tags:
+                _unlisted_phone_tags.add(elem.tag)
+                logger.info(f"Cleaning {elem.tag} as a phone number; add it to PHONE_TAGS if it is one.")
+            batches.setdefault(clean_phone_rule, []).append(elem)
+    for func, elems in batches.items():
+        if metrics is None:
+            func(elems, ctx)
         else:
-            digits = digits[:3] + '-' + digits[3:6] + '-' + digits[6:10] + 'x' +  digits[10:]
-    if len(digits) == 10:
-        digits = digits[:3] + '-' + digits[3:6] + '-' + digits[6:10]
-
-        # Check for valid area codes (just a few common ones for Ontario)
-        # FIXME get list of valid area codes
-        invalid_area_codes = ['163','081']
-
-        if digits.startswith(tuple(invalid_area_codes)):
-            logging.warning(f"Phone number '{text}' has invalid area code. Setting to empty.")
-            return ""
-        
-        if digits == '519-000-0000':
-            logging.warning(f"Phone number '{text}' is all zeros. Setting to empty.")
-            return ""
-
-    # Allow extensions
-    return digits
-
-def check_metadata_schema(record):
-    # Check for missing required fields
-    required_fields = ['ns1:CreateDate', 'ns1:CreateTime', 
-                    'ns1:CreatedBy', 'ns1:ContactNumber', 
-                    'ns1:ContactEmail', 
-                    'ns1:FullUpload', 'ns1:SchoolBoard',
-                    'ns1:BoardNumber', 'ns1:Name']
-    for field in required_fields:
-        if field not in record:
-            logging.warning(f"Record {record.get('ns1:SchoolNumber', 'Unknown')} is missing required fields: {', '.join(required_fields)}")
-            record[field] = ""  # Add empty field if missing
-    return record
-
-def remove_school_by_number(school_number, root, ns):
-    logging.info(f"Removing school with number: {school_number}")
-    for school in root.findall(".//ns1:School", ns):
-        school_number = school.find("ns1:SchoolNumber", ns)
-        if school_number is not None and school_number.text == school_number: 
-            logging.info(f"Found and removing school with number: {school_number}")
-            root.remove(school)
-    
-    return root
+            metrics.call(f"rule:{func.__name__}", len(elems), func, elems, ctx)
+    # Keys are only reused within a subtree; dropping them lets streamed schools be freed
+    ctx.record_keys.clear()
+
+
+@rule(*PHONE_TAGS, batch=True)
+def clean_phone_rule(elems: List[etree._Element], ctx: CleanContext) -> None:
+    """Reformat phone numbers and blank the ones that cannot be cleaned, in one vectorized pass."""
+    elems = [elem for elem in elems if elem.text]
+    cleaned_phones, reasons = diagnose_phones([elem.text for elem in elems])
+    for elem, cleaned_phone, reason in zip(elems, cleaned_phones, reasons):
+        if cleaned_phone != elem.text:
+            ctx.change(elem, elem.text, cleaned_phone, f"phone:{reason}")
+            elem.text = cleaned_phone
+
+
+@rule("PostalCode", batch=True)
+def clean_postal_code_rule(elems: List[etree._Element], ctx: CleanContext) -> None:
+    """Normalise postal codes in one batch, discard invalid ones and cross-check the rest against City/Province."""
+    elems = [elem for elem in elems if elem.text]
+    for elem, cleaned_code in zip(elems, clean_postal_codes([elem.text for elem in elems])):
+        if cleaned_code != elem.text:
+            ctx.change(elem, elem.text, cleaned_code, "postal_code:format" if cleaned_code else "postal_code:invalid")
+            elem.text = cleaned_code
+
+    elems = [elem for elem in elems if elem.text]
+    parents = [elem.getparent() for elem in elems]
+    problems = check_regions(
+        [elem.text for elem in elems],
+        [parent.findtext(PROVINCE_TAG) for parent in parents],
+        [parent.findtext(CITY_TAG) for parent in parents],
+    )
+    for elem, problem in zip(elems, problems):
+        if problem:
+            ctx.flag(elem, "postal_code:region_mismatch", problem)
+
+
+@rule("StreetNumber")
+def clean_street_number_rule(elem: etree._Element, ctx: CleanContext) -> None:
+    """Resolve street numbers longer than 6 characters from the store, the review queue or a prompt."""
+    street_number = elem.text
+    if not street_number or len(street_number) <= 6:
+        return
+
+    parent = elem.getparent()
+    street_name_elem = parent.find(STREET_NAME_TAG) if parent is not None else None
+    street_name = street_name_elem.text if street_name_elem is not None else None
+
+    store = ctx.store
+    stored_number = store.get("StreetNumber", street_number, street_name) if store is not None else None
+    if stored_number is not None:
+        ctx.change(elem, street_number, stored_number, "street_number:stored")
+        elem.text = stored_number
+        stored_name = store.get("StreetName", street_name, street_number) if street_name_elem is not None else None
+        if stored_name is not None:
+            ctx.change(street_name_elem, street_name, stored_name, "street_name:stored")
+            street_name_elem.text = stored_name
+        return
+
+    if ctx.review is not None:
+        ctx.flag(elem, "street_number:review", "exceeds maximum length of 6")
+        queue_review(ctx, elem, "StreetNumber", street_number, street_name)
+        return
+
+    # Ask user to input a corrected street number
+    new_street_number = input(f"Please enter a corrected street number for '{street_number}'"
+                              f"\nStreet Name:{street_name} (or press Enter to skip): "
+                             ).strip()
+    # Ask user whether to update the street name as well
+    new_street_name = None
+    if street_name:
+        update_name = input(f"Do you want to update the street name '{street_name}' as well? (y/n): ").strip().lower()
+        if update_name == 'y':
+            new_street_name = input(f"Please enter the corrected street name for '{street_name}': ").strip()
+
+    if new_street_number:
+        ctx.change(elem, street_number, new_street_number, "street_number:manual")
+        elem.text = new_street_number
+        if store is not None:
+            store.put("StreetNumber", street_number, new_street_number, street_name)
+    if new_street_name and street_name_elem is not None:
+        ctx.change(street_name_elem, street_name, new_street_name, "street_name:manual")
+        street_name_elem.text = new_street_name
+        if store is not None:
+            store.put("StreetName", street_name, new_street_name, street_number)
+
+
+def address_context(elem: etree._Element) -> Tuple[Optional[str], Optional[str]]:
+    """Return the street number and street name of the address holding elem, for review and prompts."""
+    parent = elem.getparent()
+    if parent is None:
+        return None, None
+    return parent.findtext(STREET_NUMBER_TAG), parent.findtext(STREET_NAME_TAG)
+
+
+def suggestion_note(note: str, match: Optional[TermMatch]) -> str:
+    """Add a low-confidence dictionary match to a review note."""
+    if match is None:
+        return note
+    return f"{note}; closest known: {match.canonical} ('{match.variant}', distance {match.distance})"
+
+
+@rule("Unit")
+def clean_unit_rule(elem: etree._Element, ctx: CleanContext) -> None:
+    """
+    Standardize units longer than 5 characters.
+
+    Known designators come from data/address_terms.csv. Units are then
+    unbracketed or stripped of a "unit" prefix, or resolved from the store,
+    and only then matched fuzzily; a unit with no confident match goes to
+    the review queue or a prompt.
+    """
+    original_unit = elem.text.lower() if elem.text else None
+    if not original_unit or len(original_unit) <= 5:
+        return
+
+    match = load_address_terms()[UNIT].lookup(original_unit)
+    if match is not None and match.distance == 0:
+        ctx.change(elem, elem.text, match.canonical, "unit:standard")
+        elem.text = match.canonical
+        return
+
+    #look for brackets anywhere in the string and remove them
+    if UNIT_BRACKETS.match(elem.text):
+        new_unit = UNIT_BRACKET_CHARS.sub('', elem.text)
+        ctx.change(elem, elem.text, new_unit, "unit:brackets")
+        elem.text = new_unit
+        return
+
+    if UNIT_PREFIX.match(original_unit):
+        # remove 'unit ' and keep the number
+        new_unit = UNIT_WORD.sub('', original_unit).strip()
+        ctx.change(elem, elem.text, new_unit, "unit:prefix")
+        elem.text = new_unit
+        return
+
+    store = ctx.store
+    stored_unit = store.get("Unit", original_unit) if store is not None else None
+    if stored_unit is not None:
+        ctx.change(elem, elem.text, stored_unit, "unit:stored")
+        elem.text = stored_unit
+        return
+
+    if match is not None and match.confident:
+        ctx.change(elem, elem.text, match.canonical, "unit:fuzzy")
+        elem.text = match.canonical
+        return
+
+    # Cannot standardize - flag for manual review
+    street_number, street_name = address_context(elem)
+    if ctx.review is not None:
+        ctx.flag(elem, "unit:review", suggestion_note("could not be standardized", match))
+        queue_review(ctx, elem, "Unit", street_number, street_name)
+        return
+
+    # Ask user to input a corrected unit, with the address for context.
+    # If user pressed enter then replace with empty
+    hint = f" (closest known: {match.canonical})" if match is not None else ""
+    new_unit = input(
+        f"Please enter a corrected unit for '{original_unit}'{hint} (or press Enter to skip): "
+        f"\nContext: Street Number: {street_number}, Street Name: {street_name}: "
+    ).strip()
+    print(new_unit)
+    ctx.change(elem, elem.text, new_unit, "unit:manual")
+    elem.text = new_unit
+    # A blank answer clears this unit only; stored, it would clear the value in every later file
+    if store is not None and new_unit:
+        store.put("Unit", original_unit, new_unit)
+
+
+@rule("StreetType")
+def clean_street_type_rule(elem: etree._Element, ctx: CleanContext) -> None:
+    """
+    Standardize street types to their Canada Post symbol (AVE, CRES, ...).
+
+    Known spellings come from data/address_terms.csv. Other values are
+    resolved from the store or matched fuzzily. Values with only a
+    low-confidence match go to the review queue or a prompt, and values
+    close to no known street type are flagged and left as they are.
+    """
+    street_type = elem.text
+    if not street_type or not street_type.strip():
+        return
+
+    match = load_address_terms()[STREET_TYPE].lookup(street_type)
+    if match is not None and match.distance == 0:
+        if match.canonical != street_type:
+            ctx.change(elem, street_type, match.canonical, "street_type:standard")
+            elem.text = match.canonical
+        return
+
+    store = ctx.store
+    stored_type = store.get("StreetType", street_type) if store is not None else None
+    if stored_type is not None:
+        ctx.change(elem, street_type, stored_type, "street_type:stored")
+        elem.text = stored_type
+        return
+
+    if match is None:
+        ctx.flag(elem, "street_type:unknown", "no known street type is close")
+        return
+    if match.confident:
+        ctx.change(elem, street_type, match.canonical, "street_type:fuzzy")
+        elem.text = match.canonical
+        return
+
+    street_number, street_name = address_context(elem)
+    if ctx.review is not None:
+        ctx.flag(elem, "street_type:review", suggestion_note("not a known street type", match))
+        queue_review(ctx, elem, "StreetType", street_number, street_name)
+        return
+
+    new_type = input(
+        f"Please enter a corrected street type for '{street_type}' (closest known: {match.canonical}, "
+        f"or press Enter to skip): \nContext: Street Number: {street_number}, Street Name: {street_name}: "
+    ).strip()
+    if new_type:
+        ctx.change(elem, street_type, new_type, "street_type:manual")
+        elem.text = new_type
+        if store is not None:
+            store.put("StreetType", street_type, new_type)
+
+
+def sniff_input(path: str) -> Sniffed:
+    """Sniff a STIX file's encoding, warning when it does not match the file's declaration."""
+    sniffed = sniff_file(path)
+    if sniffed.mislabelled:
+        logger.warning(f"{path} {sniffed.describe()}.")
+    return sniffed
+
+
+def clean_tree(path: str, clean_path: str, ctx: Optional[CleanContext] = None) -> int:
+    """Clean a STIX file by loading the whole document into memory and return the number of students."""
+    ctx = ctx or CleanContext()
+    with stage(ctx.metrics, "parse"):
+        tree = parse(path, sniff_input(path), remove_blank_text=True)
+        root = tree.getroot()
+
+    # Validate each top-level element against the schema
+    if ctx.validation is not None:
+        with stage(ctx.metrics, "validate"):
+            for elem in root:
+                ctx.validation.validate(elem)
+
+    # Count students and remove empty schools from the same walk
+    with stage(ctx.metrics, "empty schools"):
+        total_students, empty_schools = survey_schools(root)
+        for school_number in list(empty_schools):
+            remove_school_by_number(school_number, empty_schools)
+
+    logger.info(f"Total students to process: {total_students}")
+
+    # Run the cleaning rules over the whole document
+    with stage(ctx.metrics, "clean", total_students):
+        clean_subtree(root, ctx)
+
+    with stage(ctx.metrics, "write"):
+        tree.write(clean_path, xml_declaration=True, encoding="utf-8", pretty_print=True)
+    return total_students
+
+
+def clean_top_level(elem: etree._Element, ctx: CleanContext) -> Optional[int]:
+    """
+    Clean one child of the root element.
+
+    Returns the number of students it holds, or None for an empty school that
+    should be dropped from the output.
+    """
+    student_count = 0
+    local = etree.QName(elem).localname
+    if ctx.validation is not None:
+        with stage(ctx.metrics, "validate"):
+            ctx.validation.validate(elem, ctx.line_offset)
+    if local == "Metadata":
+        if ctx.state is not None:
+            full_upload = elem.findtext("ns1:FullUpload", "true", NS).strip().lower() != "false"
+            ctx.state.begin(elem.findtext("ns1:SchoolBoard/ns1:BoardNumber", "", NS).strip(), full_upload)
+    elif local == "School":
+        with stage(ctx.metrics, "empty schools"):
+            school_number = elem.findtext("ns1:SchoolNumber", None, NS)
+            student_count = len(elem.findall("ns1:Students/ns1:Student", NS))
+        if not student_count:
+            logger.info(f"Record {school_number or 'Unknown'} has no students.")
+            logger.info(f"Removing school with number: {school_number}")
+            return None
+        if ctx.state is not None:
+            clean_school_delta(elem, ctx)
+            return student_count
+
+    with stage(ctx.metrics, "clean", student_count):
+        clean_subtree(elem, ctx)
+    return student_count
+
+
+def clean_school_delta(school: etree._Element, ctx: CleanContext) -> None:
+    """
+    Clean the students of a school that are new or changed since the previous run.
 
-path = sys.argv[1]
-logfile = path.replace('.xml','.log')
+    Each student is looked up in the previous run by SchoolNumber and OEN. A
+    student whose raw subtree is unchanged gets its stored cleaned form back
+    instead of being cleaned again. The rest are cleaned, and saved for the
+    next run unless they needed a manual decision, so they are cleaned again
+    until a stored correction resolves them. Students without an OEN, or
+    sharing one, are always cleaned and never saved.
+    """
+    state, delta = ctx.state, ctx.delta
+    if state.board is None:
+        # No ns1:Metadata before the first school
+        state.begin("")
+    school_number = school.findtext("ns1:SchoolNumber", "", NS)
+    previous = state.previous(school_number)
+    # OEN -> (element, digest) of the students cleaned this run, and the students reused
+    cleaned: Dict[str, Tuple[etree._Element, bytes]] = {}
+    reused: List[Tuple[etree._Element, str, bytes, bytes]] = []
+    seen = set()
+    with stage(ctx.metrics, "delta"):
+        for student in school.iterfind("ns1:Students/ns1:Student", NS):
+            oen = student.findtext("ns1:OEN", "", NS)
+            if not oen or oen in seen:
+                cleaned.pop(oen, None)
+                continue
+            seen.add(oen)
+            digest = student_digest(student)
+            stored = previous.get(oen)
+            if stored is None:
+                delta.add(school_number, oen, ADDED)
+            elif stored.digest != digest:
+                delta.add(school_number, oen, CHANGED)
+            else:
+                delta.add(school_number, oen, UNCHANGED)
+                if stored.cleaned is not None:
+                    reused.append((student, oen, digest, stored.cleaned))
+                    continue
+            cleaned[oen] = (student, digest)
+        # Stand-ins keep the other students' positions, which record_context uses for students without an OEN
+        stand_ins = []
+        for student, _, _, _ in reused:
+            stand_in = etree.Element("reused")
+            student.getparent().replace(student, stand_in)
+            stand_ins.append(stand_in)
 
-parser = etree.XMLParser(remove_blank_text=True)
-tree = etree.parse(path, parser)
-root = tree.getroot()
+    review_start = len(ctx.review) if ctx.review is not None else 0
+    with stage(ctx.metrics, "clean", len(cleaned)):
+        clean_subtree(school, ctx)
 
-with open(path, 'r', encoding='windows-1252') as file:
-    dict_data = xmltodict.parse(file.read())
+    with stage(ctx.metrics, "delta"):
+        for stand_in, student in zip(stand_ins, thaw_students([stored for _, _, _, stored in reused])):
+            stand_in.getparent().replace(stand_in, student)
+        pending = {item["student_key"] for item in (ctx.review or ())[review_start:]
+                   if item["school_number"] == school_number}
+        rows = [(oen, digest, stored_cleaned) for _, oen, digest, stored_cleaned in reused]
+        rows.extend((oen, digest, None if oen in pending else freeze_student(student))
+                    for oen, (student, digest) in cleaned.items())
+        state.record(school_number, rows)
+    if ctx.metrics is not None:
+        ctx.metrics.count("reused students", len(reused))
 
-logging.basicConfig(level=logging.INFO, filename=logfile, filemode='w',)
 
-# Check metadata schema
-dict_data['ns1:Metadata'] = check_metadata_schema(dict_data.get('ns1:Metadata', {}))
+def root_tags(root: etree._Element) -> Tuple[bytes, bytes, bytes]:
+    """
+    Return what a pretty-printed write of root puts around its children.
 
-# Start by calculating the total number of entries
-records = dict_data['ns1:SchoolUpload']['ns1:School']
-ns = {"ns1": "http://ontario.ca"}
-total_students = 0
-school_records_to_remove = []
-for record in records:
+    That is the start tag line, the end tag line, and the whole element for
+    when every child has been removed.
+    """
+    shell = etree.Element(root.tag, root.attrib, nsmap=root.nsmap)
+    empty = etree.tostring(shell, encoding="utf-8", xml_declaration=False, pretty_print=True)
+    etree.SubElement(shell, "placeholder")
+    data = etree.tostring(shell, encoding="utf-8", xml_declaration=False, pretty_print=True)
+    return data[:data.index(b">") + 2], data[data.rindex(b"</"):], empty
+
+
+def serialise_child(elem: etree._Element, root: etree._Element) -> bytes:
+    """Serialise a child of root exactly as a pretty-printed write of the whole tree would."""
+    # Serialise the child inside an empty copy of the root so namespace
+    # declarations and indentation match a whole-tree write exactly
+    shell = etree.Element(root.tag, root.attrib, nsmap=root.nsmap)
+    shell.append(elem)
+    data = etree.tostring(shell, encoding="utf-8", xml_declaration=False, pretty_print=True)
+    return data[data.index(b">") + 2:data.rindex(b"</")]
+
+
+def clean_stream(path: str, clean_path: str, ctx: Optional[CleanContext] = None) -> int:
+    """
+    Clean a STIX file one top-level element at a time.
+
+    Each ns1:Metadata and ns1:School subtree is cleaned as soon as its end tag
+    is parsed, written straight to the output and released, so peak memory is
+    bounded by the largest school rather than the whole file. The output is
+    byte-for-byte identical to clean_tree. Returns the number of students.
+    """
+    ctx = ctx or CleanContext()
+    context = iterparse(path, sniff_input(path), events=("end",), remove_blank_text=True)
+    root = None
+    tags = None
+    total_students = 0
+
+    # Parsing is interleaved with the other stages, so it gets whatever time they do not account for
+    parse_stage = (ctx.metrics.remainder("parse", "validate", "empty schools", "clean", "delta", "write")
+                   if ctx.metrics is not None else nullcontext())
+    with open(clean_path, "wb") as out, parse_stage:
+        out.write(XML_DECLARATION)
+        for _, elem in context:
+            parent = elem.getparent()
+            if parent is None:
+                # End of the root element; every child has been written already
+                root = elem
+                break
+            if parent.getparent() is not None:
+                continue
+
+            root = parent
+            student_count = clean_top_level(elem, ctx)
+            if student_count is None:
+                parent.remove(elem)
+                continue
+            total_students += student_count
+
+            with stage(ctx.metrics, "write"):
+                if tags is None:
+                    tags = root_tags(root)
+                    out.write(tags[0])
+                out.write(serialise_child(elem, root))
+            elem.clear()
+
+        if root is not None:
+            # Every child removed means the empty root is written as lxml would
+            out.write(tags[1] if tags is not None else root_tags(root)[2])
+
+    logger.info(f"Total students processed: {total_students}")
+    return total_students
+
+
+@dataclass
+class ShardPlan:
+    """Byte layout of a STIX file, split into runs of whole ns1:School elements."""
+    root_start: bytes
+    root_end: bytes
+    sniffed: Sniffed
+    # (start byte, end byte, line of start byte) of each shard, in document order
+    shards: List[Tuple[int, int, int]]
+
+
+def plan_shards(path: str, shard_bytes: int = SHARD_BYTES) -> ShardPlan:
+    """
+    Split a STIX file into shards of whole ns1:School elements by scanning its bytes.
+
+    Content before the first school (ns1:Metadata) and after the last one
+    form shards of their own. Schools are grouped until a shard reaches
+    shard_bytes. Tags inside comments or CDATA are not recognised.
+    """
+    sniffed = sniff_input(path)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        root_match = re.compile(rb"<(?![?!])([^\s>/]+)[^>]*>").search(mm)
+        root_qname = root_match.group(1)
+        content_start = root_match.end()
+        content_end = mm.rfind(b"</" + root_qname)
+        prefix = root_qname.rpartition(b":")[0]
+        school_qname = prefix + b":School" if prefix else b"School"
+
+        schools = []
+        school_start = None
+        school_tag = re.compile(rb"<(/?)" + re.escape(school_qname) + rb"\b[^>]*?(/?)>")
+        for match in school_tag.finditer(mm, content_start, content_end):
+            if match.group(1):
+                schools.append((school_start, match.end()))
+            elif match.group(2):
+                schools.append((match.start(), match.end()))
+            else:
+                school_start = match.start()
+
+        ranges = []
+        first = schools[0][0] if schools else content_end
+        last = schools[-1][1] if schools else content_end
+        ranges.append((content_start, first))
+        group_start = None
+        for start, end in schools:
+            group_start = start if group_start is None else group_start
+            if end - group_start >= shard_bytes:
+                ranges.append((group_start, end))
+                group_start = None
+        if group_start is not None:
+            ranges.append((group_start, last))
+        ranges.append((last, content_end))
+
+        shards = []
+        line = 1
+        offset = 0
+        for start, end in ranges:
+            line += mm[offset:start].count(b"\n")
+            offset = start
+            if mm[start:end].strip():
+                shards.append((start, end, line))
+
+        return ShardPlan(root_match.group(0), b"</" + root_qname + b">", sniffed, shards)
+
+
+class _RecordCollector(logging.Handler):
+    """Keep log records from a worker so the parent can write them to the file's log in order."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        # (logger name, level, message) is all the file log uses, and pickles far
+        # smaller than a LogRecord
+        self.records: List[Tuple[str, int, str]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append((record.name, record.levelno, record.getMessage()))
+
+
+def _init_shard_worker() -> None:
+    """Drop the log handlers a forked worker inherits; its records go back to the parent instead."""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+
+def _clean_shard(path: str, plan: ShardPlan, shard: Tuple[int, int, int], options: "CleanOptions") -> Dict[str, Any]:
+    """Clean one shard in a worker process and return its output bytes, counts and log records."""
+    collector = _RecordCollector()
+    logger.addHandler(collector)
+    store = open_store(path, options)
+    start, end, line = shard
+    ctx = CleanContext(review=[] if options.batch else None, store=store, line_offset=line - 1,
+                       changes=[] if options.change_log is not None else None,
+                       metrics=RunMetrics() if options.timings or options.metrics else None,
+                       validation=open_validation(options))
+    try:
+        with stage(ctx.metrics, "parse"):
+            with open(path, "rb") as f:
+                f.seek(start)
+                chunk = f.read(end - start)
+            if plan.sniffed.mixed:
+                chunk = repair(chunk)
+            # Keep the root start tag on one line so shard lines map straight
+            # onto the original file's lines
+            wrapped = plan.root_start.replace(b"\r", b" ").replace(b"\n", b" ") + chunk + plan.root_end
+            parser = etree.XMLParser(remove_blank_text=True, encoding=plan.sniffed.parser_encoding)
+            root = etree.fromstring(wrapped, parser)
+
+        parts = []
+        students = 0
+        for elem in list(root):
+            student_count = clean_top_level(elem, ctx)
+            if student_count is None:
+                continue
+            students += student_count
+            with stage(ctx.metrics, "write"):
+                parts.append(serialise_child(elem, root))
+        if store is not None:
+            logger.info(f"Applied {store.hits} stored corrections from: {store.path}")
+        return {"data": b"".join(parts), "tags": root_tags(root), "students": students,
+                "fixes": ctx.fixes, "review": ctx.review, "records": collector.records,
+                "changes": ctx.changes, "rule_counts": ctx.rule_counts,
+                "metrics": ctx.metrics.to_dict() if ctx.metrics is not None else None,
+                "validation": ctx.validation.to_dict() if ctx.validation is not None else None}
+    finally:
+        if store is not None:
+            store.close()
+        logger.removeHandler(collector)
+
+
+def clean_sharded(path: str, clean_path: str, ctx: CleanContext, options: "CleanOptions") -> int:
+    """
+    Clean a STIX file by cleaning runs of its schools in parallel worker processes.
+
+    Cleaned shard bytes are written straight to the output in document
+    order, along with each shard's log records. Sourcelines in the log and
+    review queue refer to the original file. Stage timings are summed over
+    the workers, so they can add up to more than the elapsed time. The output is byte-for-byte
+    identical to clean_tree. Returns the number of students.
+    """
+    with stage(ctx.metrics, "shard plan"):
+        plan = plan_shards(path)
+    logger.info(f"Cleaning {len(plan.shards)} shards with {options.shard_workers} workers.")
+    total_students = 0
+    tags = None
+    wrote_children = False
+    with ProcessPoolExecutor(max_workers=options.shard_workers, initializer=_init_shard_worker) as pool, open(clean_path, "wb") as out:
+        out.write(XML_DECLARATION)
+        count = len(plan.shards)
+        results = pool.map(_clean_shard, [path] * count, [plan] * count, plan.shards, [options] * count)
+        for result in results:
+            for name, level, message in result["records"]:
+                logger.handle(logging.getLogger(name).makeRecord(name, level, path, 0, message, None, None))
+            total_students += result["students"]
+            ctx.fixes.update(result["fixes"])
+            ctx.rule_counts.update(result["rule_counts"])
+            if ctx.metrics is not None:
+                ctx.metrics.merge(result["metrics"])
+            if ctx.changes is not None:
+                ctx.changes.extend(result["changes"])
+            if ctx.review is not None:
+                ctx.review.extend(result["review"])
+            if ctx.validation is not None:
+                ctx.validation.merge(result["validation"])
+            tags = result["tags"]
+            if result["data"]:
+                if not wrote_children:
+                    out.write(tags[0])
+                    wrote_children = True
+                out.write(result["data"])
+        if tags is not None:
+            # Every child removed means the empty root is written as lxml would
+            out.write(tags[1] if wrote_children else tags[2])
+
+    logger.info(f"Total students processed: {total_students}")
+    return total_students
+
+
+def write_review_file(review: List[Dict[str, str]], review_path: str) -> None:
+    """Write queued review items as CSV, or JSONL when the path ends in .jsonl."""
+    with open(review_path, "w", newline="", encoding="utf-8") as f:
+        if review_path.endswith(".jsonl"):
+            for item in review:
+                f.write(json.dumps(item) + "\n")
+        else:
+            writer = csv.DictWriter(f, fieldnames=REVIEW_FIELDS)
+            writer.writeheader()
+            writer.writerows(review)
+
+
+def read_corrections(corrections_path: str) -> List[Dict[str, str]]:
+    """Read a completed review file in either CSV or JSONL form."""
+    with open(corrections_path, newline="", encoding="utf-8") as f:
+        if corrections_path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+
+def apply_corrections(clean_path: str, corrections_path: str, store: Optional[CorrectionStore] = None,
+                      ns=NS, changes: Optional[ChangeLog] = None) -> int:
+    """
+    Patch a cleaned file with the decisions filled in on a review file.
+
+    Corrections are indexed by SchoolNumber, student key and field, and the
+    cleaned file is updated in a single sweep over its StreetNumber, Unit
+    and StreetType elements. Rows with an empty correction are left unchanged. Applied
+    decisions are saved to store so later runs resolve them automatically,
+    and recorded in changes under the "review:correction" rule.
+    Returns the number of rows applied.
+    """
+    index = {}
+    for row in read_corrections(corrections_path):
+        if row.get("correction") or row.get("street_name_correction"):
+            index[(row["school_number"], row["student_key"], row["field"])] = row
+
+    parser = etree.XMLParser(remove_blank_text=True)
+    tree = etree.parse(clean_path, parser)
+    applied = 0
+    for elem in tree.getroot().iter(f"{{{ns['ns1']}}}StreetNumber", f"{{{ns['ns1']}}}Unit",
+                                   f"{{{ns['ns1']}}}StreetType"):
+        school_number, student_key = record_context(elem, ns)
+        row = index.pop((school_number, student_key, etree.QName(elem).localname), None)
+        if row is None:
+            continue
+        row_num = int(row["sourceline"])
+        # Unit and street type decisions are remembered without address context
+        context = row["street_name"] if row["field"] == "StreetNumber" else None
+        correction = row.get("correction")
+        if correction:
+            old, elem.text = elem.text, "" if correction == CLEAR_VALUE else correction
+            if changes is not None:
+                changes.append((row_num, school_number, student_key, row["field"], old, elem.text,
+                                "review:correction", ""))
+            if store is not None:
+                store.put(row["field"], row["value"], elem.text, context)
+        street_name = elem.getparent().find("ns1:StreetName", ns)
+        if row.get("street_name_correction") and street_name is not None:
+            old, street_name.text = street_name.text, row["street_name_correction"]
+            if changes is not None:
+                changes.append((row_num, school_number, student_key, "StreetName", old, street_name.text,
+                                "review:correction", ""))
+            if store is not None:
+                store.put("StreetName", row["street_name"], street_name.text, row["street_number"])
+        applied += 1
+
+    for school_number, student_key, field_name in index:
+        logger.warning(f"Correction for {field_name} of student {student_key} in school {school_number} "
+                       f"did not match any record in {clean_path}.")
+
+    tree.write(clean_path, xml_declaration=True, encoding="utf-8", pretty_print=True)
+    return applied
+
+
+@dataclass
+class CleanOptions:
+    """Command-line options that apply to every file in a run."""
+    stream: bool = False
+    batch: bool = False
+    review_file: Optional[str] = None
+    memo: Optional[str] = None
+    no_memo: bool = False
+    memo_max_age: Optional[float] = DEFAULT_MAX_AGE_DAYS
+    memo_max_entries: Optional[int] = DEFAULT_MAX_ENTRIES
+    # Clean each file's schools across this many processes (0 to clean in one process)
+    shard_workers: int = 0
+    # Change log path for a single input; "" for the default <path>_CHANGES.jsonl, None for no change log
+    change_log: Optional[str] = ""
+    # Time each stage and rule, and print a summary table
+    timings: bool = False
+    # Save the timings and counters to <path>_METRICS.json
+    metrics: bool = False
+    # Run under cProfile, saving the stats to <path>.prof
+    profile: bool = False
+    # With --delta, the student state path; "" for the default next to the input, None for no delta processing
+    state: Optional[str] = None
+    # XSD each file is validated against; "" for data/stix_school_upload.xsd, None for no validation
+    schema: Optional[str] = None
+    # Violations of each rule written to <path>_VALIDATION.csv; the rest are only counted
+    max_violations_per_rule: int = DEFAULT_MAX_PER_RULE
+
+
+def expand_inputs(patterns: List[str]) -> List[str]:
+    """Expand files, directories and glob patterns into a sorted list of input XML files."""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "*.xml"))
+        else:
+            matches = glob.glob(pattern) or [pattern]
+        # Skip the outputs of earlier runs
+        paths.extend(match for match in matches if not match.endswith("_CLEAN.xml"))
+    return sorted(set(paths))
+
+
+def open_store(path: str, options: CleanOptions) -> Optional[CorrectionStore]:
+    """Open the correction store for an input file, unless disabled."""
+    if options.no_memo:
+        return None
+    memo_path = options.memo or os.path.join(os.path.dirname(os.path.abspath(path)), "twig_stix_memo.sqlite")
+    return CorrectionStore(memo_path, options.memo_max_age, options.memo_max_entries)
+
+
+def change_log_path(path: str, options: CleanOptions) -> str:
+    return options.change_log or path.replace(".xml", "_CHANGES.jsonl")
+
+
+def open_validation(options: CleanOptions) -> Optional[ValidationReport]:
+    """Start a validation report against the compiled schema, unless disabled."""
+    if options.schema is None:
+        return None
+    return ValidationReport(load_schema(options.schema or str(DEFAULT_SCHEMA)), options.max_violations_per_rule)
+
+
+def state_path(path: str, options: CleanOptions) -> str:
+    return options.state or os.path.join(os.path.dirname(os.path.abspath(path)), "twig_stix_state.sqlite")
+
+
+def clean_file(path: str, options: CleanOptions) -> Dict[str, Any]:
+    """
+    Clean one STIX file, logging to <path>.log, and return a summary of the run.
+
+    Every value changed or flagged is written to the change log rather than
+    the log, which only gets a count per rule. With timings or metrics, a
+    table of the time spent in each stage and rule is logged as well. With a
+    student state, only students new or changed since the previous run are
+    cleaned, and the rest reuse their cleaned form from that run; the
+    students added, changed and removed are written to <path>_DELTA.csv.
+
+    The log handler is attached for the duration of the call only, so files
+    cleaned one after another in the same worker process get separate logs.
+    """
+    logfile = path.replace('.xml','.log')
+    handler = logging.FileHandler(logfile, mode='w', encoding="utf-8")
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logger.addHandler(handler)
+    summary: Dict[str, Any] = {"file": path, "students": 0, "fixes": 0, "review_items": 0, "violations": 0,
+                               "error": None}
+    store = None
+    changes = None
+    state = None
+    delta = None
+    metrics = RunMetrics() if options.timings or options.metrics else None
+    profiler = cProfile.Profile() if options.profile else None
+    if profiler is not None:
+        profiler.enable()
     try:
-        student_info = record['ns1:Students']['ns1:Student']
-        total_students += len(student_info)
-    except TypeError:
-        logging.info(f"Record {record.get('ns1:SchoolNumber', 'Unknown')} has no students.")
-        school_records_to_remove.append(record.get('ns1:SchoolNumber', None))
-        # Remove these records from the XML
-
-for i in school_records_to_remove:
-    logging.info(f"Removing school with number: {i}")
-    for school in root.findall(".//ns1:School", ns):
-        school_number = school.find("ns1:SchoolNumber",ns)
-        if school_number is not None and school_number.text == i: 
-            logging.info(f"Found and removing school with number: {i}")
-            root.remove(school)
-
-logging.info(f"Total students to process: {total_students}")
-
-# start logging file
-logging.info(f"Processing file: {path}")
-logging.info(f"Logging to file: {logfile}")
-
-
-# loop through all phone numbers and clean them
-for elem in root.iter():
-    row_num = elem.sourceline
-    if row_num == 912:
-        print(elem.tag, elem.text)
-    if 'Phone' in elem.tag:
-        original_phone = elem.text
-        if original_phone:
-            cleaned_phone = clean_phone(original_phone)
-            if cleaned_phone != original_phone:
-                logging.info(f"Row {row_num}: Cleaned phone number from '{original_phone}' to '{cleaned_phone}'")
-                elem.text = cleaned_phone
-            if not cleaned_phone:
-                logging.warning(f"Row {row_num}: Phone number '{original_phone}' could not be cleaned and was set to empty.")
-                elem.text = ""
-
-    if 'StreetNumber' in elem.tag:
-        street_number = elem.text
-        parent = elem.getparent()
-        street_name = None
-
-        # Look for sibling StreetName in same parent
-        if parent is not None:
-            for sibling in parent:
-                if 'StreetName' in sibling.tag:
-                    street_name = sibling.text
-                    break
-        if street_number and len(street_number) > 6:
-            logging.warning(f"Row {row_num}: Street number '{street_number}' exceeds maximum length of 6.")
-
-            # Ask user to input a corrected street number
-            new_street_number = input(f"Please enter a corrected street number for '{street_number}'"
-                                      f"\nStreet Name:{street_name} (or press Enter to skip): "
-                                     ).strip()
-            # Ask user whether to update the street name as well
-            new_street_name = None
-            if street_name:
-                update_name = input(f"Do you want to update the street name '{street_name}' as well? (y/n): ").strip().lower()
-                if update_name == 'y':
-                    new_street_name = input(f"Please enter the corrected street name for '{street_name}': ").strip()
-
-            if new_street_number:
-                if new_street_number == "":
-                    elem.text = ""
-                else:
-                    elem.text = new_street_number
-                logging.info(f"Row {row_num}: Updated street number to '{new_street_number}'.")
-            if new_street_name and parent is not None:
-                for sibling in parent:
-                    if 'StreetName' in sibling.tag:
-                        sibling.text = new_street_name
-                        logging.info(f"Row {row_num}: Updated street name to '{new_street_name}'.")
-                        break
-
-
-    # Check unit length
-    if 'Unit' in elem.tag:
-        row_num = elem.sourceline
-        original_unit = elem.text.lower() if elem.text else None
-        if original_unit is not None:
-            if original_unit and len(original_unit) > 5:
-                logging.warning(f"Unit '{original_unit}' exceeds maximum length of 5.")
-                
-                if original_unit == 'basement':
-                    elem.text = 'BSMT'
-                    logging.info(f"{row_num}: Standardized unit 'basement' to 'BSMT'.")
-                
-                # if element contains
-                elif elem.text.lower() == 'lower un':
-                    elem.text = 'LOWR'
-                    logging.info(f"{row_num}: Standardized unit 'lower un' to 'LOWR'.")
-                
-                elif elem.text.lower() == 'd lower':
-                    elem.text = 'LOWR'
-                    logging.info(f"{row_num}: Standardized unit 'd lower' to 'LOWR'.")
-                
-                elif elem.text.lower() == 'upperlev':
-                    elem.text = 'UPPR'
-                    logging.info(f"{row_num}: Standardized unit 'UpperLev' to 'UPPR'.")
-                
-                elif elem.text.lower() == 'main flo':
-                    elem.text = 'MAIN'
-                    logging.info(f"{row_num}: Standardized unit 'main flo:' to 'MAIN'.")
-                
-                elif elem.text.lower() == 'mainfloo':
-                    elem.text = 'MAIN'
-                    logging.info(f"{row_num}: Standardized unit 'mainfloo' to 'MAIN'.")
-                
-                #look for brackets anywhere in the string and remove them
-                elif re.match(r'.*\(.*\).*', elem.text):
-                    new_unit = re.sub(r'[\(\)]', '', elem.text)
-                    logging.info(f"{row_num}: Standardized unit '{original_unit}' to '{new_unit}'.")
-                    elem.text = new_unit
-
-                elif re.match('unit \d+', elem.text.lower()):
-                    # remove 'unit ' and keep the number
-                    new_unit = re.sub(r'unit', '', elem.text.lower())
-                    logging.info(f"{row_num}: Standardized unit '{original_unit}' to '{new_unit}'.")
-                    elem.text = new_unit.strip()
-
-                else: 
-                    # Cannot standardize - flag for manual review
-                    # print out the row number if possible
-                    logging.warning(f"Row {row_num}: Unit '{original_unit}' could not be standardized. Requires manual review.")
-                    street_number = None
-                    street_name = None
-                    parent = elem.getparent()
-                    if parent is not None:
-                        for sibling in parent:
-                            if 'StreetNumber' in sibling.tag:
-                                street_number = sibling.text
-                            if 'StreetName' in sibling.tag:
-                                street_name = sibling.text
-                    # Ask user to input a corrected unit
-                    new_unit = input(
-                        f"Please enter a corrected unit for '{original_unit}' (or press Enter to skip): "
-                        f"\nContext: Street Number: {street_number}, Street Name: {street_name}: "
-                    ).strip()
-                    # Print out the street number and street name for context
-                    # If user pressed enter then replace with empty
-                    print(new_unit)
-                    if new_unit == "":
-                        elem.text = ""
-                        logging.info(f"Row {row_num}: Updated unit to '{new_unit}'.")
-                    elif new_unit:
-                        elem.text = new_unit
-                        logging.info(f"Row {row_num}: Updated unit to '{new_unit}'.")
-
-# Write cleaned XML to new file
-clean_path = path.replace(".xml", "_CLEAN.xml")
-
-tree.write(clean_path, xml_declaration=True, encoding="utf-8", pretty_print=True)
-logging.info(f"✔ Cleaned file saved: {clean_path}")
\ No newline at end of file
+        # start logging file
+        logger.info(f"Processing file: {path}")
+        logger.info(f"Logging to file: {logfile}")
+
+        store = open_store(path, options)
+        if options.change_log is not None:
+            changes = ChangeLog(change_log_path(path, options))
+        if options.state is not None:
+            state = StudentState(state_path(path, options), RULES_VERSION, path)
+            delta = DeltaReport(path.replace(".xml", "_DELTA.csv"))
+        ctx = CleanContext(review=[] if options.batch else None, store=store, changes=changes, metrics=metrics,
+                           state=state, delta=delta, validation=open_validation(options))
+
+        # Write cleaned XML to new file
+        clean_path = path.replace(".xml", "_CLEAN.xml")
+        if options.shard_workers:
+            summary["students"] = clean_sharded(path, clean_path, ctx, options)
+        elif options.stream or state is not None:
+            summary["students"] = clean_stream(path, clean_path, ctx)
+        else:
+            summary["students"] = clean_tree(path, clean_path, ctx)
+        logger.info(f"✔ Cleaned file saved: {clean_path}")
+        if ctx.validation is not None:
+            report_validation(path, ctx.validation)
+            summary["violations"] = ctx.validation.total
+        summary["fixes"] = sum(ctx.fixes.values())
+        for field_name, count in sorted(ctx.fixes.items()):
+            logger.info(f"Fixed {count} {field_name} values.")
+        for rule_name, count in sorted(ctx.rule_counts.items()):
+            logger.info(f"Rule {rule_name}: {count} values.")
+        if changes is not None:
+            with stage(metrics, "change log"):
+                changes.close()
+            logger.info(f"{changes.count} changes logged to: {changes.path}")
+        if state is not None:
+            with stage(metrics, "delta"):
+                for school_number, oen in state.finish():
+                    delta.add(school_number, oen, REMOVED)
+                delta.close()
+            counts = delta.counts
+            summary["delta"] = {status: counts[status] for status in (ADDED, CHANGED, REMOVED, UNCHANGED)}
+            logger.info(f"Since the previous run: {counts[ADDED]} added, {counts[CHANGED]} changed, "
+                        f"{counts[REMOVED]} removed, {counts[UNCHANGED]} unchanged. Delta saved to: {delta.path}")
+
+        if store is not None:
+            logger.info(f"Applied {store.hits} stored corrections from: {store.path}")
+
+        if ctx.review is not None:
+            review_path = options.review_file or path.replace(".xml", "_REVIEW.csv")
+            with stage(metrics, "review file"):
+                write_review_file(ctx.review, review_path)
+            summary["review_items"] = len(ctx.review)
+            logger.info(f"{len(ctx.review)} items queued for manual review in: {review_path}")
+
+        if metrics is not None:
+            report_metrics(path, ctx, summary, options)
+    except Exception as exc:
+        logger.exception(f"Processing failed: {exc}")
+        summary["error"] = str(exc)
+        if state is not None:
+            state.abort()
+    finally:
+        # Closed on failure too; the hit counts of the stored corrections used are written here
+        if store is not None:
+            store.close()
+        if changes is not None:
+            changes.close()
+        if state is not None:
+            state.close()
+            delta.close()
+        if profiler is not None:
+            profiler.disable()
+            profile_path = path.replace(".xml", ".prof")
+            save_profile(profiler, profile_path)
+            logger.info(f"Profile saved to: {profile_path} (top functions in {profile_path}.txt)")
+        logger.removeHandler(handler)
+        handler.close()
+    return summary
+
+
+def report_validation(path: str, validation: ValidationReport) -> None:
+    """Log the schema violations per rule and write the first of each to <path>_VALIDATION.csv."""
+    validation.finish()
+    if not validation.total:
+        logger.info("No schema violations found.")
+        return
+    validation_path = path.replace(".xml", "_VALIDATION.csv")
+    validation.write(validation_path)
+    logger.warning(f"{validation.total} schema violations of {len(validation.counts)} rules; the first "
+                   f"{validation.max_per_rule} of each are in: {validation_path}")
+    for line in validation.summary():
+        logger.warning(f"Schema violation {line}")
+
+
+def report_metrics(path: str, ctx: CleanContext, summary: Dict[str, Any], options: CleanOptions) -> None:
+    """Add the run's counts to its metrics, then log the table, print it and save it as asked."""
+    metrics = ctx.metrics
+    metrics.count("students", summary["students"])
+    metrics.count("review items", len(ctx.review or ()))
+    if ctx.validation is not None:
+        metrics.count("schema violations", ctx.validation.total)
+    for field_name, count in ctx.fixes.items():
+        metrics.count(f"fixed:{field_name}", count)
+    for rule_name, count in ctx.rule_counts.items():
+        metrics.count(f"rule:{rule_name}", count)
+    for status, count in summary.get("delta", {}).items():
+        metrics.count(f"delta:{status}", count)
+    table = metrics.table()
+    logger.info(f"Timings for {path}:\n{table}")
+    if options.timings:
+        print(f"Timings for {path}:\n{table}\n")
+    if options.metrics:
+        metrics_path = path.replace(".xml", "_METRICS.json")
+        metrics.save(metrics_path)
+        logger.info(f"Metrics saved to: {metrics_path}")
+
+
+def print_summary(summaries: List[Dict[str, Any]]) -> None:
+    """Print students processed, fixes applied and review items for each file, with totals."""
+    width = max([len("File")] + [len(summary["file"]) for summary in summaries])
+    print(f"{'File':<{width}}  {'Students':>9}  {'Fixes':>7}  {'Review':>7}")
+    for summary in summaries:
+        line = f"{summary['file']:<{width}}  {summary['students']:>9}  {summary['fixes']:>7}  {summary['review_items']:>7}"
+        if summary["error"]:
+            line += f"  FAILED: {summary['error']}"
+        print(line)
+    print(f"{'Total':<{width}}  {sum(s['students'] for s in summaries):>9}  "
+          f"{sum(s['fixes'] for s in summaries):>7}  {sum(s['review_items'] for s in summaries):>7}")
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Clean STIX school enrollment XML files.")
+    p.add_argument("paths", nargs="+", help="XML files, directories of XML files or glob patterns")
+    p.add_argument("--workers", type=int, default=os.cpu_count(),
+                   help="Number of files to clean in parallel with --batch (default: %(default)s)")
+    p.add_argument("--shard", action="store_true",
+                   help="With --batch, split each file into runs of schools and clean them in parallel "
+                        "across --workers processes")
+    p.add_argument("--stream", action="store_true",
+                   help="Clean one school at a time with bounded memory instead of loading the whole file")
+    p.add_argument("--batch", action="store_true",
+                   help="Never prompt; write values needing manual review to a review file instead")
+    p.add_argument("--review-file",
+                   help="Review file written by --batch for a single input "
+                        "(default: <path>_REVIEW.csv; use .jsonl for JSON lines)")
+    p.add_argument("--apply-corrections", metavar="REVIEW_FILE",
+                   help="Apply the corrections filled in on a review file to <path>_CLEAN.xml and exit. "
+                        f"Leave a correction empty to skip it, or set it to '{CLEAR_VALUE}' to clear the value")
+    p.add_argument("--memo",
+                   help="SQLite store of manual corrections reused across runs "
+                        "(default: twig_stix_memo.sqlite next to the input file)")
+    p.add_argument("--no-memo", action="store_true", help="Do not read or save stored corrections")
+    p.add_argument("--memo-max-age", type=float, default=DEFAULT_MAX_AGE_DAYS, metavar="DAYS",
+                   help="Expire stored corrections unused for this many days (default: %(default)s)")
+    p.add_argument("--memo-max-entries", type=int, default=DEFAULT_MAX_ENTRIES, metavar="N",
+                   help="Keep at most this many stored corrections, evicting the least recently used "
+                        "(default: %(default)s)")
+    p.add_argument("--change-log",
+                   help="JSONL log of every value changed or flagged, for a single input "
+                        "(default: <path>_CHANGES.jsonl; query it with change_log.py)")
+    p.add_argument("--no-change-log", action="store_true", help="Do not write a change log")
+    p.add_argument("--delta", action="store_true",
+                   help="Only clean students new or changed since the previous run of the same board, reusing "
+                        "the rest, and write the students added, changed and removed to <path>_DELTA.csv "
+                        "(implies --stream)")
+    p.add_argument("--state",
+                   help="SQLite store of the students of each board's previous run, for --delta "
+                        "(default: twig_stix_state.sqlite next to the input file)")
+    p.add_argument("--validate", action="store_true",
+                   help="Validate each file as it is parsed against data/stix_school_upload.xsd, or --schema")
+    p.add_argument("--schema", help="XSD to validate each file against as it is parsed (implies --validate)")
+    p.add_argument("--max-violations-per-rule", type=int, default=DEFAULT_MAX_PER_RULE, metavar="N",
+                   help="Schema violations of each rule written to <path>_VALIDATION.csv; the rest are only "
+                        "counted (default: %(default)s)")
+    p.add_argument("--timings", action="store_true",
+                   help="Time each stage (parse, validate, empty schools, each rule, write) and print a table")
+    p.add_argument("--metrics", action="store_true",
+                   help="Save stage timings, peak memory and per-rule counts to <path>_METRICS.json")
+    p.add_argument("--profile", action="store_true",
+                   help="Run under cProfile and save the stats to <path>.prof, with a text summary in "
+                        "<path>.prof.txt (with --shard only the parent process is profiled)")
+    args = p.parse_args()
+
+    paths = expand_inputs(args.paths)
+    if not paths:
+        p.error("no XML files found")
+    if (args.apply_corrections or args.review_file or args.change_log) and len(paths) > 1:
+        p.error("--apply-corrections, --review-file and --change-log take a single input file")
+
+    if args.shard and not args.batch:
+        p.error("--shard needs --batch; worker processes cannot prompt")
+    if args.delta and args.shard:
+        p.error("--delta cannot be combined with --shard")
+    options = CleanOptions(stream=args.stream, batch=args.batch, review_file=args.review_file,
+                           memo=args.memo, no_memo=args.no_memo,
+                           memo_max_age=args.memo_max_age, memo_max_entries=args.memo_max_entries,
+                           shard_workers=args.workers if args.shard else 0,
+                           change_log=None if args.no_change_log else args.change_log or "",
+                           timings=args.timings, metrics=args.metrics, profile=args.profile,
+                           state=(args.state or "") if args.delta else None,
+                           schema=(args.schema or "") if args.validate or args.schema else None,
+                           max_violations_per_rule=args.max_violations_per_rule)
+
+    if args.apply_corrections:
+        path = paths[0]
+        clean_path = path.replace(".xml", "_CLEAN.xml")
+        # Keep the cleaning run's log when applying corrections afterwards
+        handler = logging.FileHandler(path.replace('.xml','.log'), mode='a', encoding="utf-8")
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logger.addHandler(handler)
+        logger.info(f"Applying corrections from {args.apply_corrections} to {clean_path}")
+        store = open_store(path, options)
+        # Corrections follow the cleaning run's changes in the same change log
+        changes = ChangeLog(change_log_path(path, options), append=True) if options.change_log is not None else None
+        try:
+            applied = apply_corrections(clean_path, args.apply_corrections, store, changes=changes)
+        finally:
+            if store is not None:
+                store.close()
+            if changes is not None:
+                changes.close()
+        if changes is not None:
+            logger.info(f"{changes.count} corrections logged to: {changes.path}")
+        logger.info(f"✔ Applied {applied} corrections to: {clean_path}")
+        print(f"Applied {applied} corrections to {clean_path}")
+        return 0
+
+    # Prompts need the terminal, so interactive runs clean files one at a time in this
+    # process. Sharded runs already use every worker on each file in turn.
+    if args.batch and not args.shard and args.workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            summaries = list(pool.map(clean_file, paths, [options] * len(paths)))
+    else:
+        summaries = [clean_file(path, options) for path in paths]
+
+    print_summary(summaries)
+    return 1 if any(summary["error"] for summary in summaries) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
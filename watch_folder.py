@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""
+Watch a drop folder and run each STIX file that lands in it through the whole pipeline.
+
+New .xml files are noticed through inotify on Linux, or by polling the
+folder where inotify is not available. A file is only taken once its size
+and modification time have stayed the same for a settle period, so a file
+still being copied in is never read half written. Settled files are queued
+to a pool of worker processes, each of which takes one file through the
+steps otherwise run by hand:
+
+1. probe its ns1:Metadata for its standard name (rename_file),
+2. pretty-print it under that name in the output folder (pretty_print_xml),
+3. clean it in batch mode, writing a review file (twig_stix), and
+4. extract its student table and summary counts (pull_info).
+
+The original is then moved next to its outputs as <name>.xml.bak. Each
+file is identified by the SHA-256 of its contents in a ledger
+(ingest_ledger), so an upload is processed once however often, and under
+whatever names, it is dropped, even across restarts. Files whose contents
+were already processed are moved to duplicates/ in the output folder, and
+files that fail to failed/; dropping a failed file again retries it.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import shutil
+import signal
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from enrollment_cache import DEFAULT_CACHE_DIRNAME
+from ingest_ledger import IngestLedger, file_digest
+from pretty_print_xml import try_pretty, try_wrap_and_pretty
+import pull_info
+from rename_file import SCHOOL_TYPES, probe_metadata, standard_name
+from table_export import COMPRESSIONS, FORMATS
+from twig_stix import CleanOptions, clean_file
+
+logger = logging.getLogger("watch_folder")
+
+DEFAULT_OUTPUT_DIRNAME = "processed"
+DEFAULT_LEDGER_NAME = "watch_ledger.sqlite"
+# Seconds a file's size and modification time must stay the same before it is taken
+DEFAULT_SETTLE_S = 2.0
+# Seconds between scans of the folder when it cannot be watched through inotify
+DEFAULT_POLL_S = 2.0
+DUPLICATES_DIRNAME = "duplicates"
+FAILED_DIRNAME = "failed"
+
+# Outcomes of process_file
+DONE = "done"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+# inotify(7) event masks
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+# struct inotify_event, ahead of its name: wd, mask, cookie, len
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+# (size, modification time in ns) of a file in the drop folder
+Signature = Tuple[int, int]
+
+
+@dataclass
+class WatchOptions:
+    """Options for every file the daemon takes in."""
+    output: Path
+    school_type: str
+    ledger: Path
+    dataset: str = "enrollment"
+    stage: str = "raw"
+    clean: CleanOptions = field(default_factory=lambda: CleanOptions(stream=True, batch=True))
+    # pull_info export of each cleaned file
+    export_format: str = "csv"
+    compression: Optional[str] = None
+    filter_config: Optional[Path] = None
+
+
+def move_aside(path: Path, directory: Path) -> Path:
+    """Move a file into directory, adding .1, .2, ... to its name rather than overwriting another file."""
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / path.name
+    copy = 0
+    while target.exists():
+        copy += 1
+        target = directory / f"{path.stem}.{copy}{path.suffix}"
+    shutil.move(str(path), str(target))
+    return target
+
+
+def pretty_print(source: Path, target: Path) -> None:
+    """Pretty-print source to target as pretty_print_xml does, wrapping content that is not a single document."""
+    if try_pretty(str(source), str(target)) is None and try_wrap_and_pretty(str(source), str(target)) is None:
+        raise ValueError("the file is too malformed to pretty-print")
+
+
+def extract(clean_path: Path, out: Path, options: WatchOptions) -> int:
+    """Export the student table and summary counts of a cleaned file as pull_info does, and return its students."""
+    # pull_info's messages follow the cleaning run's in the file's log
+    handler = logging.FileHandler(str(out.with_suffix(".log")), mode="a", encoding="utf-8")
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    pull_info.logger.addHandler(handler)
+    try:
+        df = pull_info.load_students(clean_path, clean_path.parent / DEFAULT_CACHE_DIRNAME)
+        summaries = pull_info.summarize(df)
+        df_filtered = pull_info.filter_students(df, pull_info.load_filter(options.filter_config))
+        pull_info.export_outputs(df, df_filtered, summaries, out, export_format=options.export_format,
+                                 compression=options.compression)
+    finally:
+        pull_info.logger.removeHandler(handler)
+        handler.close()
+    return len(df)
+
+
+def process_file(path: str, options: WatchOptions) -> Dict[str, Any]:
+    """
+    Run one dropped file through the pipeline in a worker process, and return a summary.
+
+    The file is claimed in the ledger by its contents first. Its outputs
+    are written under its standard name in the output folder, and it is
+    marked done before the original is moved there as <name>.xml.bak, so
+    a restart in between finds it already done rather than processing it
+    twice.
+    """
+    started = time.perf_counter()
+    source = Path(path)
+    summary: Dict[str, Any] = {"file": path, "status": FAILED, "target": None, "students": 0, "error": None}
+    ledger = IngestLedger(str(options.ledger))
+    try:
+        digest = file_digest(path)
+        previous = ledger.claim(digest, path)
+        if previous is not None:
+            summary.update(status=DUPLICATE, target=previous.target,
+                           error=f"same contents as {previous.source}, which is {previous.status}")
+            move_aside(source, options.output / DUPLICATES_DIRNAME)
+            return summary
+        try:
+            target = options.output / standard_name(probe_metadata(source), options.school_type, options.dataset,
+                                                    options.stage)
+            other = ledger.set_target(digest, str(target))
+            if other is not None:
+                raise ValueError(f"{target.name} is also the new name of {other.source}")
+            summary["target"] = str(target)
+            pretty_print(source, target)
+            cleaned = clean_file(str(target), options.clean)
+            if cleaned["error"]:
+                raise RuntimeError(f"cleaning failed: {cleaned['error']}")
+            summary["review_items"] = cleaned["review_items"]
+            summary["students"] = extract(target.with_name(target.stem + "_CLEAN.xml"), target, options)
+        except Exception as exc:
+            ledger.fail(digest, str(exc))
+            summary["error"] = str(exc)
+            move_aside(source, options.output / FAILED_DIRNAME)
+            return summary
+        ledger.finish(digest)
+        shutil.move(path, str(target) + ".bak")
+        summary["status"] = DONE
+    except OSError as exc:
+        # The file left the folder or could not be read; it is taken again if it comes back
+        summary["error"] = str(exc)
+    finally:
+        ledger.close()
+        summary["seconds"] = time.perf_counter() - started
+    return summary
+
+
+def fail_lost_file(path: Path, options: WatchOptions, error: str) -> Dict[str, Any]:
+    """
+    Fail a file whose worker returned no summary, as when the worker process died, and return a summary.
+
+    Its claim in the ledger is marked failed, so dropping it again retries
+    it, and the file is moved to failed/ if it is still in the folder.
+    """
+    ledger = IngestLedger(str(options.ledger))
+    try:
+        ledger.fail_source(str(path), error)
+    finally:
+        ledger.close()
+    if path.exists():
+        move_aside(path, options.output / FAILED_DIRNAME)
+    return {"file": str(path), "status": FAILED, "error": error}
+
+
+class InotifyWatcher:
+    """The names of files created, written or moved into a directory, read from Linux inotify."""
+
+    def __init__(self, directory: Path) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        mask = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), str(directory))
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read(self) -> Optional[Set[str]]:
+        """Return the names of the files changed since the last read, or None if events were lost and a scan is needed."""
+        names: Set[str] = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.add(os.fsdecode(name))
+        return None if overflow else names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def open_watcher(directory: Path, poll: bool = False) -> Optional[InotifyWatcher]:
+    """Watch a directory through inotify where it is available; None means it has to be polled."""
+    if poll or not sys.platform.startswith("linux"):
+        return None
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError) as exc:
+        # AttributeError: a C library without inotify
+        logger.warning("Cannot watch %s through inotify (%s); polling it instead.", directory, exc)
+        return None
+
+
+class DropFolder:
+    """
+    The .xml files in a drop folder, and how long each has been unchanged.
+
+    A file is ready once it is not empty and its signature has not changed
+    for settle seconds. Files handed out are remembered by their signature
+    until they change or leave the folder, so none is handed out twice.
+    """
+
+    def __init__(self, directory: Path, settle: float = DEFAULT_SETTLE_S) -> None:
+        self.directory = directory
+        self.settle = settle
+        # Files not handed out yet: their signature, and when it last changed
+        self.pending: Dict[Path, Tuple[Signature, float]] = {}
+        self.taken: Dict[Path, Signature] = {}
+
+    @staticmethod
+    def wanted(path: Path) -> bool:
+        # Hidden files are partial uploads of some transfer tools
+        return path.suffix.lower() == ".xml" and not path.name.startswith(".")
+
+    def scan(self) -> None:
+        """Look at every file in the folder, forgetting those that have left it."""
+        present = {path for path in self.directory.iterdir() if self.wanted(path)}
+        for path in (self.pending.keys() | self.taken.keys()) - present:
+            self.forget(path)
+        for path in present:
+            self.touch(path)
+
+    def forget(self, path: Path) -> None:
+        self.pending.pop(path, None)
+        self.taken.pop(path, None)
+
+    def touch(self, path: Path) -> None:
+        """Note that a file may have changed."""
+        if not self.wanted(path):
+            return
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self.forget(path)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self.taken.get(path) == signature:
+            return
+        self.taken.pop(path, None)
+        if path not in self.pending or self.pending[path][0] != signature:
+            self.pending[path] = (signature, time.monotonic())
+
+    def ready(self) -> List[Path]:
+        """Hand out the files that have settled, in the order they did."""
+        now = time.monotonic()
+        due = sorted((changed, path) for path, (signature, changed) in self.pending.items()
+                     if signature[0] and now - changed >= self.settle)
+        ready = []
+        for changed, path in due:
+            # A file can change without an event, e.g. on a network share
+            self.touch(path)
+            if path in self.pending and self.pending[path][1] == changed:
+                self.taken[path] = self.pending.pop(path)[0]
+                ready.append(path)
+        return ready
+
+    def next_due(self) -> Optional[float]:
+        """Return the seconds until the next file could settle, or None if no file is waiting to."""
+        waiting = [changed for signature, changed in self.pending.values() if signature[0]]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) + self.settle - time.monotonic())
+
+
+def _wake(fd: int) -> None:
+    try:
+        os.write(fd, b"\0")
+    except BlockingIOError:
+        # The pipe is full, so the loop is already due to wake
+        pass
+
+
+def _init_worker() -> None:
+    """Leave stopping to the daemon, which lets files in progress finish."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def report(summary: Dict[str, Any]) -> None:
+    if summary["status"] == DONE:
+        logger.info("Done %s -> %s: %d students, %d review items in %.1fs", summary["file"], summary["target"],
+                    summary["students"], summary["review_items"], summary["seconds"])
+    elif summary["status"] == DUPLICATE:
+        logger.info("Skipped %s: %s", summary["file"], summary["error"])
+    else:
+        logger.error("Failed %s: %s", summary["file"], summary["error"])
+
+
+def watch(directory: Path, options: WatchOptions, workers: int, settle: float = DEFAULT_SETTLE_S,
+          poll: bool = False, poll_interval: float = DEFAULT_POLL_S, once: bool = False) -> int:
+    """
+    Process the files dropped in directory until SIGINT or SIGTERM, and return the number that failed.
+
+    At most `workers` files are processed at once; the rest wait their turn
+    in the folder. On a stop signal, files in progress are finished and
+    files not yet started are left for the next run. With once, the daemon
+    stops as soon as the files already in the folder are done.
+
+    A worker process that dies takes down every file in progress; those
+    files are failed, and the next file is taken by a new pool of workers.
+    """
+    options.output.mkdir(parents=True, exist_ok=True)
+    ledger = IngestLedger(str(options.ledger))
+    interrupted = ledger.recover()
+    ledger.close()
+    if interrupted:
+        logger.info("%d files interrupted by the last shutdown will be processed again.", interrupted)
+
+    folder = DropFolder(directory, settle)
+    watcher = None if once else open_watcher(directory, poll)
+    wake_read, wake_write = os.pipe()
+    os.set_blocking(wake_read, False)
+    os.set_blocking(wake_write, False)
+    stopping = False
+
+    def stop(signum: int, frame: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        _wake(wake_write)
+
+    previous_handlers = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    logger.info("Watching %s%s with %d workers; outputs go to %s", directory,
+                "" if watcher is not None else f" (polling every {poll_interval:g}s)", workers, options.output)
+
+    queue: Deque[Path] = deque()
+    in_flight: Dict[Future, Path] = {}
+    failed = 0
+
+    def collect(futures: List[Future]) -> None:
+        nonlocal failed
+        for future in futures:
+            path = in_flight.pop(future)
+            try:
+                summary = future.result()
+            except Exception as exc:
+                summary = fail_lost_file(path, options, f"worker died: {exc!r}")
+            report(summary)
+            failed += summary["status"] == FAILED
+            # Forgets the file once it has been moved out of the folder
+            folder.touch(path)
+
+    folder.scan()
+    last_scan = time.monotonic()
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    try:
+        while True:
+            collect([future for future in in_flight if future.done()])
+
+            queue.extend(folder.ready())
+            while queue and len(in_flight) < workers and not stopping:
+                path = queue.popleft()
+                try:
+                    future = pool.submit(process_file, str(path), options)
+                except BrokenProcessPool:
+                    # A worker died; fail the files it took down with it and start new workers
+                    logger.error("A worker process died; starting new workers.")
+                    queue.appendleft(path)
+                    wait(in_flight)
+                    collect(list(in_flight))
+                    pool.shutdown()
+                    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+                    continue
+                future.add_done_callback(lambda _: _wake(wake_write))
+                in_flight[future] = path
+
+            if not in_flight and (stopping or (once and not queue and folder.next_due() is None)):
+                break
+            timeout = folder.next_due()
+            if watcher is None:
+                until_scan = max(0.0, last_scan + poll_interval - time.monotonic())
+                timeout = until_scan if timeout is None else min(timeout, until_scan)
+            watched = [wake_read] if watcher is None else [wake_read, watcher.fileno()]
+            readable, _, _ = select.select(watched, [], [], timeout)
+            if wake_read in readable:
+                while True:
+                    try:
+                        os.read(wake_read, 4096)
+                    except BlockingIOError:
+                        break
+            if watcher is not None and watcher.fileno() in readable:
+                names = watcher.read()
+                if names is None:
+                    logger.warning("inotify events were lost; rescanning %s", directory)
+                    folder.scan()
+                else:
+                    for name in names:
+                        folder.touch(directory / name)
+            if watcher is None and time.monotonic() - last_scan >= poll_interval:
+                folder.scan()
+                last_scan = time.monotonic()
+    finally:
+        pool.shutdown()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        if watcher is not None:
+            watcher.close()
+        os.close(wake_read)
+        os.close(wake_write)
+    if stopping and (queue or folder.pending):
+        logger.info("Stopped; %d files left in %s for the next run.", len(queue) + len(folder.pending), directory)
+    return failed
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Watch a drop folder and rename, pretty-print, clean and extract "
+                                            "each STIX file that lands in it.")
+    p.add_argument("directory", type=Path, help="Drop folder to watch")
+    p.add_argument("school_type", type=str.lower, choices=SCHOOL_TYPES, help="Level of the schools in its files")
+    p.add_argument("--output", type=Path,
+                   help=f"Folder for the renamed files and their outputs (default: {DEFAULT_OUTPUT_DIRNAME}/ "
+                        "in the drop folder)")
+    p.add_argument("--ledger", type=Path,
+                   help=f"SQLite ledger of the files processed (default: {DEFAULT_LEDGER_NAME} in the output folder)")
+    p.add_argument("--workers", type=int, default=os.cpu_count(),
+                   help="Number of files processed at once (default: %(default)s)")
+    p.add_argument("--settle", type=float, default=DEFAULT_SETTLE_S, metavar="SECONDS",
+                   help="Take a file once it has not changed for this long (default: %(default)s)")
+    p.add_argument("--poll", action="store_true", help="Poll the folder instead of watching it through inotify")
+    p.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_S, metavar="SECONDS",
+                   help="Seconds between scans of a polled folder (default: %(default)s)")
+    p.add_argument("--once", action="store_true", help="Process the files already in the folder, then exit")
+    p.add_argument("--dataset", default="enrollment", help="DATASET component of the new names")
+    p.add_argument("--stage", default="raw", help="STAGE component of the new names")
+    p.add_argument("--delta", action="store_true",
+                   help="Clean only the students new or changed since each board's previous upload (twig_stix --delta)")
+    p.add_argument("--validate", action="store_true",
+                   help="Validate files against data/stix_school_upload.xsd as they are cleaned")
+    p.add_argument("--filter-config", type=Path, help="JSON file of cohort filters for pull_info")
+    p.add_argument("--format", choices=FORMATS, default="csv", dest="export_format",
+                   help="Export format of the student tables (default: %(default)s)")
+    p.add_argument("--compress", choices=COMPRESSIONS, help="Compress the CSV student tables")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if not args.directory.is_dir():
+        logger.error("Drop folder not found: %s", args.directory)
+        return 2
+    if args.compress and args.export_format != "csv":
+        p.error("--compress applies to CSV output only")
+    # The ledger outlives the working directory of any one run
+    directory = args.directory.resolve()
+    output = (args.output or directory / DEFAULT_OUTPUT_DIRNAME).resolve()
+    options = WatchOptions(
+        output=output, school_type=args.school_type, ledger=args.ledger or output / DEFAULT_LEDGER_NAME,
+        dataset=args.dataset, stage=args.stage,
+        clean=CleanOptions(stream=True, batch=True, state="" if args.delta else None,
+                           schema="" if args.validate else None),
+        export_format=args.export_format, compression=args.compress, filter_config=args.filter_config,
+    )
+    failed = watch(directory, options, max(1, args.workers), args.settle, args.poll, args.poll_interval,
+                   args.once)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,182 @@
+"""
+Shared reading of STIX files: what encoding the bytes are really in, and what to hand lxml.
+
+Board exports do not always say what they are. Some declare windows-1252
+but hold UTF-8, some declare nothing (so UTF-8 by default) but hold
+windows-1252, and some mix the two, such as a UTF-8 export with values
+pasted from a windows-1252 system. sniff() reads the byte order mark, the
+XML declaration and a prefix of the content and decides what the bytes
+are. lxml is then given the file itself with that encoding, so it decodes
+natively, or for a mixed file a stream that repairs it to UTF-8 a chunk at
+a time. The whole file is never decoded in Python.
+"""
+import codecs
+import re
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Optional, Union
+
+from lxml import etree
+
+# How much of the file sniff_file() reads
+SNIFF_BYTES = 1 << 20
+_CHUNK = 1 << 20
+_DECLARED_ENCODING = re.compile(rb"""\s*<\?xml[^>]*encoding=["']([\w.\-]+)""")
+_BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+# A well-formed multibyte UTF-8 character
+_UTF8_MULTIBYTE = re.compile(rb"[\xc2-\xdf][\x80-\xbf]|[\xe0-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}")
+# Encodings read one byte per character, where any byte sequence decodes
+_SINGLE_BYTE = {"cp1252", "latin_1", "iso8859_15"}
+# Exports that are neither UTF-8 nor declared single-byte come from windows systems
+FALLBACK_ENCODING = "windows-1252"
+
+# windows-1252 leaves five bytes undefined; they are read as latin-1
+_CP1252 = [bytes([byte]).decode("cp1252", errors="ignore") or chr(byte) for byte in range(256)]
+REPAIR_ERRORS = "stix-windows-1252"
+
+
+def _windows_1252_fallback(error: UnicodeError) -> tuple:
+    """Decode the bytes that are not valid UTF-8 as windows-1252."""
+    if not isinstance(error, UnicodeDecodeError):
+        raise error
+    return "".join(_CP1252[byte] for byte in error.object[error.start:error.end]), error.end
+
+
+codecs.register_error(REPAIR_ERRORS, _windows_1252_fallback)
+
+
+def _codec(name: str) -> Optional[str]:
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+@dataclass(frozen=True)
+class Sniffed:
+    """What a file's bytes say about their encoding, and what they are."""
+    # Encoding named by the XML declaration, as written
+    declared: Optional[str]
+    # Encoding of the byte order mark
+    bom: Optional[str]
+    # Encoding the content is actually in, for lxml and Python alike
+    encoding: str
+    # UTF-8 with windows-1252 bytes among it; read through RepairedStream
+    mixed: bool = False
+
+    @property
+    def mislabelled(self) -> bool:
+        """Whether the content does not match its declaration (or UTF-8, with none)."""
+        return self.mixed or _codec(self.declared or "utf-8") != _codec(self.encoding)
+
+    @property
+    def parser_encoding(self) -> str:
+        """Encoding to tell lxml, overriding the declaration, for the source from open_source()."""
+        return "utf-8" if self.mixed else self.encoding
+
+    def describe(self) -> str:
+        declared = f"declares {self.declared}" if self.declared else "declares no encoding"
+        if self.mixed:
+            return f"{declared} but mixes UTF-8 and windows-1252; windows-1252 bytes are repaired"
+        return f"{declared} but is {self.encoding}"
+
+
+def sniff(prefix: bytes) -> Sniffed:
+    """
+    Decide the encoding of a file from its first bytes.
+
+    A byte order mark settles it. Otherwise, if the prefix holds non-ASCII
+    bytes, valid UTF-8 means UTF-8 whatever the declaration says; UTF-8
+    characters among invalid bytes mean a mixed file; and anything else is
+    the declared single-byte encoding, or windows-1252. With only ASCII in
+    the prefix, the declaration is trusted.
+    """
+    declared_match = _DECLARED_ENCODING.match(prefix[:1024].lstrip(codecs.BOM_UTF8))
+    declared = declared_match.group(1).decode("ascii") if declared_match else None
+    for bom, encoding in _BOMS:
+        if prefix.startswith(bom):
+            return Sniffed(declared, encoding, encoding)
+
+    declared_codec = _codec(declared) if declared else None
+    if prefix.isascii():
+        return Sniffed(declared, None, declared if declared_codec else "utf-8")
+    try:
+        # The prefix may end partway through a character
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        if _UTF8_MULTIBYTE.search(prefix):
+            return Sniffed(declared, None, "utf-8", mixed=True)
+        return Sniffed(declared, None, declared if declared_codec in _SINGLE_BYTE else FALLBACK_ENCODING)
+    return Sniffed(declared, None, declared if declared_codec == "utf-8" else "utf-8")
+
+
+def sniff_file(path: Union[str, Any], size: int = SNIFF_BYTES) -> Sniffed:
+    """Sniff the encoding of a file from its first size bytes."""
+    with open(path, "rb") as f:
+        return sniff(f.read(size))
+
+
+class RepairedStream:
+    """
+    Read-only file-like view of a mixed file as UTF-8.
+
+    Bytes that are not valid UTF-8 are decoded as windows-1252. The file is
+    decoded and re-encoded a chunk at a time, so memory stays flat.
+    """
+
+    def __init__(self, path: Union[str, Any]) -> None:
+        self._file = open(path, "rb")
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors=REPAIR_ERRORS)
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            chunk = self._file.read(_CHUNK)
+            text = self._decoder.decode(chunk, final=not chunk)
+            if text or not chunk:
+                return text.encode("utf-8")
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "RepairedStream":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def repair(data: bytes) -> bytes:
+    """Return mixed UTF-8 and windows-1252 bytes as UTF-8."""
+    return data.decode("utf-8", errors=REPAIR_ERRORS).encode("utf-8")
+
+
+def open_source(path: Union[str, Any], sniffed: Sniffed) -> Union[str, RepairedStream]:
+    """Return what to hand lxml for a file: its path, or a RepairedStream for a mixed file."""
+    return RepairedStream(path) if sniffed.mixed else str(path)
+
+
+def open_bytes(path: Union[str, Any], sniffed: Sniffed) -> Union[BinaryIO, RepairedStream]:
+    """Open a file for reading bytes in sniffed.parser_encoding."""
+    return RepairedStream(path) if sniffed.mixed else open(path, "rb")
+
+
+def iterparse(path: Union[str, Any], sniffed: Optional[Sniffed] = None, **kwargs: Any) -> etree.iterparse:
+    """etree.iterparse over a file in the encoding it is actually in."""
+    sniffed = sniffed or sniff_file(path)
+    return etree.iterparse(open_source(path, sniffed), encoding=sniffed.parser_encoding, **kwargs)
+
+
+def parse(path: Union[str, Any], sniffed: Optional[Sniffed] = None, **parser_options: Any) -> etree._ElementTree:
+    """etree.parse of a file in the encoding it is actually in, with an XMLParser built from parser_options."""
+    sniffed = sniffed or sniff_file(path)
+    parser = etree.XMLParser(encoding=sniffed.parser_encoding, **parser_options)
+    source = open_source(path, sniffed)
+    if isinstance(source, RepairedStream):
+        with source:
+            return etree.parse(source, parser)
+    return etree.parse(source, parser)